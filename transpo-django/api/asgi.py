@@ -0,0 +1,514 @@
+"""
+ASGI application serving the next times of stations and locations on an event loop.
+
+Django 1.9 has no support for ASGI, so this is a plain ASGI 3 application in front of the WSGI application.
+The compact lookups of the next times of a station or a location, with a date or time and a limit,
+are answered on the event loop from the timetable index, preloaded at startup,
+so that many long-lived client connections don't each hold a thread.
+The database is only queried in a pool of threads: for the station or the stations of a location,
+and for the times when the timetables are not available in memory or the service calendar is enabled.
+All other requests go to the WSGI application, in the same pool of threads, and behave as before.
+
+The stream of the departures of a location is a long-lived response of server-sent events,
+sent the departures once, and then only their changes, as departures pass or schedules change.
+All the streams of a location and limit share a board, refreshed by a single task:
+it looks up the next times only when a departure passed or the schedule versions of its stations changed,
+checked every TRANSPO_BOARD_CHECK_SECONDS or as soon as a schedule changes in this process,
+so the work is proportional to the changes and not to the number of clients.
+"""
+import asyncio
+import heapq
+import logging
+import sys
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from io import BytesIO
+from itertools import islice
+
+from django.conf import settings
+from django.core import signals
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.urlresolvers import Resolver404, resolve
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from lines import calendar, models, timetable
+from lines.signals import schedule_changed
+from api import serializers
+from api.views import StationTimesForm, board_check_seconds, board_limit
+
+logger = logging.getLogger(__name__)
+
+STATION_TIMES = 'station-times-list'
+LOCATION_TIMES = 'location-times-list'
+LOCATION_STREAM = 'location-times-stream'
+
+KEEPALIVE = b': keepalive\n\n'
+
+# the running applications, to wake their boards when a schedule changes
+_applications = weakref.WeakSet()
+
+
+def wsgi_environ(scope, body=b''):
+    """
+    Return the WSGI environ of the request of an ASGI HTTP scope
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name, value = name.decode('latin-1').lower(), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def station_links(station_id, request):
+    """
+    Return the links of the times of a station, or None if it doesn't exist
+    """
+    line_id = models.Station.objects.filter(pk=station_id).values_list('line_id', flat=True).first()
+    if line_id is None:
+        return None
+    return serializers.compact_station_links(models.Station(id=station_id, line_id=line_id), request)
+
+
+def location_links(location_id, request):
+    """
+    Return the links of the times of a location, including its stations, or None if it doesn't exist
+    """
+    location = models.Location.objects.filter(pk=location_id).first()
+    if location is None:
+        return None
+    return serializers.compact_location_links(location, request)
+
+
+def next_times(station_ids, date, limit):
+    """
+    Return the next times of stations, across the following days as needed to reach the limit,
+    merged in order of service date, time and id
+    """
+    times = models.Station.next_daily_times_by_station(station_ids, date, limit)
+    merged = heapq.merge(*times.values(), key=lambda s: (s.service_date, s.time, s.id))
+    return list(islice(merged, limit))
+
+
+def location_versions(location_id):
+    """
+    Return the ids and schedule versions of the stations of a location, or None if it doesn't exist
+    """
+    versions = models.Location.objects.filter(pk=location_id).order_by('stations__id')
+    versions = list(versions.values_list('stations__id', 'stations__schedule_version'))
+    if not versions:
+        return None
+    return [row for row in versions if row[0] is not None]
+
+
+def departure_key(row):
+    return row['id'], row['date']
+
+
+def passes_at(schedule):
+    """
+    Return the date from which the next times no longer include a time, looked up to the minute
+    """
+    date = datetime.combine(schedule.service_date, schedule.time) + timedelta(minutes=1)
+    return timezone.make_aware(date) if settings.USE_TZ else date
+
+
+def encode_headers(headers):
+    return [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+def indexed_next_times(station_ids, date, limit):
+    """
+    Return the next times of stations as next_times does, from a snapshot of their timetables taken at once,
+    or None if they can't all be found without querying the database
+    """
+    if not timetable.is_enabled() or calendar.is_enabled():
+        return None
+    timetables = timetable.snapshot(station_ids)
+    if timetables is None:
+        return None
+
+    def day_times(station_timetable):
+        return lambda day_date, count, after: station_timetable.next_times(
+            '{:%a}'.format(day_date), day_date, after)[:count]
+
+    times = [models.with_rollover(day_times(timetables[station_id]), date, limit) for station_id in station_ids]
+    merged = heapq.merge(*times, key=lambda s: (s.service_date, s.time, s.id))
+    return list(islice(merged, limit))
+
+
+class Board(object):
+    """
+    The next departures of a location, shared by all the streams of the location and limit
+    """
+    def __init__(self, application, location_id, limit):
+        self.application = application
+        self.location_id = location_id
+        self.limit = limit
+        self.station_ids = set()
+        self.versions = None
+        self.times = []
+        self.rows = None
+        self.stale = False
+        self.changed = asyncio.Event()
+        # the queues of events of the streams, and the links of those waiting for the departures
+        self.subscribers = set()
+        self.pending = {}
+
+    def subscribe(self, queue, links):
+        self.subscribers.add(queue)
+        if self.rows is None:
+            self.pending[queue] = links
+        else:
+            queue.put_nowait(self.departures_event(links))
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        self.pending.pop(queue, None)
+        if not self.subscribers:
+            self.changed.set()
+
+    def wake(self):
+        self.stale = True
+        self.changed.set()
+
+    def departures_event(self, links):
+        data = OrderedDict(list(links.items()) + [('times', self.rows)])
+        return serializers.server_sent_event('departures', data)
+
+    def publish(self, message):
+        for queue in self.subscribers:
+            if queue not in self.pending:
+                queue.put_nowait(message)
+
+    def close(self):
+        """
+        End the streams of the board, and stop it
+        """
+        for queue in self.subscribers:
+            queue.put_nowait(None)
+        self.subscribers.clear()
+        self.pending.clear()
+        self.changed.set()
+        if self.application.boards.get((self.location_id, self.limit)) is self:
+            del self.application.boards[self.location_id, self.limit]
+
+    async def run(self):
+        """
+        Refresh the board until its last stream is gone or its location no longer exists.
+        A failed refresh is logged and retried after a delay doubling up to TRANSPO_BOARD_CHECK_SECONDS.
+        """
+        failures = 0
+        try:
+            while self.subscribers:
+                self.changed.clear()
+                timeout = board_check_seconds()
+                try:
+                    if not await self.refresh():
+                        return
+                    failures = 0
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Refresh of the board of location %s failed', self.location_id)
+                    failures += 1
+                    timeout = min(timeout, 2 ** (failures - 1))
+                else:
+                    if self.times:
+                        timeout = max(1, min(timeout, (passes_at(self.times[0]) - timezone.now()).total_seconds()))
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.close()
+
+    async def refresh(self):
+        """
+        Look up the departures if a departure passed or a schedule changed, and send the changes to the streams
+
+        :return: False if the location no longer exists
+        """
+        versions = await self.application.run_sync(location_versions, self.location_id)
+        if versions is None:
+            return False
+
+        date = timezone.now()
+        passed = bool(self.times) and passes_at(self.times[0]) <= date
+        if self.rows is not None and versions == self.versions and not passed and not self.stale:
+            self.publish(KEEPALIVE)
+            return True
+
+        self.versions, self.stale = versions, False
+        station_ids = [station_id for station_id, _ in versions]
+        self.station_ids = set(station_ids)
+        times = indexed_next_times(station_ids, date, self.limit)
+        if times is None:
+            times = await self.application.run_sync(next_times, station_ids, date, self.limit)
+        rows = serializers.compact_times(serializers.compact_rows(times), with_station=True)
+
+        previous = {departure_key(row) for row in self.rows or []}
+        current = {departure_key(row) for row in rows}
+        removed = [OrderedDict([('id', pk), ('date', day)]) for pk, day in
+                   (departure_key(row) for row in self.rows or []) if (pk, day) not in current]
+        added = [row for row in rows if departure_key(row) not in previous]
+        self.times, self.rows = times, rows
+
+        if removed or added:
+            self.publish(serializers.server_sent_event('changes', OrderedDict([
+                ('removed', removed),
+                ('added', added),
+            ])))
+        else:
+            self.publish(KEEPALIVE)
+        for queue, links in self.pending.items():
+            queue.put_nowait(self.departures_event(links))
+        self.pending.clear()
+        return True
+
+
+class TimesApplication(object):
+    """
+    ASGI application answering the compact lookups of next times, and passing other requests to a WSGI application
+
+    :param executor: the pool of threads in which to query the database and call the WSGI application,
+                     by default the default executor of the event loop
+    """
+    def __init__(self, wsgi_application, executor=None):
+        self.wsgi_application = wsgi_application
+        self.executor = executor
+        self.loop = None
+        self.boards = {}
+        _applications.add(self)
+
+    async def __call__(self, scope, receive, send):
+        self.loop = asyncio.get_event_loop()
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('unsupported scope type: {}'.format(scope['type']))
+
+    def run_sync(self, fun, *args):
+        """
+        Call a function in the pool of threads, with the database connections of the thread
+        closed before and after if obsolete, as for a request
+        """
+        def call():
+            signals.request_started.send(sender=self.__class__)
+            try:
+                return fun(*args)
+            finally:
+                signals.request_finished.send(sender=self.__class__)
+        return asyncio.get_event_loop().run_in_executor(self.executor, call)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if timetable.is_enabled():
+                    await self.run_sync(timetable.preload)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for board in list(self.boards.values()):
+                    board.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        environ = wsgi_environ(scope, body)
+        if await self.stream_departures(environ, receive, send):
+            return
+        response = await self.lookup_times(environ)
+        if response is None:
+            response = await asyncio.get_event_loop().run_in_executor(self.executor, self.call_wsgi, environ)
+
+        status, headers, content = response
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': encode_headers(headers)})
+        await send({'type': 'http.response.body', 'body': content})
+
+    def call_wsgi(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], content
+
+    def schedule_changed(self, station_ids):
+        """
+        Wake the boards of the stations whose schedule changed, from any thread
+        """
+        station_ids = set(station_ids)
+        for board in list(self.boards.values()):
+            if board.station_ids & station_ids:
+                self.loop.call_soon_threadsafe(board.wake)
+
+    def subscribe(self, location_id, limit, queue, links):
+        board = self.boards.get((location_id, limit))
+        if board is None:
+            board = self.boards[location_id, limit] = Board(self, location_id, limit)
+            asyncio.ensure_future(board.run())
+        board.subscribe(queue, links)
+        return board
+
+    async def stream_departures(self, environ, receive, send):
+        """
+        Stream the departures of a location and their changes as server-sent events, until the client disconnects,
+        and return True, or return False for other requests
+        """
+        if environ['REQUEST_METHOD'] != 'GET':
+            return False
+        try:
+            match = resolve(environ['PATH_INFO'])
+        except Resolver404:
+            return False
+        if match.url_name != LOCATION_STREAM or 'format' in match.kwargs:
+            return False
+
+        request = WSGIRequest(environ)
+        form = StationTimesForm(request.GET)
+        if not form.is_valid():
+            return False
+        location_id = int(match.kwargs['location_id'])
+        links = await self.run_sync(location_links, location_id, request)
+        if links is None:
+            status, headers, content = self.json_response(404, {'detail': 'Not found.'}, request)
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': encode_headers(headers)})
+            await send({'type': 'http.response.body', 'body': content})
+            return True
+
+        queue = asyncio.Queue()
+        board = self.subscribe(location_id, form.cleaned_data['limit'] or board_limit(), queue, links)
+        headers = self.response_headers('text/event-stream; charset=utf-8', request) + [
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),
+        ]
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': encode_headers(headers)})
+
+        disconnected = asyncio.Event()
+
+        async def wait_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+            queue.put_nowait(None)
+
+        watcher = asyncio.ensure_future(wait_disconnect())
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+        finally:
+            board.unsubscribe(queue)
+            watcher.cancel()
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+        return True
+
+    async def lookup_times(self, environ):
+        """
+        Return the response of a compact lookup of next times, or None for other requests
+        """
+        if environ['REQUEST_METHOD'] != 'GET' or 'text/html' in environ.get('HTTP_ACCEPT', ''):
+            return None
+        try:
+            match = resolve(environ['PATH_INFO'])
+        except Resolver404:
+            return None
+        if match.url_name not in (STATION_TIMES, LOCATION_TIMES) or 'format' in match.kwargs:
+            return None
+
+        request = WSGIRequest(environ)
+        form = StationTimesForm(request.GET)
+        if 'format' in request.GET or not form.is_valid() or not form.cleaned_data['compact']:
+            return None
+        date, limit = form.parse_date(), form.cleaned_data['limit']
+        if date is None or limit is None:
+            return None
+
+        if match.url_name == STATION_TIMES:
+            station_id = int(match.kwargs['station_id'])
+            links = await self.run_sync(station_links, station_id, request)
+            station_ids, with_station = [station_id], False
+        else:
+            links = await self.run_sync(location_links, int(match.kwargs['location_id']), request)
+            station_ids, with_station = [] if links is None else [int(pk) for pk in links['stations']], True
+        if links is None:
+            return self.json_response(404, {'detail': 'Not found.'}, request)
+
+        times = indexed_next_times(station_ids, date, limit)
+        if times is None:
+            times = await self.run_sync(next_times, station_ids, date, limit)
+        data = OrderedDict(list(links.items()) + [
+            ('times', serializers.compact_times(serializers.compact_rows(times), with_station)),
+        ])
+        return self.json_response(200, data, request)
+
+    @staticmethod
+    def response_headers(content_type, request):
+        headers = [('Content-Type', content_type)]
+        if getattr(settings, 'CORS_ORIGIN_ALLOW_ALL', False) and 'HTTP_ORIGIN' in request.META:
+            headers.append(('Access-Control-Allow-Origin', '*'))
+        return headers
+
+    @classmethod
+    def json_response(cls, status, data, request):
+        return status, cls.response_headers('application/json', request), JSONRenderer().render(data)
+
+
+@receiver(schedule_changed)
+def wake_boards(sender, station_ids, **kwargs):
+    # once the change is visible to the threads refreshing the boards
+    def wake():
+        for application in list(_applications):
+            if application.loop is not None:
+                application.schedule_changed(station_ids)
+    transaction.on_commit(wake)
@@ -0,0 +1,234 @@
+"""
+Cache of the responses of the times endpoints of stations and locations.
+
+Enabled by setting TRANSPO_TIMES_CACHE to the alias of a cache in CACHES.
+Cached responses are keyed by a generation of their station or location,
+which is replaced whenever the schedule of the station or the stations of the location change,
+so that outdated responses are never found again, and eventually evicted.
+The generations are replaced once the change is committed,
+so that responses cached meanwhile from the previous data stay under the previous generation.
+
+The receivers replacing the generations are connected when the api app is ready, in every process,
+so that management commands changing schedules invalidate a cache shared by processes, such as memcached.
+A local memory cache, such as LRULocMemCache, is only invalidated in the process making the change,
+so it is only suitable when a single process serves the times.
+"""
+import hashlib
+import itertools
+import pickle
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.db import transaction
+from django.db.models.signals import post_delete, m2m_changed
+from django.dispatch import receiver
+
+from lines import models
+from lines.signals import schedule_changed
+
+STATION = 'station'
+LOCATION = 'location'
+
+# hits and misses of the current process
+stats = Counter()
+
+# the entries and locks of the caches by name, shared by the instances of the threads of the process
+_caches = {}
+_locks = {}
+# the order of accesses to the entries
+_clock = itertools.count()
+
+
+class LRULocMemCache(BaseCache):
+    """
+    Local memory cache that evicts the least recently used entries when full.
+    Its entries are those of the current process only, as are their invalidations.
+
+    Reads don't take the lock: they stamp the entry with the order of the access,
+    and the stamps are only compared when the cache is full and entries are evicted.
+    Each entry is a list of the pickled value, the expiry time or None, and the stamp.
+    """
+    def __init__(self, name, params):
+        super(LRULocMemCache, self).__init__(params)
+        self._entries = _caches.setdefault(name, {})
+        self._lock = _locks.setdefault(name, threading.Lock())
+
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return None
+        return entry
+
+    def _set(self, key, value, timeout):
+        if key not in self._entries and len(self._entries) >= self._max_entries:
+            self._cull()
+        self._entries[key] = [pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self.get_backend_timeout(timeout),
+                              next(_clock)]
+
+    def _cull(self):
+        if self._cull_frequency == 0:
+            self._entries.clear()
+            return
+
+        now = time.time()
+        # expired entries first, then the least recently used
+        keys = sorted(self._entries, key=lambda key: (self._entries[key][1] is None or self._entries[key][1] > now,
+                                                      self._entries[key][2]))
+        for key in keys[:max(1, len(keys) // self._cull_frequency)]:
+            del self._entries[key]
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            if self._entry(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        entry = self._entry(key)
+        if entry is None:
+            return default
+        entry[2] = next(_clock)
+        return pickle.loads(entry[0])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(entry[0]) + delta
+            entry[0] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            entry[2] = next(_clock)
+        return value
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._entry(key) is not None
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def get_cache():
+    alias = getattr(settings, 'TRANSPO_TIMES_CACHE', None)
+    if alias:
+        return caches[alias]
+    return None
+
+
+def generation_key(kind, pk):
+    return 'times:{}:{}:generation'.format(kind, pk)
+
+
+def get_generation(cache, kind, pk):
+    key = generation_key(kind, pk)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def response_key(cache, kind, pk, date, request):
+    """
+    Return the cache key of the response of the times of a station or location.
+
+    The times depend on the date, as holidays and other calendar exceptions are per date,
+    and on the minute of the date,
+    the pagination and other parameters, and the host used in the URLs of the response.
+    """
+    params = sorted((name, value) for name, value in request.GET.items() if name not in ('date', 'time'))
+    when = 'all' if date is None else '{:%Y-%m-%d %H:%M}'.format(date)
+    variant = '{} {} {} {}'.format(request.build_absolute_uri('/'), request.accepted_renderer.format, when, params)
+    digest = hashlib.md5(variant.encode()).hexdigest()
+    return 'times:{}:{}:{}:{}'.format(kind, pk, get_generation(cache, kind, pk), digest)
+
+
+def lookup(kind, pk, date, request):
+    """
+    Look up the cached response of the times of a station or location.
+
+    :return: (key, entry), where entry is None on a miss, and key is None when the cache is disabled
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, None
+    try:
+        pk = int(pk)
+    except ValueError:
+        return None, None
+
+    key = response_key(cache, kind, pk, date, request)
+    entry = cache.get(key)
+    stats['misses' if entry is None else 'hits'] += 1
+    return key, entry
+
+
+def store(key, entry):
+    get_cache().set(key, entry, getattr(settings, 'TRANSPO_TIMES_CACHE_TIMEOUT', DEFAULT_TIMEOUT))
+
+
+def invalidate(kind, pks):
+    cache = get_cache()
+    if cache is not None:
+        keys = [generation_key(kind, pk) for pk in pks]
+        transaction.on_commit(lambda: cache.set_many({key: uuid.uuid4().hex for key in keys}, None))
+
+
+def invalidate_stations(station_ids):
+    if get_cache() is None:
+        return
+    invalidate(STATION, station_ids)
+    location_ids = models.Location.objects.filter(stations__in=station_ids).values_list('id', flat=True)
+    invalidate(LOCATION, set(location_ids))
+
+
+@receiver(schedule_changed)
+def schedule_changed_handler(sender, station_ids, **kwargs):
+    invalidate_stations(station_ids)
+
+
+@receiver(post_delete, sender=models.Station)
+def station_deleted_handler(sender, instance, **kwargs):
+    invalidate(STATION, [instance.pk])
+
+
+@receiver(post_delete, sender=models.Location)
+def location_deleted_handler(sender, instance, **kwargs):
+    invalidate(LOCATION, [instance.pk])
+
+
+@receiver(m2m_changed, sender=models.Location.stations.through)
+def location_stations_changed_handler(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate(LOCATION, [instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        invalidate(LOCATION, pk_set)
+    elif action == 'pre_clear':
+        invalidate(LOCATION, instance.location_set.values_list('id', flat=True))
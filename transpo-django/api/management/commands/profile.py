@@ -0,0 +1,31 @@
+import argparse
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from api import profiling
+
+
+class Command(BaseCommand):
+    help = 'Run a management command under cProfile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('command',
+                            help='Name of the command to profile')
+        parser.add_argument('args', nargs=argparse.REMAINDER,
+                            help='Arguments of the command to profile')
+        parser.add_argument('--output', '-o',
+                            help='Write the profile to this directory, instead of printing a summary')
+        parser.add_argument('--sort', default=getattr(settings, 'TRANSPO_PROFILING_SORT', 'cumulative'),
+                            help='Order of the functions of the summary, for example: cumulative, tottime, calls')
+        parser.add_argument('--limit', type=int, default=getattr(settings, 'TRANSPO_PROFILING_LIMIT', 40),
+                            help='Number of functions in the summary')
+
+    def handle(self, *args, **options):
+        _, profile = profiling.profile_call(call_command, options['command'], *args,
+                                            stdout=self.stdout, stderr=self.stderr)
+        if options['output']:
+            path = profiling.dump(profile, options['output'], options['command'])
+            self.stderr.write('profile written to {}'.format(path))
+        else:
+            self.stderr.write(profiling.summary(profile, options['sort'], options['limit']))
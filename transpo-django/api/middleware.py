@@ -0,0 +1,199 @@
+"""
+Middleware to measure the cost of requests.
+"""
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from api import profiling
+
+logger = logging.getLogger(__name__)
+
+IN_LIST_PATTERN = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """
+    Return the statement of a query, with any number of parameters in lists counted as one,
+    so that queries that differ only by their parameters are grouped together
+
+    >>> normalize_sql('SELECT a FROM t WHERE id IN (%s, %s,  %s) AND b = %s')
+    'SELECT a FROM t WHERE id IN (...) AND b = %s'
+    """
+    return WHITESPACE_PATTERN.sub(' ', IN_LIST_PATTERN.sub('(...)', sql)).strip()
+
+
+class TimingCursorWrapper(CursorWrapper):
+    """
+    Cursor that records the SQL and duration of its queries, without formatting their parameters
+    """
+    def __init__(self, cursor, db, queries):
+        super(TimingCursorWrapper, self).__init__(cursor, db)
+        self.queries = queries
+
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super(TimingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return super(TimingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+
+class QueryRecorder(object):
+    """
+    Records the queries of all database connections of the current thread, until stopped
+    """
+    def __init__(self):
+        self.queries = []
+        self.restore = []
+
+    def start(self):
+        for connection in connections.all():
+            previous = connection.__dict__.get('make_debug_cursor')
+            self.restore.append((connection, connection.force_debug_cursor, previous))
+            wrap = connection.make_debug_cursor if connection.queries_logged else connection.make_cursor
+            connection.make_debug_cursor = self.wrapper(wrap, connection)
+            connection.force_debug_cursor = True
+        return self
+
+    def wrapper(self, wrap, connection):
+        def make_debug_cursor(cursor):
+            return TimingCursorWrapper(wrap(cursor), connection, self.queries)
+        return make_debug_cursor
+
+    def stop(self):
+        for connection, force_debug_cursor, make_debug_cursor in self.restore:
+            connection.force_debug_cursor = force_debug_cursor
+            if make_debug_cursor is None:
+                del connection.make_debug_cursor
+            else:
+                connection.make_debug_cursor = make_debug_cursor
+        self.restore = []
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.queries)
+
+    def statements(self):
+        """
+        Return the count and total duration of the queries of each normalized statement, most expensive first
+        """
+        statements = OrderedDict()
+        for sql, duration in self.queries:
+            statement = normalize_sql(sql)
+            count, total = statements.get(statement, (0, 0))
+            statements[statement] = count + 1, total + duration
+        return sorted(statements.items(), key=lambda item: (item[1][1], item[1][0]), reverse=True)
+
+
+class SQLInstrumentationMiddleware(object):
+    """
+    Count the queries and the time spent in the database of each request,
+    and report them in a Server-Timing header, along with the total time of the request.
+
+    Requests exceeding TRANSPO_SQL_QUERY_BUDGET queries or TRANSPO_SQL_LATENCY_BUDGET milliseconds
+    are logged as warnings, with their queries grouped by statement.
+    Enabled by the TRANSPO_SQL_INSTRUMENTATION setting.
+    """
+    def __init__(self):
+        if not getattr(settings, 'TRANSPO_SQL_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.query_budget = getattr(settings, 'TRANSPO_SQL_QUERY_BUDGET', None)
+        self.latency_budget = getattr(settings, 'TRANSPO_SQL_LATENCY_BUDGET', None)
+        self.statements_logged = getattr(settings, 'TRANSPO_SQL_STATEMENTS_LOGGED', 10)
+
+    def process_request(self, request):
+        request._sql_recorder = QueryRecorder().start()
+        request._sql_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        recorder = getattr(request, '_sql_recorder', None)
+        if recorder is None:
+            # an earlier middleware responded before this one processed the request
+            return response
+        recorder.stop()
+
+        total = (time.perf_counter() - request._sql_start) * 1000
+        db = recorder.duration * 1000
+        metrics = 'db;dur={:.3f};desc="{} queries", total;dur={:.3f}'.format(db, len(recorder.queries), total)
+        if response.has_header('Server-Timing'):
+            metrics = response['Server-Timing'] + ', ' + metrics
+        response['Server-Timing'] = metrics
+
+        over_queries = self.query_budget is not None and len(recorder.queries) > self.query_budget
+        over_latency = self.latency_budget is not None and total > self.latency_budget
+        if over_queries or over_latency:
+            self.log(request, response, recorder, db, total)
+        return response
+
+    def log(self, request, response, recorder, db, total):
+        lines = ['{} {} {}: {} queries, {:.1f} ms in the database, {:.1f} ms in total'.format(
+            request.method, request.get_full_path(), response.status_code, len(recorder.queries), db, total)]
+        for sql, (count, duration) in recorder.statements()[:self.statements_logged]:
+            lines.append('  {:>4} x {:>8.1f} ms  {}'.format(count, duration * 1000, sql))
+        logger.warning('\n'.join(lines))
+
+
+class ProfilingMiddleware(object):
+    """
+    Profile single requests on demand, with cProfile.
+
+    A request is profiled when it has a profile query parameter or an X-Profile header,
+    and the user is staff, or the X-Profile-Secret header matches the TRANSPO_PROFILING_SECRET setting.
+    With the value "file", and the TRANSPO_PROFILING_DIR setting, the profile is written to a file
+    of that directory, named in the X-Profile-File header of the response,
+    otherwise the response is replaced by a summary of the profile.
+    Enabled by the TRANSPO_PROFILING setting; other requests only pay for checking the parameter and header.
+    """
+    query_param = 'profile'
+    header = 'HTTP_X_PROFILE'
+    secret_header = 'HTTP_X_PROFILE_SECRET'
+
+    def __init__(self):
+        if not getattr(settings, 'TRANSPO_PROFILING', False):
+            raise MiddlewareNotUsed
+        self.secret = getattr(settings, 'TRANSPO_PROFILING_SECRET', None)
+        self.directory = getattr(settings, 'TRANSPO_PROFILING_DIR', None)
+        self.sort = getattr(settings, 'TRANSPO_PROFILING_SORT', 'cumulative')
+        self.limit = getattr(settings, 'TRANSPO_PROFILING_LIMIT', 40)
+
+    def is_allowed(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff:
+            return True
+        secret = request.META.get(self.secret_header)
+        return bool(self.secret and secret and constant_time_compare(secret, self.secret))
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        mode = request.GET.get(self.query_param, request.META.get(self.header))
+        if mode is None or not self.is_allowed(request):
+            return None
+
+        def call_view():
+            response = view_func(request, *view_args, **view_kwargs)
+            # deferred rendering, such as of the responses of the API, is part of the cost of the request
+            if hasattr(response, 'render') and callable(response.render):
+                response = response.render()
+            return response
+
+        response, profile = profiling.profile_call(call_view)
+        if mode == 'file' and self.directory:
+            response['X-Profile-File'] = os.path.basename(profiling.dump(profile, self.directory, request.path))
+            return response
+        return HttpResponse(profiling.summary(profile, self.sort, self.limit), content_type='text/plain')
@@ -0,0 +1,109 @@
+import base64
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime, parse_time
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class TimesCursorPagination(BasePagination):
+    """
+    Keyset pagination of times ordered by (time, id).
+
+    The view passes the position of the cursor to the query of the times,
+    so that every page costs the same, no matter how deep.
+    Pagination is active only when the cursor or page_size parameter is used,
+    otherwise all times are returned, as a plain list.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def is_active(self, request):
+        return self.cursor_query_param in request.query_params or self.page_size_query_param in request.query_params
+
+    def get_page_size(self, request):
+        default = getattr(settings, 'TRANSPO_TIMES_PAGE_SIZE', 100)
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param], strict=True,
+                                 cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return default
+
+    def get_limit(self, request):
+        """
+        Return the number of times to fetch for a page, or None when not paginating
+        """
+        if self.is_active(request):
+            return self.get_page_size(request) + 1
+        return None
+
+    def get_after(self, request):
+        """
+        Return the (time, id) position of the cursor of the request, or None for the first page
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value, pk = base64.urlsafe_b64decode(encoded.encode()).decode().split(',')
+            position = self.parse_position(value)
+            if position is None:
+                raise ValueError(value)
+            return position, int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+
+    @staticmethod
+    def parse_position(value):
+        return parse_time(value)
+
+    @staticmethod
+    def encode_cursor(position, pk):
+        return base64.urlsafe_b64encode('{},{}'.format(position.isoformat(), pk).encode()).decode()
+
+    @staticmethod
+    def row_position(row):
+        # rows are daily schedules, or compact (id, station_id, day, time) rows
+        if isinstance(row, tuple):
+            return row[3], row[0]
+        return row.time, row.id
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_active(request):
+            return None
+
+        page_size = self.get_page_size(request)
+        rows = list(queryset[:page_size + 1])
+        page = rows[:page_size]
+
+        self.next_url = None
+        if len(rows) > page_size:
+            cursor = self.encode_cursor(*self.row_position(page[-1]))
+            self.next_url = replace_query_param(request.build_absolute_uri(), self.cursor_query_param, cursor)
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.next_url),
+            ('results', data),
+        ]))
+
+
+class DatesCursorPagination(TimesCursorPagination):
+    """
+    Keyset pagination of dates ordered by (date, id), always active
+    """
+    def is_active(self, request):
+        return True
+
+    @staticmethod
+    def parse_position(value):
+        return parse_datetime(value)
+
+    @staticmethod
+    def row_position(row):
+        return row.date, row.id
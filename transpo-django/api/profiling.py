@@ -0,0 +1,51 @@
+"""
+Profiling of single calls with cProfile, written to files or summarized as text.
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+from datetime import datetime
+
+UNSAFE_FILENAME_PATTERN = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def profile_call(fun, *args, **kwargs):
+    """
+    Call a function under cProfile
+
+    :return: (result of the call, profile)
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result = fun(*args, **kwargs)
+    finally:
+        profile.disable()
+    return result, profile
+
+
+def summary(profile, sort='cumulative', limit=40):
+    """
+    Return the statistics of the most expensive functions of a profile, as text
+    """
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def dump(profile, directory, name):
+    """
+    Write a profile to a new file in a directory, named after the time and the name of what was profiled,
+    to load with pstats or visualize with tools such as snakeviz
+
+    :return: the path of the file
+    """
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    filename = '{}-{}.prof'.format(stamp, UNSAFE_FILENAME_PATTERN.sub('_', name).strip('_'))
+    path = os.path.join(directory, filename)
+    profile.dump_stats(path)
+    return path
@@ -1,4 +1,9 @@
+from collections import OrderedDict
+
+from django.db.models.query import QuerySet
 from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.reverse import reverse
 from lines import models
 
 
@@ -7,9 +12,35 @@ class DailyScheduleSerializer(serializers.HyperlinkedModelSerializer):
         model = models.DailySchedule
 
 
+class DepartureSerializer(DailyScheduleSerializer):
+    """
+    Daily schedule with the date of the day it is used for, when the times of many days are listed
+    """
+    service_date = serializers.SerializerMethodField()
+
+    def get_service_date(self, obj):
+        service_date = getattr(obj, 'service_date', None)
+        return None if service_date is None else service_date.isoformat()
+
+
+class DayTimeSerializer(serializers.Serializer):
+    """
+    A time of a day of the daily schedule of a station, without its hyperlinks, to write many at once
+    """
+    day = serializers.CharField(max_length=30)
+    time = serializers.TimeField()
+
+
+class GeneralScheduleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.GeneralSchedule
+        fields = ('id', 'date')
+
+
 class StationSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.Station
+        fields = ('url', 'name', 'line')
 
 
 class LineSerializer(serializers.HyperlinkedModelSerializer):
@@ -20,3 +51,86 @@ class LineSerializer(serializers.HyperlinkedModelSerializer):
 class LocationSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.Location
+
+
+def compact_rows(times):
+    """
+    Return the id, station id, day and time of daily schedules,
+    straight from the database for querysets, without instantiating models,
+    followed by the service date of schedules that have one
+    """
+    if isinstance(times, QuerySet):
+        return times.values_list('id', 'station_id', 'day', 'time')
+
+    rows = []
+    for s in times:
+        row = (s.id, s.station_id, s.day, s.time)
+        if hasattr(s, 'service_date'):
+            row += (s.service_date,)
+        rows.append(row)
+    return rows
+
+
+def compact_times(rows, with_station=False):
+    result = []
+    for values in rows:
+        pk, station_id, day, time = values[:4]
+        row = OrderedDict(id=pk)
+        if with_station:
+            row['station'] = station_id
+        row['day'] = day
+        row['time'] = time.isoformat()
+        if len(values) > 4:
+            row['date'] = values[4].isoformat()
+        result.append(row)
+    return result
+
+
+def compact_station_links(station, request):
+    return OrderedDict([
+        ('station', reverse('station-detail', kwargs={'pk': station.id}, request=request)),
+        ('line', reverse('line-detail', kwargs={'pk': station.line_id}, request=request)),
+    ])
+
+
+def compact_location_links(location, request):
+    stations = OrderedDict()
+    for station_id, line_id in location.stations.order_by('id').values_list('id', 'line_id'):
+        stations[str(station_id)] = OrderedDict([
+            ('url', reverse('station-detail', kwargs={'pk': station_id}, request=request)),
+            ('line', reverse('line-detail', kwargs={'pk': line_id}, request=request)),
+        ])
+    return OrderedDict([
+        ('location', reverse('location-detail', kwargs={'pk': location.id}, request=request)),
+        ('stations', stations),
+    ])
+
+
+def server_sent_event(name, data, retry=None):
+    """
+    Return a server-sent event of JSON data, with the delay in milliseconds before clients reconnect if given
+    """
+    message = b'' if retry is None else 'retry: {}\n'.format(retry).encode()
+    return message + b'event: ' + name.encode() + b'\ndata: ' + JSONRenderer().render(data) + b'\n\n'
+
+
+def journey_data(legs, request):
+    """
+    Return the departure and arrival of a journey, and its legs, with links to their lines and stations
+    """
+    datetime_field = serializers.DateTimeField()
+    rows = []
+    for leg in legs:
+        rows.append(OrderedDict([
+            ('trip', leg.trip_id),
+            ('line', reverse('line-detail', kwargs={'pk': leg.line_id}, request=request)),
+            ('from', reverse('station-detail', kwargs={'pk': leg.from_station_id}, request=request)),
+            ('departure', datetime_field.to_representation(leg.departure)),
+            ('to', reverse('station-detail', kwargs={'pk': leg.to_station_id}, request=request)),
+            ('arrival', datetime_field.to_representation(leg.arrival)),
+        ]))
+    return OrderedDict([
+        ('departure', rows[0]['departure'] if rows else None),
+        ('arrival', rows[-1]['arrival'] if rows else None),
+        ('legs', rows),
+    ])
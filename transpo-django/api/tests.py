@@ -1,16 +1,30 @@
+import asyncio
 import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
 from datetime import timedelta
+from io import StringIO
+from unittest import mock
 from django.contrib.auth.models import User
 
+from django.core import signals
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.core.wsgi import get_wsgi_application
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import close_old_connections, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils.datetime_safe import time
 from django.utils import timezone
 from django.utils.timezone import datetime
 from rest_framework import status
 from rest_framework.test import APITestCase
-from lines import models
-from api import views
+from lines import journeys, models, timetable
+from api import asgi, cache, middleware, views
 
 TESTSERVER_URL = 'http://testserver'
 
@@ -154,6 +168,82 @@ class StationTimesTestCase(TestCase):
         self.assertEquals(self.times[3:], to_times(to_json(response)))
 
 
+    def test_times_with_limit_roll_over_to_next_service_day(self):
+        url = self.baseurl() + '?date=' + self.service_datestr + ' 18:00&limit=3'
+        response = self.client.get(url)
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+
+        results = to_json(response)
+        self.assertEquals(self.times[3:] + self.times[:1], to_times(results))
+        self.assertEquals(['2016-01-11', '2016-01-11', '2016-01-18'], [row['service_date'] for row in results])
+
+    def test_compact_times_with_limit(self):
+        url = self.baseurl() + '?date=' + self.service_datestr + ' 18:20&limit=2&compact=1'
+        rows = to_json(self.client.get(url))['times']
+        self.assertEquals(['2016-01-11', '2016-01-18'], [row['date'] for row in rows])
+
+    def test_invalid_limit_param(self):
+        response = self.client.get(self.baseurl() + '?limit=0')
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+class BulkStationTimesTestCase(APITestCase):
+    def setUp(self):
+        self.line = models.Line.objects.create(name='R5')
+        self.station = models.Station.objects.create(name='Jaures', line=self.line)
+        self.station.register_daily_times(['Sat'], [time(8, 10), time(9, 10)])
+        self.url = reverse('station-times-bulk', kwargs={'station_id': self.station.id})
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+
+    def day_times(self):
+        return list(self.station.dailyschedule_set.order_by('day', 'time').values_list('day', 'time'))
+
+    def test_create(self):
+        response = self.client.post(self.url, [{'day': 'Sun', 'time': '10:10'}, {'day': 'Sun', 'time': '11:10'}],
+                                    format='json')
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+        self.assertEquals({'created': 2, 'deleted': 0, 'schedule_version': 2}, to_json(response))
+        self.assertEquals(4, len(self.day_times()))
+
+    def test_replace(self):
+        response = self.client.put(self.url, [{'day': 'Sat', 'time': '08:10'}, {'day': 'Sun', 'time': '10:10'}],
+                                   format='json')
+        self.assertEquals({'created': 1, 'deleted': 1, 'schedule_version': 2}, to_json(response))
+        self.assertEquals([('Sat', time(8, 10)), ('Sun', time(10, 10))], self.day_times())
+
+    def test_replace_days(self):
+        self.station.register_daily_times(['Sun'], [time(10, 10)])
+        response = self.client.put(self.url + '?days=Sat', [{'day': 'Sat', 'time': '08:30'}], format='json')
+        self.assertEquals({'created': 1, 'deleted': 2, 'schedule_version': 3}, to_json(response))
+        self.assertEquals([('Sat', time(8, 30)), ('Sun', time(10, 10))], self.day_times())
+
+        response = self.client.put(self.url + '?days=Sat', [{'day': 'Sun', 'time': '08:30'}], format='json')
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_delete(self):
+        response = self.client.delete(self.url, [{'day': 'Sat', 'time': '08:10'}], format='json')
+        self.assertEquals({'created': 0, 'deleted': 1, 'schedule_version': 2}, to_json(response))
+        self.assertEquals([('Sat', time(9, 10))], self.day_times())
+
+    def test_invalid_rows_change_nothing(self):
+        response = self.client.post(self.url, [{'day': 'Sun', 'time': '10:10'}, {'day': 'Sun', 'time': 'malformed'}],
+                                    format='json')
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEquals([{}, {'time': mock.ANY}], to_json(response))
+        self.assertEquals(2, len(self.day_times()))
+
+    def test_nonexistent_station_gives_404(self):
+        url = reverse('station-times-bulk', kwargs={'station_id': self.station.id + 1})
+        response = self.client.post(url, [], format='json')
+        self.assertEquals(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_requires_permission(self):
+        self.client.logout()
+        response = self.client.post(self.url, [{'day': 'Sun', 'time': '10:10'}], format='json')
+        self.assertEquals(status.HTTP_403_FORBIDDEN, response.status_code)
+        self.assertEquals(2, len(self.day_times()))
+
+
 class LocationTimesTestCase(TestCase):
     line1_times = [time(17, 1), time(17, 11), time(17, 21), time(17, 31)]
     line2_times = [time(17, 6), time(17, 26), time(17, 46), time(18, 6)]
@@ -262,6 +352,545 @@ class LocationTimesTestCase(TestCase):
         self.assertEquals(self.line2_times[3:], to_times(to_json(response)))
 
 
+@override_settings(TRANSPO_TIMES_CACHE='times')
+class CachedStationTimesTestCase(StationTimesTestCase):
+    def setUp(self):
+        caches['times'].clear()
+        # the transaction of the test never commits, so invalidate as soon as the schedule changes
+        patcher = mock.patch('django.db.transaction.on_commit', lambda func, using=None: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(CachedStationTimesTestCase, self).setUp()
+
+    def test_second_request_is_a_hit_without_queries(self):
+        url = self.baseurl() + '?date=' + self.service_datestr
+        self.assertEquals('miss', self.client.get(url)['X-Times-Cache'])
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEquals('hit', response['X-Times-Cache'])
+        self.assertEquals(self.times, to_times(to_json(response)))
+
+    def test_same_day_and_minute_share_entry(self):
+        self.client.get(self.baseurl() + '?date=' + self.service_datestr + ' 18:00')
+        response = self.client.get(self.baseurl() + '?date=' + self.service_datestr + ' 18:00:30')
+        self.assertEquals('hit', response['X-Times-Cache'])
+
+    def test_registering_times_invalidates(self):
+        url = self.baseurl() + '?date=' + self.service_datestr
+        self.client.get(url)
+        self.station.register_daily_times([self.service_day], [time(19, 0)])
+        response = self.client.get(url)
+        self.assertEquals('miss', response['X-Times-Cache'])
+        self.assertEquals(self.times + [time(19, 0)], to_times(to_json(response)))
+
+    def test_invalidates_on_commit(self):
+        url = self.baseurl() + '?date=' + self.service_datestr
+        self.client.get(url)
+        with mock.patch('django.db.transaction.on_commit') as on_commit:
+            self.station.register_daily_times([self.service_day], [time(19, 0)])
+        self.assertEquals('hit', self.client.get(url)['X-Times-Cache'])
+        for call in on_commit.call_args_list:
+            call[0][0]()
+        self.assertEquals('miss', self.client.get(url)['X-Times-Cache'])
+
+    def test_deleting_times_invalidates(self):
+        url = self.baseurl() + '?date=' + self.service_datestr
+        self.client.get(url)
+        self.station.dailyschedule_set.filter(time=self.times[0]).delete()
+        self.assertEquals(self.times[1:], to_times(to_json(self.client.get(url))))
+
+    @override_settings(TRANSPO_SERVICE_CALENDAR=True)
+    def test_holiday_invalidates_and_has_own_entry(self):
+        next_service_date = self.service_date + timedelta(7)
+        url = self.baseurl() + '?date=' + next_service_date.strftime('%Y-%m-%d')
+        self.client.get(url)
+        models.CalendarException.objects.create(line=self.line, date=next_service_date.date())
+        response = self.client.get(url)
+        self.assertEquals('miss', response['X-Times-Cache'])
+        self.assertEquals([], to_json(response))
+        response = self.client.get(self.baseurl() + '?date=' + self.service_datestr)
+        self.assertEquals(self.times, to_times(to_json(response)))
+
+    def test_counts_hits_and_misses(self):
+        stats = dict(cache.stats)
+        url = self.baseurl()
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEquals(stats.get('hits', 0) + 1, cache.stats['hits'])
+        self.assertEquals(stats.get('misses', 0) + 1, cache.stats['misses'])
+
+
+@override_settings(TRANSPO_TIMES_CACHE='times')
+class CachedLocationTimesTestCase(LocationTimesTestCase):
+    def setUp(self):
+        caches['times'].clear()
+        # the transaction of the test never commits, so invalidate as soon as the schedule changes
+        patcher = mock.patch('django.db.transaction.on_commit', lambda func, using=None: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(CachedLocationTimesTestCase, self).setUp()
+
+    def test_registering_station_times_invalidates(self):
+        url = self.baseurl() + '?date=' + self.service_datestr
+        self.client.get(url)
+        self.station2.register_daily_times([self.service_day], [time(19, 0)])
+        response = self.client.get(url)
+        self.assertEquals('miss', response['X-Times-Cache'])
+        self.assertEquals(time(19, 0), to_times(to_json(response))[-1])
+
+    def test_removing_station_invalidates(self):
+        url = self.baseurl() + '?date=' + self.service_datestr
+        self.client.get(url)
+        self.location.stations.remove(self.station2)
+        self.assertEquals(self.line1_times, to_times(to_json(self.client.get(url))))
+
+    def test_adding_location_from_station_invalidates(self):
+        url = self.baseurl() + '?date=' + self.service_datestr
+        self.location.stations.remove(self.station2)
+        self.client.get(url)
+        self.station2.location_set.add(self.location)
+        self.assertEquals(sorted(self.line1_times + self.line2_times), to_times(to_json(self.client.get(url))))
+
+
+class StationsTimesTestCase(TestCase):
+    times1 = [time(17, 1), time(17, 11), time(17, 21)]
+    times2 = [time(17, 6), time(17, 26)]
+
+    def setUp(self):
+        line = models.Line.objects.create(name='R5')
+        self.station1 = models.Station.objects.create(name='Saint-Germain-en-Laye', line=line)
+        self.station1.register_daily_times([models.DailySchedule.MONDAY], self.times1)
+        self.station1.register_daily_times([models.DailySchedule.WEEKDAYS], [time(8, 0)])
+        self.station2 = models.Station.objects.create(name='Nanterre', line=line)
+        self.station2.register_daily_times([models.DailySchedule.DAILY], self.times2)
+        self.station3 = models.Station.objects.create(name='Auber', line=line)
+
+    def url(self, *station_ids):
+        return reverse('station-times') + '?ids=' + ','.join(str(station_id) for station_id in station_ids)
+
+    def test_times_by_station(self):
+        url = self.url(self.station1.id, self.station2.id, self.station3.id) + '&date=2016-01-11'
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+
+        results = to_json(response)
+        self.assertEquals(self.times1, to_times(results[str(self.station1.id)]))
+        self.assertEquals(self.times2, to_times(results[str(self.station2.id)]))
+        self.assertEquals([], results[str(self.station3.id)])
+
+    def test_times_with_limit(self):
+        url = self.url(self.station1.id, self.station2.id) + '&date=2016-01-11 17:05&limit=1'
+        results = to_json(self.client.get(url))
+        self.assertEquals([time(17, 11)], to_times(results[str(self.station1.id)]))
+        self.assertEquals([time(17, 6)], to_times(results[str(self.station2.id)]))
+
+    def test_times_with_limit_roll_over_midnight(self):
+        url = self.url(self.station1.id, self.station2.id) + '&date=2016-01-11 17:15&limit=3'
+        results = to_json(self.client.get(url))
+        self.assertEquals([time(17, 21), time(8, 0), time(8, 0)], to_times(results[str(self.station1.id)]))
+        self.assertEquals(['2016-01-11', '2016-01-12', '2016-01-13'],
+                          [row['service_date'] for row in results[str(self.station1.id)]])
+        self.assertEquals([time(17, 26), time(17, 6), time(17, 26)], to_times(results[str(self.station2.id)]))
+
+    def test_compact_times(self):
+        url = self.url(self.station2.id) + '&date=2016-01-11&compact=1'
+        results = to_json(self.client.get(url))
+        self.assertEquals({'day', 'id', 'time'}, set(results[str(self.station2.id)][0]))
+
+    def test_nonexistent_stations_omitted(self):
+        results = to_json(self.client.get(self.url(self.station2.id, 123) + '&date=2016-01-11'))
+        self.assertEquals([str(self.station2.id)], list(results))
+
+    def test_invalid_ids(self):
+        response = self.client.get(reverse('station-times') + '?ids=1,x')
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEquals({'ids': ['Enter a comma separated list of station ids.']}, to_json(response))
+
+    def test_missing_ids(self):
+        response = self.client.get(reverse('station-times'))
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    @override_settings(TRANSPO_BATCH_MAX_STATIONS=2)
+    def test_too_many_ids(self):
+        response = self.client.get(self.url(1, 2, 3))
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEquals({'ids': ['Ensure at most 2 station ids are given.']}, to_json(response))
+
+    @override_settings(TRANSPO_TIMETABLE_INDEX=True)
+    def test_times_from_timetable_index(self):
+        url = self.url(self.station1.id, self.station2.id) + '&date=2016-01-11 17:05&limit=2'
+        results = to_json(self.client.get(url))
+        self.assertEquals(self.times1[1:], to_times(results[str(self.station1.id)]))
+        self.assertEquals(self.times2, to_times(results[str(self.station2.id)]))
+
+
+class CompactTimesTestCase(TestCase):
+    def setUp(self):
+        self.line = models.Line.objects.create(name='R5')
+        self.station = models.Station.objects.create(name='Saint-Germain-en-Laye', line=self.line)
+        self.station.register_daily_times([models.DailySchedule.MONDAY], [time(17, 6), time(17, 26)])
+
+        self.location = models.Location.objects.create(user=User.objects.create(), name='Work')
+        self.location.stations.add(self.station)
+
+    def test_station_times(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station.id})
+        with self.assertNumQueries(4):
+            response = self.client.get(url + '?date=2016-01-11 17:10&compact=true')
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+
+        schedule = self.station.dailyschedule_set.get(time=time(17, 26))
+        expected = {
+            'station': TESTSERVER_URL + reverse('station-detail', kwargs={'pk': self.station.id}),
+            'line': TESTSERVER_URL + reverse('line-detail', kwargs={'pk': self.line.id}),
+            'times': [
+                {'id': schedule.id, 'day': models.DailySchedule.MONDAY, 'time': '17:26:00'},
+            ],
+        }
+        self.assertEquals(expected, to_json(response))
+
+    def test_location_times(self):
+        url = reverse('location-times-list', kwargs={'location_id': self.location.id})
+        response = self.client.get(url + '?date=2016-01-11&compact=1')
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+
+        results = to_json(response)
+        self.assertEquals(TESTSERVER_URL + reverse('location-detail', kwargs={'pk': self.location.id}),
+                          results['location'])
+        expected_station = {
+            'url': TESTSERVER_URL + reverse('station-detail', kwargs={'pk': self.station.id}),
+            'line': TESTSERVER_URL + reverse('line-detail', kwargs={'pk': self.line.id}),
+        }
+        self.assertEquals({str(self.station.id): expected_station}, results['stations'])
+        self.assertEquals([time(17, 6), time(17, 26)], to_times(results['times']))
+        self.assertEquals({self.station.id}, {row['station'] for row in results['times']})
+
+    @override_settings(TRANSPO_TIMETABLE_INDEX=True)
+    def test_location_times_from_timetable_index(self):
+        url = reverse('location-times-list', kwargs={'location_id': self.location.id})
+        response = self.client.get(url + '?date=2016-01-11&compact=1')
+        self.assertEquals([time(17, 6), time(17, 26)], to_times(to_json(response)['times']))
+
+
+class CursorPaginationTestCase(TestCase):
+    line1_times = [time(17, 1), time(17, 11), time(17, 21), time(17, 31)]
+    line2_times = [time(17, 6), time(17, 11), time(17, 46)]
+
+    def setUp(self):
+        line = models.Line.objects.create(name='R5')
+        self.station1 = models.Station.objects.create(name='Saint-Germain-en-Laye', line=line)
+        self.station1.register_daily_times([models.DailySchedule.MONDAY], self.line1_times)
+        self.station2 = models.Station.objects.create(name='Nanterre', line=line)
+        self.station2.register_daily_times([models.DailySchedule.WEEKDAYS], self.line2_times)
+
+        self.location = models.Location.objects.create(user=User.objects.create(), name='Work')
+        self.location.stations.add(self.station1, self.station2)
+
+    def get_all_pages(self, url):
+        times = []
+        pages = 0
+        while url:
+            results = to_json(self.client.get(url))
+            times += to_times(results['results'])
+            url = results['next']
+            pages += 1
+        return times, pages
+
+    def test_station_pages(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station1.id}) + '?date=2016-01-11&page_size=3'
+        self.assertEquals((self.line1_times, 2), self.get_all_pages(url))
+
+    def test_station_exact_pages(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station1.id}) + '?date=2016-01-11&page_size=2'
+        self.assertEquals((self.line1_times, 2), self.get_all_pages(url))
+
+    def test_location_pages_with_same_times(self):
+        url = reverse('location-times-list', kwargs={'location_id': self.location.id}) + '?date=2016-01-11&page_size=2'
+        self.assertEquals((sorted(self.line1_times + self.line2_times), 4), self.get_all_pages(url))
+
+    def test_compact_location_pages(self):
+        url = reverse('location-times-list', kwargs={'location_id': self.location.id})
+        url += '?date=2016-01-11&page_size=3&compact=1'
+        self.assertEquals((sorted(self.line1_times + self.line2_times), 3), self.get_all_pages(url))
+
+    @override_settings(TRANSPO_TIMETABLE_INDEX=False)
+    def test_page_pushes_cursor_into_query(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station1.id}) + '?date=2016-01-11&page_size=2'
+        next_url = to_json(self.client.get(url))['next']
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(next_url)
+        times_sql = [query['sql'] for query in context.captured_queries if 'LIMIT 3' in query['sql']]
+        self.assertEquals(1, len(times_sql))
+        self.assertIn('"lines_dailyschedule"."time" > ', times_sql[0])
+
+    def test_invalid_cursor_gives_404(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station1.id}) + '?cursor=malformed'
+        self.assertEquals(status.HTTP_404_NOT_FOUND, self.client.get(url).status_code)
+
+
+class StationDatesTestCase(TestCase):
+    def setUp(self):
+        line = models.Line.objects.create(name='TGV 6911')
+        self.station = models.Station.objects.create(name='Paris-Gare-de-Lyon', line=line)
+        start = datetime(2016, 1, 19, 9, 41, tzinfo=timezone.utc)
+        self.dates = [start + timedelta(days) for days in range(5)]
+        self.station.register_dates(self.dates)
+
+    def url(self, station_id=None):
+        return reverse('station-dates-list', kwargs={'station_id': station_id or self.station.id})
+
+    def get_all_pages(self, url):
+        dates = []
+        while url:
+            results = to_json(self.client.get(url))
+            dates += [row['date'] for row in results['results']]
+            url = results['next']
+        return dates
+
+    def test_dates_in_range(self):
+        response = self.client.get(self.url() + '?from=2016-01-20&to=2016-01-22 09:41')
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+        results = to_json(response)
+        self.assertEquals(None, results['next'])
+        self.assertEquals(['2016-01-20T09:41:00Z', '2016-01-21T09:41:00Z'], [row['date'] for row in results['results']])
+
+    def test_dates_in_pages(self):
+        expected = [date.strftime('%Y-%m-%dT%H:%M:%SZ') for date in self.dates]
+        self.assertEquals(expected, self.get_all_pages(self.url() + '?page_size=2'))
+
+    def test_invalid_range(self):
+        response = self.client.get(self.url() + '?from=malformed')
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEquals({'from': ['Enter a valid date/time.']}, to_json(response))
+
+    def test_nonexistent_station_gives_404(self):
+        self.assertEquals(status.HTTP_404_NOT_FOUND, self.client.get(self.url(self.station.id + 1)).status_code)
+
+
+@override_settings(TRANSPO_TIMETABLE_INDEX=True)
+class TimetableIndexCursorPaginationTestCase(CursorPaginationTestCase):
+    pass
+
+
+class ConditionalGetTestCase(TestCase):
+    # queries to answer a conditional request of times with 304
+    times_not_modified_queries = 1
+
+    def setUp(self):
+        self.line = models.Line.objects.create(name='R5')
+        self.station = models.Station.objects.create(name='Saint-Germain-en-Laye', line=self.line)
+        self.station.register_daily_times([models.DailySchedule.MONDAY], [time(17, 6), time(17, 26)])
+
+        self.location = models.Location.objects.create(user=User.objects.create(), name='Work')
+        self.location.stations.add(self.station)
+
+    def get(self, url, etag=None):
+        if etag is None:
+            return self.client.get(url)
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def assertNotModified(self, url, queries=1):
+        etag = self.get(url)['ETag']
+        with self.assertNumQueries(queries):
+            response = self.get(url, etag)
+        self.assertEquals(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEquals(etag, response['ETag'])
+        return etag
+
+    def test_station_times_not_modified(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station.id}) + '?date=2016-01-11'
+        self.assertNotModified(url, self.times_not_modified_queries)
+
+    def test_station_times_modified_by_schedule_change(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station.id}) + '?date=2016-01-11'
+        etag = self.assertNotModified(url, self.times_not_modified_queries)
+        self.station.register_daily_times([models.DailySchedule.MONDAY], [time(19, 0)])
+        response = self.get(url, etag)
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+        self.assertEquals(3, len(to_json(response)))
+
+    def test_station_times_modified_by_time(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station.id})
+        etag = self.get(url + '?date=2016-01-11 17:00')['ETag']
+        self.assertNotEqual(etag, self.get(url + '?date=2016-01-11 17:10')['ETag'])
+
+    def test_nonexistent_station_times_gives_404(self):
+        url = reverse('station-times-list', kwargs={'station_id': self.station.id + 1})
+        self.assertEquals(status.HTTP_404_NOT_FOUND, self.get(url, '"anything"').status_code)
+
+    def test_location_times_not_modified(self):
+        url = reverse('location-times-list', kwargs={'location_id': self.location.id})
+        self.assertNotModified(url, self.times_not_modified_queries)
+
+    def test_location_times_modified_by_stations_change(self):
+        url = reverse('location-times-list', kwargs={'location_id': self.location.id})
+        etag = self.assertNotModified(url, self.times_not_modified_queries)
+        self.location.stations.remove(self.station)
+        response = self.get(url, etag)
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+        self.assertEquals([], to_json(response))
+
+    def test_station_not_modified(self):
+        self.assertNotModified(reverse('station-detail', kwargs={'pk': self.station.id}))
+        self.assertNotModified(reverse('station-list'))
+
+    def test_station_modified_by_rename(self):
+        url = reverse('station-detail', kwargs={'pk': self.station.id})
+        etag = self.get(url)['ETag']
+        models.Station.objects.filter(pk=self.station.id).update(name='Jaures')
+        self.assertEquals(status.HTTP_200_OK, self.get(url, etag).status_code)
+
+    def test_line_not_modified(self):
+        self.assertNotModified(reverse('line-detail', kwargs={'pk': self.line.id}))
+        self.assertNotModified(reverse('line-list'))
+
+
+@override_settings(TRANSPO_TIMES_CACHE='times')
+class CachedConditionalGetTestCase(ConditionalGetTestCase):
+    times_not_modified_queries = 0
+
+    def setUp(self):
+        caches['times'].clear()
+        # the transaction of the test never commits, so invalidate as soon as the schedule changes
+        patcher = mock.patch('django.db.transaction.on_commit', lambda func, using=None: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(CachedConditionalGetTestCase, self).setUp()
+
+
+@override_settings(TRANSPO_SQL_INSTRUMENTATION=True, TRANSPO_SQL_QUERY_BUDGET=100, TRANSPO_SQL_LATENCY_BUDGET=None)
+class SQLInstrumentationTestCase(TestCase):
+    def setUp(self):
+        line = models.Line.objects.create(name='R5')
+        self.station = models.Station.objects.create(name='Saint-Germain-en-Laye', line=line)
+        self.station.register_daily_times([models.DailySchedule.MONDAY], [time(17, 6), time(17, 26)])
+        self.url = reverse('station-times-list', kwargs={'station_id': self.station.id}) + '?date=2016-01-11'
+
+    def test_server_timing_counts_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="{} queries", total;dur='.format(len(context)), response['Server-Timing'])
+
+    def test_restores_cursors(self):
+        self.client.get(self.url)
+        self.assertFalse(connection.force_debug_cursor)
+        self.assertNotIn('make_debug_cursor', connection.__dict__)
+
+    @override_settings(TRANSPO_SQL_QUERY_BUDGET=0)
+    def test_logs_statements_over_budget(self):
+        with self.assertLogs('api.middleware', 'WARNING') as logs:
+            self.client.get(self.url)
+        self.assertIn('GET ' + self.url + ' 200: ', logs.output[0])
+        self.assertIn('1 x ', logs.output[0])
+        self.assertIn('FROM "lines_dailyschedule"', logs.output[0])
+
+    @override_settings(TRANSPO_SQL_INSTRUMENTATION=False)
+    def test_disabled(self):
+        self.assertFalse(self.client.get(self.url).has_header('Server-Timing'))
+
+    def test_normalize_sql_groups_parameter_lists(self):
+        self.assertEquals(middleware.normalize_sql('SELECT a FROM t WHERE id IN (%s)'),
+                          middleware.normalize_sql('SELECT a FROM t WHERE id IN (%s, %s,\n %s)'))
+
+
+@override_settings(TRANSPO_PROFILING=True, TRANSPO_PROFILING_SECRET='s3cret')
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        line = models.Line.objects.create(name='R5')
+        self.station = models.Station.objects.create(name='Saint-Germain-en-Laye', line=line)
+        self.location = models.Location.objects.create(user=User.objects.create(username='user'), name='Work')
+        self.location.stations.add(self.station)
+        self.url = reverse('location-times-list', kwargs={'location_id': self.location.id}) + '?date=2016-01-11'
+
+    def test_summary_with_secret(self):
+        response = self.client.get(self.url + '&profile=1', HTTP_X_PROFILE_SECRET='s3cret')
+        self.assertEquals('text/plain', response['Content-Type'])
+        self.assertIn(b'function calls', response.content)
+        self.assertIn(b'next_daily_times', response.content)
+
+    def test_summary_for_staff(self):
+        User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.login(username='staff', password='secret')
+        response = self.client.get(self.url, HTTP_X_PROFILE='summary')
+        self.assertIn(b'function calls', response.content)
+
+    def test_not_profiled_without_permission(self):
+        response = self.client.get(self.url + '&profile=1', HTTP_X_PROFILE_SECRET='wrong')
+        self.assertEquals([], to_json(response))
+
+    def test_writes_profile_to_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with self.settings(TRANSPO_PROFILING_DIR=directory):
+            response = self.client.get(self.url + '&profile=file', HTTP_X_PROFILE_SECRET='s3cret')
+        self.assertEquals([], to_json(response))
+        self.assertEquals([response['X-Profile-File']], os.listdir(directory))
+
+    @override_settings(TRANSPO_PROFILING=False)
+    def test_disabled(self):
+        response = self.client.get(self.url + '&profile=1', HTTP_X_PROFILE_SECRET='s3cret')
+        self.assertEquals([], to_json(response))
+
+
+class ProfileCommandTestCase(TestCase):
+    def test_prints_summary(self):
+        models.Line.objects.create(name='R5')
+        out, err = StringIO(), StringIO()
+        call_command('profile', 'lines', '--list', stdout=out, stderr=err)
+        self.assertEquals('R5\n', out.getvalue())
+        self.assertIn('function calls', err.getvalue())
+        self.assertIn('handle', err.getvalue())
+
+    def test_writes_profile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        call_command('profile', 'lines', output=directory, stdout=StringIO(), stderr=StringIO())
+        self.assertEquals(1, len([name for name in os.listdir(directory) if name.endswith('-lines.prof')]))
+
+
+class LRULocMemCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = cache.LRULocMemCache('lru-test', {'OPTIONS': {'MAX_ENTRIES': 3, 'CULL_FREQUENCY': 3}})
+        self.cache.clear()
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.set('c', 3)
+        self.cache.get('a')
+        self.cache.set('d', 4)
+        self.assertEquals({'a': 1, 'c': 3, 'd': 4}, self.cache.get_many(['a', 'b', 'c', 'd']))
+
+    def test_evicts_expired_first(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, 0)
+        self.cache.set('c', 3)
+        self.cache.set('d', 4)
+        self.assertEquals({'a': 1, 'c': 3, 'd': 4}, self.cache.get_many(['a', 'b', 'c', 'd']))
+
+    def test_get_without_lock(self):
+        self.cache.set('a', [1])
+        with mock.patch.object(self.cache, '_lock') as lock:
+            self.assertEquals([1], self.cache.get('a'))
+            self.assertIsNone(self.cache.get('b'))
+        self.assertFalse(lock.__enter__.called)
+
+    def test_shared_by_instances_of_name(self):
+        self.cache.set('a', 1)
+        self.assertTrue(cache.LRULocMemCache('lru-test', {}).has_key('a'))
+        self.assertIsNone(cache.LRULocMemCache('lru-other', {}).get('a'))
+
+    def test_add_and_incr(self):
+        self.assertTrue(self.cache.add('a', 1))
+        self.assertFalse(self.cache.add('a', 2))
+        self.assertEquals(3, self.cache.incr('a', 2))
+        self.cache.delete('a')
+        with self.assertRaises(ValueError):
+            self.cache.incr('a')
+
+
 class LineTestCase(APITestCase):
     def test_no_lines(self):
         url = reverse('line-list')
@@ -288,6 +917,273 @@ class LineTestCase(APITestCase):
         self.assertEquals(expected, results)
 
 
+class JourneysTestCase(APITestCase):
+    def setUp(self):
+        journeys.invalidate()
+        self.line1 = models.Line.objects.create(name='line1')
+        self.line2 = models.Line.objects.create(name='line2')
+        self.a = models.Station.objects.create(line=self.line1, name='A')
+        self.b = models.Station.objects.create(line=self.line1, name='B')
+        self.b2 = models.Station.objects.create(line=self.line2, name='B')
+        self.c = models.Station.objects.create(line=self.line2, name='C')
+        self.first = self.line1.register_trip(models.DailySchedule.WEEKDAYS, [
+            (self.a, time(8, 0)), (self.b, time(8, 10))])
+        self.second = self.line2.register_trip(models.DailySchedule.WEEKDAYS, [
+            (self.b2, time(8, 20)), (self.c, time(8, 30))])
+
+    def _get(self, **params):
+        return self.client.get(reverse('journeys-list'), params)
+
+    def _station_url(self, station):
+        return TESTSERVER_URL + reverse('station-detail', kwargs={'pk': station.id})
+
+    def test_journey_with_transfer(self):
+        response = self._get(**{'from': self.a.id, 'to': self.c.id, 'date': '2016-01-11 07:00'})
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+        data = json.loads(response.content.decode())
+        self.assertEquals([self.first.id, self.second.id], [leg['trip'] for leg in data['legs']])
+        self.assertEquals([self._station_url(self.a), self._station_url(self.b2)],
+                          [leg['from'] for leg in data['legs']])
+        self.assertEquals(TESTSERVER_URL + reverse('line-detail', kwargs={'pk': self.line2.id}),
+                          data['legs'][1]['line'])
+        self.assertEquals(data['legs'][0]['departure'], data['departure'])
+        self.assertTrue(data['arrival'].startswith('2016-01-11T08:30:00'))
+
+    def test_no_journey(self):
+        response = self._get(**{'from': self.a.id, 'to': self.c.id, 'date': '2016-01-11 09:00'})
+        self.assertEquals(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_unknown_station(self):
+        response = self._get(**{'from': self.a.id, 'to': self.c.id + 1})
+        self.assertEquals(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_missing_station(self):
+        response = self._get(to=self.c.id)
+        self.assertEquals(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+
+def parse_event(message):
+    lines = dict(line.split(': ', 1) for line in message.decode().strip().split('\n'))
+    return lines['event'], json.loads(lines['data'])
+
+
+class InlineExecutor(Executor):
+    """
+    Runs the calls of the application in the thread of the test, which holds its transaction
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+@override_settings(TRANSPO_TIMETABLE_INDEX=True)
+class ASGITestCase(LocationTimesTestCase):
+    def setUp(self):
+        super(ASGITestCase, self).setUp()
+        # as the test client does, keep the connection of the test open
+        for signal in (signals.request_started, signals.request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        timetable.invalidate()
+        self.addCleanup(timetable.invalidate)
+        self.application = asgi.TimesApplication(get_wsgi_application(), executor=InlineExecutor())
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def call(self, scope, messages):
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.application(scope, receive, send))
+        return sent
+
+    def get(self, url, query=''):
+        scope = {'type': 'http', 'method': 'GET', 'path': url, 'query_string': query.encode(), 'scheme': 'http',
+                 'server': ('testserver', 80), 'headers': [(b'host', b'testserver')]}
+        start, body = self.call(scope, [{'type': 'http.request', 'body': b''}])
+        return start['status'], body['body']
+
+    def assertSameAsWSGI(self, url, query):
+        status_code, content = self.get(url, query)
+        response = self.client.get(url + '?' + query)
+        self.assertEquals((response.status_code, to_json(response)), (status_code, json.loads(content.decode())))
+
+    def test_station_times(self):
+        self.assertSameAsWSGI(reverse('station-times-list', kwargs={'station_id': self.station1.id}),
+                              'date=2016-01-11 17:05&compact=true&limit=6')
+
+    def test_location_times(self):
+        self.assertSameAsWSGI(self.baseurl(), 'date=2016-01-11 17:05&compact=true&limit=6')
+
+    def test_times_from_preloaded_timetable(self):
+        self.call({'type': 'lifespan'}, [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        self.assertIsNotNone(timetable.snapshot([self.station1.id, self.station2.id]))
+        # only the location and its stations are queried
+        with self.assertNumQueries(2):
+            status_code, content = self.get(self.baseurl(), 'date=2016-01-11 17:05&compact=true&limit=3')
+        self.assertEquals(200, status_code)
+        self.assertEquals([time(17, 6), time(17, 11), time(17, 21)], to_times(json.loads(content.decode())['times']))
+
+    def test_indexed_next_times_from_one_snapshot(self):
+        station_ids = [self.station1.id, self.station2.id]
+        date = datetime(2016, 1, 11, 23, 30)
+        self.assertIsNone(asgi.indexed_next_times(station_ids, date, 4))
+        timetable.preload()
+        with self.assertNumQueries(0):
+            times = asgi.indexed_next_times(station_ids, date, 4)
+        self.assertEquals(asgi.next_times(station_ids, date, 4), times)
+        timetable.invalidate([self.station1.id])
+        self.assertIsNone(asgi.indexed_next_times(station_ids, date, 4))
+
+    def test_other_requests_use_wsgi(self):
+        self.assertSameAsWSGI(self.baseurl(), 'date=2016-01-11 17:05')
+        self.assertSameAsWSGI(self.baseurl(), 'date=2016-01-11 17:05&compact=true&limit=0')
+        self.assertSameAsWSGI(reverse('station-list'), '')
+
+    def test_nonexistent_location_gives_404(self):
+        status_code, content = self.get(self.baseurl(123), 'date=2016-01-11&compact=true&limit=3')
+        self.assertEquals((404, {'detail': 'Not found.'}), (status_code, json.loads(content.decode())))
+
+    def stream(self, location_id, query, scenario):
+        """
+        Run a scenario of the events of the stream of departures of a location, and disconnect
+
+        :param scenario: coroutine function called with a coroutine function returning the next event
+        :return: the start of the response
+        """
+        incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+        incoming.put_nowait({'type': 'http.request', 'body': b''})
+        scope = {'type': 'http', 'method': 'GET', 'path': reverse('location-times-stream', kwargs={
+            'location_id': location_id}), 'query_string': query.encode(), 'scheme': 'http',
+            'server': ('testserver', 80), 'headers': [(b'host', b'testserver')]}
+
+        async def next_event():
+            message = await asyncio.wait_for(outgoing.get(), 5)
+            return parse_event(message['body'])
+
+        async def run():
+            task = asyncio.ensure_future(self.application(scope, incoming.get, outgoing.put))
+            start = await asyncio.wait_for(outgoing.get(), 5)
+            if start['status'] == 200:
+                await scenario(next_event)
+                incoming.put_nowait({'type': 'http.disconnect'})
+            await asyncio.wait_for(task, 5)
+            # the boards stop once their last stream is gone
+            pending = [t for t in asyncio.Task.all_tasks() if t is not asyncio.Task.current_task()]
+            if pending:
+                await asyncio.wait(pending, timeout=5)
+            return start
+
+        return self.loop.run_until_complete(run())
+
+    @mock.patch('django.utils.timezone.now', return_value=timezone.make_aware(datetime(2016, 1, 11, 17, 5)))
+    def test_stream_sends_departures_then_changes(self, now):
+        async def scenario(next_event):
+            name, data = await next_event()
+            self.assertEquals('departures', name)
+            self.assertEquals(TESTSERVER_URL + reverse('location-detail', kwargs={'pk': self.location.id}),
+                              data['location'])
+            self.assertEquals([time(17, 6), time(17, 11), time(17, 21)], to_times(data['times']))
+            self.assertEquals(1, len(self.application.boards))
+            first, last = [{'id': row['id'], 'date': row['date']} for row in (data['times'][0], data['times'][2])]
+
+            self.station1.register_daily_times([self.service_day], [time(17, 8)])
+            # the test transaction is never committed, so wake the board as on commit
+            self.application.schedule_changed([self.station1.id])
+            name, data = await next_event()
+            self.assertEquals('changes', name)
+            self.assertEquals([last], data['removed'])
+            self.assertEquals([time(17, 8)], to_times(data['added']))
+
+            now.return_value = timezone.make_aware(datetime(2016, 1, 11, 17, 7))
+            list(self.application.boards.values())[0].changed.set()
+            name, data = await next_event()
+            self.assertEquals('changes', name)
+            self.assertEquals([first], data['removed'])
+            self.assertEquals([time(17, 21)], to_times(data['added']))
+
+        start = self.stream(self.location.id, 'limit=3', scenario)
+        self.assertEquals(200, start['status'])
+        self.assertIn((b'content-type', b'text/event-stream; charset=utf-8'),
+                      [(name.lower(), value) for name, value in start['headers']])
+        self.assertEquals({}, self.application.boards)
+
+    @mock.patch('django.utils.timezone.now', return_value=timezone.make_aware(datetime(2016, 1, 11, 17, 5)))
+    def test_streams_share_board(self, now):
+        async def scenario(next_event):
+            await next_event()
+            board = list(self.application.boards.values())[0]
+            queue = asyncio.Queue()
+            # the departures are sent to another stream without being looked up again
+            with self.assertNumQueries(0):
+                self.application.subscribe(self.location.id, 3, queue, OrderedDict())
+            name, data = parse_event(queue.get_nowait())
+            self.assertEquals([time(17, 6), time(17, 11), time(17, 21)], to_times(data['times']))
+            board.unsubscribe(queue)
+
+        self.stream(self.location.id, 'limit=3', scenario)
+
+    @override_settings(TRANSPO_BOARD_CHECK_SECONDS=0)
+    @mock.patch('django.utils.timezone.now', return_value=timezone.make_aware(datetime(2016, 1, 11, 17, 5)))
+    def test_board_retries_failed_refresh(self, now):
+        async def scenario(next_event):
+            name, data = await next_event()
+            self.assertEquals('departures', name)
+            self.assertEquals([time(17, 6), time(17, 11), time(17, 21)], to_times(data['times']))
+
+        versions = asgi.location_versions(self.location.id)
+        with mock.patch('api.asgi.location_versions', side_effect=[RuntimeError('database is down'), versions]), \
+                self.assertLogs('api.asgi', 'ERROR') as logs:
+            self.stream(self.location.id, 'limit=3', scenario)
+        self.assertEquals(1, len(logs.records))
+        self.assertEquals({}, self.application.boards)
+
+    @mock.patch('django.utils.timezone.now', return_value=timezone.make_aware(datetime(2016, 1, 11, 17, 5)))
+    def test_shutdown_ends_streams(self, now):
+        async def scenario(next_event):
+            await next_event()
+            messages = [{'type': 'lifespan.shutdown'}]
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                pass
+
+            await self.application({'type': 'lifespan'}, receive, send)
+            self.assertEquals({}, self.application.boards)
+
+        start = self.stream(self.location.id, 'limit=3', scenario)
+        self.assertEquals(200, start['status'])
+
+    def test_stream_of_nonexistent_location_gives_404(self):
+        start = self.stream(123, 'limit=3', None)
+        self.assertEquals(404, start['status'])
+
+    @mock.patch('django.utils.timezone.now', return_value=timezone.make_aware(datetime(2016, 1, 11, 17, 5)))
+    def test_wsgi_stream_sends_departures_once(self, now):
+        response = self.client.get(reverse('location-times-stream', kwargs={'location_id': self.location.id}),
+                                   {'limit': 3})
+        self.assertEquals(status.HTTP_200_OK, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/event-stream'))
+        content = response.content.decode()
+        self.assertTrue(content.startswith('retry: '))
+        name, data = parse_event(content.split('\n', 1)[1].encode())
+        self.assertEquals('departures', name)
+        self.assertEquals([time(17, 6), time(17, 11), time(17, 21)], to_times(data['times']))
+
+
 class StationTimesFormTestCase(TestCase):
     def test_valid_parameterless(self):
         form = views.StationTimesForm({})
@@ -6,9 +6,11 @@ router = routers.DefaultRouter()
 router.register(r'lines', views.LineViewSet)
 router.register(r'stations', views.StationViewSet)
 router.register(r'stations/(?P<station_id>[^/.]+)/times', views.StationTimesViewSet, base_name='station-times')
+router.register(r'stations/(?P<station_id>[^/.]+)/dates', views.StationDatesViewSet, base_name='station-dates')
 router.register(r'locations', views.LocationViewSet)
 router.register(r'locations/(?P<location_id>[^/.]+)/times', views.LocationTimesViewSet, base_name='location-times')
 router.register(r'dailyschedule', views.DailyScheduleViewSet)
+router.register(r'journeys', views.JourneysViewSet, base_name='journeys')
 
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browsable API.
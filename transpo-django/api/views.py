@@ -1,20 +1,107 @@
+import hashlib
+from collections import OrderedDict
+
 from django import forms
+from django.conf import settings
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from rest_framework import viewsets, status
-from lines import models
-from api import serializers
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from rest_framework import renderers, viewsets, status
+from rest_framework.decorators import list_route
+from lines import journeys, models
+from api import cache, pagination, serializers
 from rest_framework.response import Response
 
 
-class StationViewSet(viewsets.ModelViewSet):
+def board_limit():
+    return getattr(settings, 'TRANSPO_BOARD_LIMIT', 10)
+
+
+def board_check_seconds():
+    return getattr(settings, 'TRANSPO_BOARD_CHECK_SECONDS', 30)
+
+
+def etag_for(request, *values):
+    """
+    Return an ETag for the response to a request, from values that change whenever the response changes
+    """
+    variant = (request.build_absolute_uri(), request.accepted_renderer.format, values)
+    return hashlib.md5(repr(variant).encode()).hexdigest()
+
+
+def conditional_response(request, etag, get_response):
+    """
+    Return 304 Not Modified if the ETag matches If-None-Match, or else the response with the ETag
+    """
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = get_response()
+    if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        response['ETag'] = quote_etag(etag)
+    return response
+
+
+class ConditionalViewSetMixin(object):
+    """
+    Answer conditional GET requests of lists and details with 304 Not Modified,
+    using an ETag computed from the fields in etag_fields, without serializing anything
+    """
+    etag_fields = ()
+
+    def list(self, request, *args, **kwargs):
+        values = list(self.get_queryset().order_by('pk').values_list(*self.etag_fields))
+        return conditional_response(request, etag_for(request, values),
+                                    lambda: super(ConditionalViewSetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        values = list(self.get_queryset().filter(pk=kwargs['pk']).values_list(*self.etag_fields))
+        if not values:
+            raise Http404
+        return conditional_response(request, etag_for(request, values),
+                                    lambda: super(ConditionalViewSetMixin, self).retrieve(request, *args, **kwargs))
+
+
+class StationViewSet(ConditionalViewSetMixin, viewsets.ModelViewSet):
     queryset = models.Station.objects.all()
     serializer_class = serializers.StationSerializer
+    etag_fields = ('id', 'name', 'line_id', 'schedule_version')
+
+    @list_route(url_path='times')
+    def times(self, request):
+        """
+        Next times of many stations at once, by station id
+        """
+        form = StationsTimesForm(request.GET)
+        if not form.is_valid():
+            return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        date = form.parse_date() or timezone.now()
+        # with their line, named in the links of the times
+        stations = models.Station.objects.select_related('line').in_bulk(form.cleaned_data['ids'])
+        station_ids = [station_id for station_id in form.cleaned_data['ids'] if station_id in stations]
+        limit = form.cleaned_data['limit']
+        times = models.Station.next_daily_times_by_station(station_ids, date, limit)
+        serializer_class = serializers.DailyScheduleSerializer if limit is None else serializers.DepartureSerializer
+
+        data = OrderedDict()
+        for station_id in station_ids:
+            if form.cleaned_data['compact']:
+                data[str(station_id)] = serializers.compact_times(serializers.compact_rows(times[station_id]))
+            else:
+                for schedule in times[station_id]:
+                    schedule.station = stations[station_id]
+                serializer = serializer_class(times[station_id], many=True, context=self.get_serializer_context())
+                data[str(station_id)] = serializer.data
+        return Response(data)
 
 
 class StationTimesForm(forms.Form):
     date = forms.DateTimeField(required=False)
     time = forms.TimeField(required=False)
+    compact = forms.BooleanField(required=False)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=1000)
 
     def parse_date(self):
         if self.cleaned_data['date'] is not None:
@@ -32,31 +119,213 @@ class StationTimesForm(forms.Form):
         return date
 
 
-class StationTimesViewSet(viewsets.ModelViewSet):
+class StationsTimesForm(StationTimesForm):
+    ids = forms.CharField()
+
+    def clean_ids(self):
+        try:
+            ids = [int(value) for value in self.cleaned_data['ids'].split(',') if value.strip()]
+        except ValueError:
+            raise forms.ValidationError('Enter a comma separated list of station ids.')
+
+        max_stations = getattr(settings, 'TRANSPO_BATCH_MAX_STATIONS', 50)
+        if len(ids) > max_stations:
+            raise forms.ValidationError('Ensure at most {} station ids are given.'.format(max_stations))
+        return list(OrderedDict.fromkeys(ids))
+
+
+class TimesViewSetMixin(object):
+    """
+    Times are paginated with a cursor, unless a limit is given,
+    in which case the next times are listed across the following days, with their service date.
+    """
+    def get_times_data(self, times, limited=False):
+        if limited:
+            serializer = serializers.DepartureSerializer(times, many=True, context=self.get_serializer_context())
+            return serializer.data
+
+        page = self.paginate_queryset(times)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data).data
+
+        serializer = self.get_serializer(times, many=True)
+        return serializer.data
+
+    def get_compact_times_data(self, times, links, with_station=False, limited=False):
+        """
+        Return times as plain rows of id, day and time, with the links common to all rows at the top level
+        """
+        rows = serializers.compact_rows(times)
+        page = None if limited else self.paginate_queryset(rows)
+        if page is not None:
+            data = self.get_paginated_response(serializers.compact_times(page, with_station)).data
+        else:
+            data = OrderedDict(times=serializers.compact_times(rows, with_station))
+
+        return OrderedDict(list(links.items()) + list(data.items()))
+
+    def times_response(self, kind, pk, date, get_versions, get_data):
+        """
+        Return the response of times, from the cache if possible,
+        or 304 Not Modified if the schedule versions are unchanged since the client's copy.
+
+        :param get_versions: function returning the schedule versions the times depend on,
+                             or None if the station or location doesn't exist
+        :param get_data: function returning the data of the response
+        """
+        request = self.request
+        key, entry = cache.lookup(kind, pk, date, request)
+        hit = entry is not None
+        if not hit:
+            versions = get_versions()
+            if versions is None:
+                raise Http404
+            when = None if date is None else '{:%Y-%m-%d %H:%M}'.format(date)
+            entry = {'etag': etag_for(request, kind, versions, when)}
+
+        def get_response():
+            if 'data' not in entry:
+                entry['data'] = get_data()
+                if key is not None:
+                    cache.store(key, entry)
+            return Response(entry['data'])
+
+        response = conditional_response(request, entry['etag'], get_response)
+        if key is not None:
+            response['X-Times-Cache'] = 'hit' if hit else 'miss'
+        return response
+
+
+class StationTimesViewSet(TimesViewSetMixin, viewsets.ModelViewSet):
     queryset = models.DailySchedule.objects.all()
     serializer_class = serializers.DailyScheduleSerializer
+    pagination_class = pagination.TimesCursorPagination
 
     def list(self, request, station_id):
         form = StationTimesForm(request.GET)
         if not form.is_valid():
             return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        station = get_object_or_404(models.Station, pk=station_id)
         date = form.parse_date()
-        times = station.next_daily_times(date)
 
-        page = self.paginate_queryset(times)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+        def get_versions():
+            return models.Station.objects.filter(pk=station_id).values_list('schedule_version', flat=True).first()
 
-        serializer = self.get_serializer(times, many=True)
-        return Response(serializer.data)
+        def get_data():
+            station = get_object_or_404(models.Station, pk=station_id)
+            limit = form.cleaned_data['limit']
+            if limit is None:
+                times = station.next_daily_times(date, after=self.paginator.get_after(request))
+            else:
+                times = station.next_daily_times(date, limit=limit)
+            limited = limit is not None
+            if form.cleaned_data['compact']:
+                links = serializers.compact_station_links(station, request)
+                return self.get_compact_times_data(times, links, limited=limited)
+            return self.get_times_data(times, limited)
 
+        return self.times_response(cache.STATION, station_id, date, get_versions, get_data)
 
-class LineViewSet(viewsets.ModelViewSet):
+    @list_route(methods=['post', 'put', 'delete'])
+    def bulk(self, request, station_id):
+        """
+        Create, replace or delete many times of the station at once, from a list of day and time rows,
+        in a single transaction. PUT replaces all the times of the station, or of the days in the days parameter,
+        deleting and creating only the times that differ.
+        """
+        station = get_object_or_404(models.Station, pk=station_id)
+        serializer = serializers.DayTimeSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        day_times = [(row['day'], row['time']) for row in serializer.validated_data]
+        created = deleted = 0
+        if request.method == 'POST':
+            created = station.bulk_register_daily_times(day_times)
+        elif request.method == 'PUT':
+            days = request.query_params.getlist('days') or None
+            try:
+                created, deleted = station.sync_daily_times(day_times, days)
+            except ValueError as e:
+                return Response({'days': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            deleted = station.delete_daily_times(day_times)
+
+        version = models.Station.objects.filter(pk=station.pk).values_list('schedule_version', flat=True).first()
+        return Response(OrderedDict([
+            ('created', created),
+            ('deleted', deleted),
+            ('schedule_version', version),
+        ]))
+
+
+class StationDatesForm(forms.Form):
+    to = forms.DateTimeField(required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(StationDatesForm, self).__init__(*args, **kwargs)
+        # from is a keyword, so it can't be declared like the other fields
+        self.fields['from'] = forms.DateTimeField(required=False)
+
+
+class StationDatesViewSet(viewsets.GenericViewSet):
+    """
+    Dates of the general schedule of a station, from a date inclusive to a date exclusive
+    """
+    queryset = models.GeneralSchedule.objects.all()
+    serializer_class = serializers.GeneralScheduleSerializer
+    pagination_class = pagination.DatesCursorPagination
+
+    def list(self, request, station_id):
+        form = StationDatesForm(request.GET)
+        if not form.is_valid():
+            return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        station = get_object_or_404(models.Station, pk=station_id)
+        dates = station.general_schedules(form.cleaned_data['from'], form.cleaned_data['to'],
+                                          after=self.paginator.get_after(request))
+        page = self.paginate_queryset(dates)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class JourneyForm(forms.Form):
+    to = forms.IntegerField()
+    date = forms.DateTimeField(required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(JourneyForm, self).__init__(*args, **kwargs)
+        # from is a keyword, so it can't be declared like the other fields
+        self.fields['from'] = forms.IntegerField()
+
+
+class JourneysViewSet(viewsets.GenericViewSet):
+    """
+    The journey arriving the earliest at a station, from another station at a date and time, by default now
+    """
+    queryset = models.Trip.objects.all()
+
+    def list(self, request):
+        form = JourneyForm(request.GET)
+        if not form.is_valid():
+            return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        station_ids = {form.cleaned_data['from'], form.cleaned_data['to']}
+        if models.Station.objects.filter(id__in=station_ids).count() != len(station_ids):
+            raise Http404
+
+        date = form.cleaned_data['date'] or timezone.now()
+        legs = journeys.find_journey(form.cleaned_data['from'], form.cleaned_data['to'], date)
+        if legs is None:
+            return Response({'detail': 'No journey found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(serializers.journey_data(legs, request))
+
+
+class LineViewSet(ConditionalViewSetMixin, viewsets.ModelViewSet):
     queryset = models.Line.objects.all()
     serializer_class = serializers.LineSerializer
+    etag_fields = ('id', 'name')
 
 
 class DailyScheduleViewSet(viewsets.ModelViewSet):
@@ -69,23 +338,66 @@ class LocationViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.LocationSerializer
 
 
-class LocationTimesViewSet(viewsets.ModelViewSet):
+class EventStreamRenderer(renderers.BaseRenderer):
+    """
+    Renders a list of (name, data, retry) server-sent events, or an error as an event named error
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            return serializers.server_sent_event('error', data)
+        return b''.join(serializers.server_sent_event(*event) for event in data)
+
+
+class LocationTimesViewSet(TimesViewSetMixin, viewsets.ModelViewSet):
     queryset = models.DailySchedule.objects.all()
     serializer_class = serializers.DailyScheduleSerializer
+    pagination_class = pagination.TimesCursorPagination
 
     def list(self, request, location_id):
         form = StationTimesForm(request.GET)
         if not form.is_valid():
             return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        location = get_object_or_404(models.Location, pk=location_id)
         date = form.parse_date()
-        times = location.next_daily_times(date)
 
-        page = self.paginate_queryset(times)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+        def get_versions():
+            # the stations of the location and their versions, or [(None, None)] for no stations
+            versions = models.Location.objects.filter(pk=location_id).order_by('stations__id')
+            return list(versions.values_list('stations__id', 'stations__schedule_version')) or None
 
-        serializer = self.get_serializer(times, many=True)
-        return Response(serializer.data)
+        def get_data():
+            location = get_object_or_404(models.Location, pk=location_id)
+            limit = form.cleaned_data['limit']
+            if limit is None:
+                times = location.next_daily_times(date, limit=self.paginator.get_limit(request),
+                                                  after=self.paginator.get_after(request), rollover=False)
+            else:
+                times = location.next_daily_times(date, limit=limit)
+            limited = limit is not None
+            if form.cleaned_data['compact']:
+                links = serializers.compact_location_links(location, request)
+                return self.get_compact_times_data(times, links, with_station=True, limited=limited)
+            return self.get_times_data(times, limited)
+
+        return self.times_response(cache.LOCATION, location_id, date, get_versions, get_data)
+
+    @list_route(renderer_classes=[EventStreamRenderer])
+    def stream(self, request, location_id):
+        """
+        Next departures of the location as server-sent events.
+        The ASGI application streams the departures, and then their changes;
+        otherwise the departures are sent once, with a delay after which clients reconnect.
+        """
+        form = StationTimesForm(request.GET)
+        if not form.is_valid():
+            return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        location = get_object_or_404(models.Location, pk=location_id)
+        times = location.next_daily_times(timezone.now(), limit=form.cleaned_data['limit'] or board_limit())
+        links = serializers.compact_location_links(location, request)
+        data = self.get_compact_times_data(times, links, with_station=True, limited=True)
+        return Response([('departures', data, board_check_seconds() * 1000)], headers={'Cache-Control': 'no-cache'})
@@ -0,0 +1,96 @@
+import json
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from benchmarks import network, runner
+
+
+def setting_arg(value):
+    name, _, raw = value.partition('=')
+    if not name or not raw:
+        raise ValueError(value)
+    try:
+        return name, json.loads(raw)
+    except ValueError:
+        return name, raw
+
+
+class Command(BaseCommand):
+    help = 'Time model methods and API endpoints on generated networks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', '-s', nargs='+', choices=sorted(network.SCALES), default=['small'],
+                            help='Predefined sizes of networks to generate')
+        parser.add_argument('--lines', type=int,
+                            help='Number of lines of a custom network, instead of the predefined scales')
+        parser.add_argument('--stations-per-line', type=int, default=10)
+        parser.add_argument('--departures-per-day', type=int, default=60)
+        parser.add_argument('--users', type=int, default=5)
+        parser.add_argument('--case', '-c', nargs='+', choices=list(runner.CASES),
+                            help='Cases to run, by default all')
+        parser.add_argument('--iterations', '-n', type=int, default=100,
+                            help='Number of timed calls of each case')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--override', metavar='NAME=VALUE', type=setting_arg, nargs='+', default=[],
+                            help='Override settings, with JSON values, for example: TRANSPO_TIMETABLE_INDEX=true')
+        parser.add_argument('--output', '-o',
+                            help='Write the results as JSON to this file, instead of standard output')
+        parser.add_argument('--baseline', '-b',
+                            help='Compare the results with the JSON results of an earlier run')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Relative slowdown of the median above which a case counts as a regression')
+        parser.add_argument('--current-db', action='store_true',
+                            help='Generate the networks in the configured database, instead of a test database; '
+                                 'they are rolled back in both cases')
+
+    def handle(self, *args, **options):
+        if options['lines']:
+            scales = {'custom': dict(lines=options['lines'], stations_per_line=options['stations_per_line'],
+                                     departures_per_day=options['departures_per_day'], users=options['users'])}
+        else:
+            scales = OrderedDict((name, network.SCALES[name]) for name in options['scale'])
+
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as fh:
+                    baseline = json.load(fh)
+            except (IOError, ValueError) as e:
+                raise CommandError('Cannot read baseline: {}'.format(e))
+
+        results = self.run(scales, options)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            self.report(runner.compare(baseline, results, options['threshold']))
+
+    def run(self, scales, options):
+        setup_test_environment()
+        old_name = None
+        if not options['current_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(**dict(options['override'])):
+                return runner.run_benchmarks(scales, options['case'], options['iterations'], options['seed'])
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def report(self, rows):
+        regressions = 0
+        for scale, name, before, after, change, regression in rows:
+            regressions += regression
+            self.stderr.write('{:<8} {:<32} {:>10.3f} ms {:>10.3f} ms {:>+8.1%}{}'.format(
+                scale, name, before, after, change, '  REGRESSION' if regression else ''))
+        if regressions:
+            raise CommandError('{} of {} cases regressed'.format(regressions, len(rows)))
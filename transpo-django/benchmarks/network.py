@@ -0,0 +1,84 @@
+"""
+Generator of synthetic transportation networks, to benchmark on realistic amounts of data.
+"""
+import random
+from collections import namedtuple
+from datetime import time
+
+from django.contrib.auth.models import User
+from lines import models, signals
+from lines.utils import chunked
+
+Network = namedtuple('Network', ['line_ids', 'station_ids', 'location_ids'])
+
+# the parameters of the networks of the predefined scales
+SCALES = {
+    'small': dict(lines=5, stations_per_line=10, departures_per_day=60, users=5),
+    'medium': dict(lines=20, stations_per_line=20, departures_per_day=150, users=50),
+    'large': dict(lines=50, stations_per_line=40, departures_per_day=300, users=200),
+}
+
+# first and last departures of the day, in minutes
+FIRST_DEPARTURE = 5 * 60
+LAST_DEPARTURE = 24 * 60 - 1
+
+
+def departure_times(count, rng):
+    """
+    Return the sorted times of departures spread over the service hours, with some jitter
+    """
+    if count <= 0:
+        return []
+    interval = (LAST_DEPARTURE - FIRST_DEPARTURE) / count
+    minutes = {min(LAST_DEPARTURE, int(FIRST_DEPARTURE + i * interval + rng.random() * interval))
+               for i in range(count)}
+    return [time(m // 60, m % 60) for m in sorted(minutes)]
+
+
+def station_day_times(departures_per_day, specific_day_ratio, rng):
+    """
+    Generate the (day, time) pairs of the daily schedule of a station:
+    weekdays, fewer departures on weekends, and for some stations, a specific day overriding its group
+    """
+    for t in departure_times(departures_per_day, rng):
+        yield models.DailySchedule.WEEKDAYS, t
+    for t in departure_times(departures_per_day // 2, rng):
+        yield models.DailySchedule.WEEKENDS, t
+    if rng.random() < specific_day_ratio:
+        day = rng.choice(models.DailySchedule.DAYS)
+        for t in departure_times(departures_per_day // 3, rng):
+            yield day, t
+
+
+def generate_network(lines=5, stations_per_line=10, departures_per_day=60, specific_day_ratio=0.2,
+                     users=5, locations_per_user=2, stations_per_location=3, seed=0, batch_size=None):
+    """
+    Create a network of lines, stations and their daily schedules, and locations of users, in bulk
+
+    :return: the ids of the created lines, stations and locations
+    """
+    rng = random.Random(seed)
+    first = models.Line.objects.count()
+
+    line_ids = [models.Line.objects.create(name='L{}'.format(first + i)).id for i in range(lines)]
+    stations = (models.Station(line_id=line_id, name='S{}'.format(i)) for line_id in line_ids
+                for i in range(stations_per_line))
+    models.bulk_create(models.Station, stations, batch_size)
+    station_ids = list(models.Station.objects.filter(line_id__in=line_ids).values_list('id', flat=True))
+
+    schedules = (models.DailySchedule(station_id=station_id, day=day, time=t) for station_id in station_ids
+                 for day, t in station_day_times(departures_per_day, specific_day_ratio, rng))
+    models.bulk_create(models.DailySchedule, schedules, batch_size)
+
+    location_ids = []
+    for i in range(users):
+        user = User.objects.create(username='benchmark-{}-{}'.format(first, i))
+        for j in range(locations_per_user):
+            location = models.Location.objects.create(user=user, name='Location {}'.format(j))
+            location.stations.add(*rng.sample(station_ids, min(stations_per_location, len(station_ids))))
+            location_ids.append(location.id)
+
+    # bulk inserts bypass the model signals; chunked to stay within the query parameter limits of sqlite
+    for chunk in chunked(station_ids, 500):
+        signals.schedule_changed.send(sender=models.DailySchedule, station_ids=chunk)
+    return Network(line_ids, station_ids, location_ids)
@@ -0,0 +1,216 @@
+"""
+Timing of model methods and API endpoints on generated networks, and comparison of results against a baseline.
+"""
+import platform
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import django
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from lines import models, timetable
+from lines.utils import TimeIndex, batch_lookup, times_gte
+from api import cache
+from benchmarks.network import generate_network
+
+FORMAT_VERSION = 1
+
+# the settings that change how times are found, recorded with the results
+SETTINGS = ('TRANSPO_TIMETABLE_INDEX', 'TRANSPO_SERVICE_CALENDAR', 'TRANSPO_TIMES_CACHE')
+
+CASES = OrderedDict()
+
+
+def case(name):
+    def register(fun):
+        CASES[name] = fun
+        return fun
+    return register
+
+
+class Context(object):
+    """
+    The network of a benchmark, and random choices of its stations, locations and dates
+    """
+    def __init__(self, network, seed):
+        self.rng = random.Random(seed)
+        self.stations = list(models.Station.objects.filter(line_id__in=network.line_ids))
+        self.locations = list(models.Location.objects.filter(id__in=network.location_ids))
+        self.client = Client()
+
+        sample = self.rng.sample(self.stations, min(10, len(self.stations)))
+        self.times = [list(station.dailyschedule_set.filter(day=models.DailySchedule.WEEKDAYS)
+                           .order_by('time').values_list('time', flat=True)) for station in sample]
+        self.time_indexes = {i: TimeIndex(times) for i, times in enumerate(self.times)}
+
+    def station(self):
+        return self.rng.choice(self.stations)
+
+    def location(self):
+        return self.rng.choice(self.locations)
+
+    def date(self):
+        # any minute of a week
+        minutes = self.rng.randrange(7 * 24 * 60)
+        return timezone.make_aware(datetime(2016, 1, 11) + timedelta(minutes=minutes), timezone.utc)
+
+    def get(self, url, date, **params):
+        params['date'] = date.strftime('%Y-%m-%d %H:%M')
+        response = self.client.get(url, params)
+        assert response.status_code == 200, response.status_code
+        return response.content
+
+
+@case('station_next_daily_times')
+def station_next_daily_times(context):
+    return list(context.station().next_daily_times(context.date()))
+
+
+@case('station_next_daily_times_limit')
+def station_next_daily_times_limit(context):
+    return list(context.station().next_daily_times(context.date(), limit=3))
+
+
+@case('location_next_daily_times')
+def location_next_daily_times(context):
+    return list(context.location().next_daily_times(context.date()))
+
+
+@case('times_gte')
+def times_gte_case(context):
+    return times_gte(context.rng.choice(context.times), context.date().time())
+
+
+@case('times_gte_batch')
+def times_gte_batch_case(context):
+    # the next times of 100 (station, time) questions, as when refreshing boards
+    queries = [(context.rng.randrange(len(context.times)), context.date().time()) for _ in range(100)]
+    return batch_lookup(context.time_indexes, queries, limit=3)
+
+
+@case('api_station_times')
+def api_station_times(context):
+    url = reverse('station-times-list', kwargs={'station_id': context.station().id})
+    return context.get(url, context.date())
+
+
+@case('api_location_times')
+def api_location_times(context):
+    url = reverse('location-times-list', kwargs={'location_id': context.location().id})
+    return context.get(url, context.date())
+
+
+@case('api_stations_times')
+def api_stations_times(context):
+    ids = ','.join(str(context.station().id) for _ in range(10))
+    return context.get(reverse('station-times'), context.date(), ids=ids)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(fun, context, iterations, warmup=5):
+    """
+    Time calls of a benchmark case, after counting the queries of one call
+
+    :return: statistics of the durations of the calls, in milliseconds
+    """
+    for _ in range(warmup):
+        fun(context)
+
+    with CaptureQueriesContext(connection) as queries:
+        fun(context)
+
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fun(context)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    return OrderedDict([
+        ('iterations', iterations),
+        ('queries', len(queries)),
+        ('min_ms', round(min(durations), 4)),
+        ('median_ms', round(percentile(durations, 0.5), 4)),
+        ('mean_ms', round(sum(durations) / len(durations), 4)),
+        ('p95_ms', round(percentile(durations, 0.95), 4)),
+    ])
+
+
+def environment():
+    return OrderedDict([
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('database', connection.vendor),
+        ('settings', OrderedDict((name, getattr(settings, name, None)) for name in SETTINGS)),
+    ])
+
+
+def run_scale(params, cases, iterations, seed):
+    """
+    Generate a network and time the cases on it, in a transaction that is rolled back
+    """
+    result = OrderedDict(network=params)
+    with transaction.atomic():
+        start = time.perf_counter()
+        network = generate_network(seed=seed, **params)
+        result['setup_s'] = round(time.perf_counter() - start, 3)
+        result['rows'] = models.DailySchedule.objects.filter(station__line_id__in=network.line_ids).count()
+
+        context = Context(network, seed)
+        result['cases'] = OrderedDict((name, measure(CASES[name], context, iterations)) for name in cases)
+        transaction.set_rollback(True)
+
+    # forget the rolled back network
+    timetable.invalidate()
+    if cache.get_cache() is not None:
+        cache.get_cache().clear()
+    return result
+
+
+def run_benchmarks(scales, cases=None, iterations=100, seed=0):
+    """
+    Time the cases on networks of the scales
+
+    :param scales: map of scale name to parameters of generate_network
+    :param cases: names of the cases to run, or None for all
+    :return: the results, as a dictionary ready to be saved as JSON
+    """
+    cases = list(CASES) if cases is None else cases
+    return OrderedDict([
+        ('version', FORMAT_VERSION),
+        ('created', timezone.now().isoformat()),
+        ('environment', environment()),
+        ('iterations', iterations),
+        ('seed', seed),
+        ('scales', OrderedDict((name, run_scale(params, cases, iterations, seed)) for name, params in scales.items())),
+    ])
+
+
+def compare(baseline, results, threshold=0.1):
+    """
+    Compare the median durations of results with a baseline
+
+    :param threshold: the relative slowdown above which a case counts as a regression
+    :return: list of (scale, case, baseline median, median, relative change, regression) tuples,
+             for the cases found in both
+    """
+    rows = []
+    for scale, scale_results in results['scales'].items():
+        baseline_cases = baseline.get('scales', {}).get(scale, {}).get('cases', {})
+        for name, stats in scale_results['cases'].items():
+            if name not in baseline_cases:
+                continue
+            before = baseline_cases[name]['median_ms']
+            after = stats['median_ms']
+            change = (after - before) / before if before else 0
+            rows.append((scale, name, before, after, change, change > threshold))
+    return rows
@@ -0,0 +1,43 @@
+
+from django.test import TestCase
+from lines import models
+from benchmarks import runner
+from benchmarks.network import generate_network
+
+TINY = dict(lines=2, stations_per_line=3, departures_per_day=10, users=1, locations_per_user=2)
+
+
+class NetworkTestCase(TestCase):
+    def test_generates_network(self):
+        network = generate_network(**TINY)
+        self.assertEquals(2, len(network.line_ids))
+        self.assertEquals(6, len(network.station_ids))
+        self.assertEquals(2, len(network.location_ids))
+        self.assertEquals(10, models.DailySchedule.objects.filter(station_id=network.station_ids[0],
+                                                                  day=models.DailySchedule.WEEKDAYS).count())
+        self.assertEquals(3, models.Location.objects.get(pk=network.location_ids[0]).stations.count())
+
+    def test_same_seed_same_times(self):
+        first = generate_network(**TINY)
+        second = generate_network(**TINY)
+
+        def times(station_id):
+            return list(models.DailySchedule.objects.filter(station_id=station_id).values_list('day', 'time'))
+        self.assertEquals(times(first.station_ids[0]), times(second.station_ids[0]))
+
+
+class RunnerTestCase(TestCase):
+    def test_runs_cases_and_rolls_back(self):
+        results = runner.run_benchmarks({'tiny': TINY}, iterations=2)
+        cases = results['scales']['tiny']['cases']
+        self.assertEquals(list(runner.CASES), list(cases))
+        self.assertEquals(2, cases['station_next_daily_times']['queries'])
+        self.assertFalse(models.Line.objects.exists())
+
+    def test_compare_finds_regressions(self):
+        def results(median):
+            return {'scales': {'tiny': {'cases': {'times_gte': {'median_ms': median}}}}}
+        self.assertEquals([('tiny', 'times_gte', 1.0, 1.05, 0.05, False)],
+                          [row[:4] + (round(row[4], 2), row[5]) for row in runner.compare(results(1.0), results(1.05))])
+        self.assertTrue(runner.compare(results(1.0), results(1.5))[0][-1])
+        self.assertEquals([], runner.compare({'scales': {}}, results(1.5)))
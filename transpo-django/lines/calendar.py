@@ -0,0 +1,218 @@
+"""
+Service calendar of stations, with holidays and other exception dates per line.
+
+The day label to use for the times of a station on a date is found by looking for
+the label of the calendar exception of the line on that date, if any,
+then the specific day, then weekdays or weekends, then daily.
+
+When the TRANSPO_SERVICE_CALENDAR setting is enabled, the labels are compiled ahead of time
+for a horizon of days by the calendar command, into ServiceDay rows,
+and resolving the label of a station on a date is a single indexed lookup.
+The compiled dates of stations whose schedule or calendar exceptions change are compiled again
+once the change is committed, and resolved from their schedules meanwhile.
+Dates outside the compiled horizon are resolved from the daily schedules and calendar exceptions.
+When disabled, calendar exceptions are ignored.
+"""
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min
+from django.db.models.query import QuerySet
+from django.dispatch import receiver
+
+from lines.signals import schedule_changed
+
+
+def is_enabled():
+    return getattr(settings, 'TRANSPO_SERVICE_CALENDAR', False)
+
+
+def horizon_days():
+    return getattr(settings, 'TRANSPO_SERVICE_CALENDAR_DAYS', 60)
+
+
+def as_date(date):
+    return date.date() if isinstance(date, datetime) else date
+
+
+def date_labels(day, exception=None):
+    """
+    Return the labels to look for when finding the times of a day, in order of precedence
+
+    :param exception: the label of the calendar exception of the date, if any
+    """
+    from lines.models import DailySchedule, CalendarException
+
+    if exception is None:
+        return DailySchedule.day_labels(day)
+    if exception == CalendarException.NO_SERVICE:
+        return ()
+    if exception in DailySchedule.DAYS:
+        return DailySchedule.day_labels(exception)
+    return (exception,) + DailySchedule.day_labels(DailySchedule.SUNDAY)
+
+
+def first_labels(station_labels):
+    """
+    Return the first label that has times of each station, using a single query.
+    Stations without times with any of their labels are omitted.
+
+    :param station_labels: map of station id to labels in order of precedence
+    """
+    from lines.models import DailySchedule
+
+    all_labels = {label for labels in station_labels.values() for label in labels}
+    found = defaultdict(set)
+    query = DailySchedule.objects.filter(station_id__in=list(station_labels), day__in=all_labels)
+    for station_id, label in query.values_list('station_id', 'day').distinct():
+        found[station_id].add(label)
+
+    result = {}
+    for station_id, labels in station_labels.items():
+        label = next((label for label in labels if label in found[station_id]), None)
+        if label is not None:
+            result[station_id] = label
+    return result
+
+
+def resolve_uncompiled(station_ids, date):
+    """
+    Return the label to use for the times of each station on the date, from their schedules and calendar exceptions
+    """
+    from lines.models import CalendarException
+
+    exceptions = CalendarException.objects.filter(date=date, line__station__in=station_ids)
+    exception_days = dict(exceptions.values_list('line__station', 'day'))
+    day = '{:%a}'.format(date)
+    return first_labels({station_id: date_labels(day, exception_days.get(station_id)) for station_id in station_ids})
+
+
+def resolve(station_ids, date):
+    """
+    Return the label to use for the times of each station on the day of the date.
+    Stations without times on that day are omitted.
+
+    :param station_ids: list of station ids, or a queryset of stations
+    """
+    from lines.models import DailySchedule, ServiceDay
+
+    if not is_enabled():
+        return DailySchedule.resolve_day_labels(station_ids, '{:%a}'.format(date))
+
+    if isinstance(station_ids, QuerySet):
+        station_ids = station_ids.values_list('id', flat=True)
+    station_ids = list(station_ids)
+    date = as_date(date)
+
+    # the compiled labels of the stations changed in the current transaction are outdated until it commits
+    compiled = [station_id for station_id in station_ids if station_id not in pending_station_ids()]
+    labels = dict(ServiceDay.objects.filter(station_id__in=compiled, date=date).values_list('station_id', 'day'))
+    missing = [station_id for station_id in station_ids if station_id not in labels]
+    if missing:
+        labels.update(resolve_uncompiled(missing, date))
+    return {station_id: label for station_id, label in labels.items() if label}
+
+
+def station_date_labels(start, days, station_ids=None, with_exceptions=True):
+    """
+    Generate the label to use for the times of stations for each date of a horizon of days,
+    as (station id, date, label) tuples, with an empty label for no times
+
+    :param station_ids: the stations, or None for all stations
+    :param with_exceptions: whether to take calendar exceptions into account
+    """
+    from lines.models import Station, DailySchedule, CalendarException
+
+    end = start + timedelta(days - 1)
+    stations = Station.objects.all()
+    schedules = DailySchedule.objects.all()
+    if station_ids is not None:
+        stations = stations.filter(id__in=station_ids)
+        schedules = schedules.filter(station_id__in=station_ids)
+
+    station_lines = dict(stations.values_list('id', 'line_id'))
+    present = defaultdict(set)
+    for station_id, label in schedules.values_list('station_id', 'day').distinct():
+        present[station_id].add(label)
+
+    exception_days = {}
+    if with_exceptions:
+        exceptions = CalendarException.objects.filter(date__range=(start, end))
+        exception_days = {(line_id, date): day
+                          for line_id, date, day in exceptions.values_list('line_id', 'date', 'day')}
+
+    for offset in range(days):
+        date = start + timedelta(offset)
+        day = '{:%a}'.format(date)
+        for station_id, line_id in station_lines.items():
+            labels = date_labels(day, exception_days.get((line_id, date)))
+            yield station_id, date, next((label for label in labels if label in present[station_id]), '')
+
+
+def compile_calendar(start, days, station_ids=None, batch_size=None):
+    """
+    Compile the labels of stations for each date of a horizon of days, replacing previously compiled labels.
+
+    :param station_ids: the stations to compile, or None for all stations
+    :return: the number of compiled (station, date) pairs
+    """
+    from lines.models import ServiceDay, bulk_create
+
+    compiled = ServiceDay.objects.filter(date__range=(start, start + timedelta(days - 1)))
+    if station_ids is not None:
+        compiled = compiled.filter(station_id__in=station_ids)
+
+    service_days = (ServiceDay(station_id=station_id, date=date, day=label)
+                    for station_id, date, label in station_date_labels(start, days, station_ids))
+    with transaction.atomic():
+        compiled.delete()
+        return bulk_create(ServiceDay, service_days, batch_size)
+
+
+def recompile(station_ids, batch_size=None):
+    """
+    Compile the labels of stations again, for the dates they were compiled for
+
+    :return: the number of compiled (station, date) pairs
+    """
+    from lines.models import ServiceDay
+
+    compiled = ServiceDay.objects.filter(station_id__in=station_ids).aggregate(start=Min('date'), end=Max('date'))
+    if compiled['start'] is None:
+        return 0
+    return compile_calendar(compiled['start'], (compiled['end'] - compiled['start']).days + 1, station_ids,
+                            batch_size)
+
+
+# the stations changed in the current transaction of each thread, to recompile once it commits
+_pending = threading.local()
+
+
+def pending_station_ids():
+    if not hasattr(_pending, 'station_ids'):
+        _pending.station_ids = set()
+    return _pending.station_ids
+
+
+def recompile_pending():
+    """
+    Compile the labels of the stations changed since the last recompilation again
+    """
+    station_ids = pending_station_ids()
+    if not station_ids:
+        return
+    changed = sorted(station_ids)
+    station_ids.clear()
+    recompile(changed)
+
+
+@receiver(schedule_changed)
+def recompile_changed(sender, station_ids, **kwargs):
+    if not is_enabled():
+        return
+    pending_station_ids().update(station_ids)
+    # the first callback to run recompiles all the stations changed in the transaction, the others have nothing left
+    transaction.on_commit(recompile_pending)
@@ -0,0 +1,130 @@
+"""
+Departures of stations materialized per date.
+
+When the TRANSPO_DEPARTURES setting is enabled, the departures command fills the Departure table
+with the times of each station on each date of a window of days, from the daily schedule,
+using the day label of the station on that date.
+The window of each station is recorded on the station, and the times of a station
+on a date of its window are read from the departures with a single indexed range scan,
+instead of resolving its day label first.
+
+A change of the schedule of a station rebuilds the departures of that station only, over its window,
+once the transaction of the change commits, and once for all the changes of the transaction.
+"""
+import multiprocessing
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.dispatch import receiver
+
+from lines import calendar
+from lines.signals import schedule_changed
+
+
+def is_enabled():
+    return getattr(settings, 'TRANSPO_DEPARTURES', False)
+
+
+def window_days():
+    return getattr(settings, 'TRANSPO_DEPARTURES_DAYS', 30)
+
+
+def covers(station, date):
+    """
+    Return whether the departures of the station on the day of the date are materialized
+    """
+    date = calendar.as_date(date)
+    return station.departures_start is not None and station.departures_start <= date < station.departures_end
+
+
+def station_departures(station_id, start, days):
+    """
+    Generate the departures of a station on each date of a window of days
+    """
+    from lines.models import DailySchedule, Departure
+
+    schedules = defaultdict(list)
+    for pk, label, time in DailySchedule.objects.filter(station_id=station_id).values_list('id', 'day', 'time'):
+        schedules[label].append((pk, time))
+
+    labels = calendar.station_date_labels(start, days, [station_id], with_exceptions=calendar.is_enabled())
+    for _, date, label in labels:
+        for pk, time in schedules.get(label, ()):
+            yield Departure(station_id=station_id, service_date=date, time=time, schedule_id=pk)
+
+
+def rebuild_station(station_id, start, days, batch_size=None):
+    """
+    Replace the departures of a station with its departures on each date of a window of days
+
+    :return: the number of departures
+    """
+    from lines.models import Station, Departure, bulk_create
+
+    with transaction.atomic():
+        Departure.objects.filter(station_id=station_id).delete()
+        count = bulk_create(Departure, station_departures(station_id, start, days), batch_size)
+        Station.objects.filter(id=station_id).update(departures_start=start, departures_end=start + timedelta(days))
+    return count
+
+
+def _rebuild_station(args):
+    return rebuild_station(*args)
+
+
+def _close_connections():
+    # the connections of the parent process must not be shared with the workers
+    connections.close_all()
+
+
+def rebuild(station_ids, start, days, processes=1, batch_size=None):
+    """
+    Rebuild the departures of stations, in parallel in a pool of processes if more than one
+
+    :return: the number of departures
+    """
+    tasks = [(station_id, start, days, batch_size) for station_id in station_ids]
+    if processes <= 1:
+        return sum(_rebuild_station(task) for task in tasks)
+
+    _close_connections()
+    with multiprocessing.Pool(processes, initializer=_close_connections) as pool:
+        return sum(pool.imap_unordered(_rebuild_station, tasks))
+
+
+# the stations changed in the current transaction of each thread, to rebuild once it commits
+_pending = threading.local()
+
+
+def pending_station_ids():
+    if not hasattr(_pending, 'station_ids'):
+        _pending.station_ids = set()
+    return _pending.station_ids
+
+
+def rebuild_pending():
+    """
+    Rebuild the departures of the stations changed since the last rebuild, over their windows
+    """
+    from lines.models import Station
+
+    station_ids = pending_station_ids()
+    if not station_ids:
+        return
+    windows = Station.objects.filter(id__in=sorted(station_ids), departures_start__isnull=False)
+    station_ids.clear()
+    for station_id, start, end in windows.values_list('id', 'departures_start', 'departures_end'):
+        rebuild_station(station_id, start, (end - start).days)
+
+
+@receiver(schedule_changed)
+def rebuild_changed(sender, station_ids, **kwargs):
+    if not is_enabled():
+        return
+    pending_station_ids().update(station_ids)
+    # the first callback to run rebuilds all the stations changed in the transaction, the others have nothing left;
+    # the stations of a transaction rolled back are rebuilt at the next commit, which is harmless
+    transaction.on_commit(rebuild_pending)
@@ -0,0 +1,268 @@
+"""
+Export of the network as rows of tables, streamed in constant memory.
+
+Rows are fetched in chunks ordered by primary key, each chunk continuing from the last key of the previous one,
+so that neither the database driver nor the process holds more than a chunk of rows at a time,
+however large the tables.
+"""
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, time, timedelta
+
+from django.utils import timezone
+
+from lines import calendar
+
+GTFS_CALENDAR_COLUMNS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+# GTFS exception types of calendar dates
+SERVICE_ADDED = 1
+SERVICE_REMOVED = 2
+
+
+def iter_chunks(queryset, fields, chunk_size=None):
+    """
+    Generate the values of the fields of the rows of a queryset in primary key order,
+    fetched in chunks continuing from the last key of the previous chunk
+
+    :return: lists of tuples of values
+    """
+    from lines.models import BULK_BATCH_SIZE
+
+    chunk_size = chunk_size or BULK_BATCH_SIZE
+    last = None
+    while True:
+        query = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(query.order_by('pk').values_list('pk', *fields)[:chunk_size])
+        if chunk:
+            yield [row[1:] for row in chunk]
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1][0]
+
+
+def iter_rows(queryset, fields, chunk_size=None):
+    for chunk in iter_chunks(queryset, fields, chunk_size):
+        yield from chunk
+
+
+def local_datetime(value):
+    return timezone.localtime(value) if timezone.is_aware(value) else value
+
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return local_datetime(value).isoformat()
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+
+class Selection(object):
+    """
+    The parts of the network to export: all of it, or only some lines or stations
+    """
+    def __init__(self, line_ids=None, station_ids=None):
+        self.line_ids = line_ids
+        self.station_ids = station_ids
+
+    @property
+    def is_filtered(self):
+        return bool(self.line_ids or self.station_ids)
+
+    def lines(self):
+        from lines.models import Line
+
+        lines = Line.objects.all()
+        if self.is_filtered:
+            lines = lines.filter(id__in=self.stations().values('line_id'))
+        return lines
+
+    def stations(self):
+        from lines.models import Station
+
+        stations = Station.objects.all()
+        if self.line_ids:
+            stations = stations.filter(line_id__in=self.line_ids)
+        if self.station_ids:
+            stations = stations.filter(id__in=self.station_ids)
+        return stations
+
+    def of_stations(self, model):
+        objects = model.objects.all()
+        if self.is_filtered:
+            objects = objects.filter(station_id__in=self.stations().values('id'))
+        return objects
+
+    def locations(self):
+        from lines.models import Location
+
+        locations = Location.objects.all()
+        if self.is_filtered:
+            locations = locations.filter(id__in=self.location_stations().values('location_id'))
+        return locations
+
+    def location_stations(self):
+        from lines.models import Location
+
+        return self.of_stations(Location.stations.through)
+
+
+def line_rows(selection, chunk_size=None):
+    return iter_rows(selection.lines(), ('id', 'name'), chunk_size)
+
+
+def station_rows(selection, chunk_size=None):
+    return iter_rows(selection.stations(), ('id', 'line_id', 'name'), chunk_size)
+
+
+def daily_schedule_rows(selection, chunk_size=None):
+    from lines.models import DailySchedule
+
+    return iter_rows(selection.of_stations(DailySchedule), ('id', 'station_id', 'day', 'time'), chunk_size)
+
+
+def dated_schedule_rows(selection, chunk_size=None):
+    from lines.models import GeneralSchedule
+
+    return iter_rows(selection.of_stations(GeneralSchedule), ('id', 'station_id', 'date'), chunk_size)
+
+
+def location_rows(selection, chunk_size=None):
+    for chunk in iter_chunks(selection.locations(), ('id', 'user_id', 'name'), chunk_size):
+        station_ids = defaultdict(list)
+        through = selection.location_stations().filter(location_id__in=[row[0] for row in chunk])
+        for location_id, station_id in through.order_by('location_id', 'station_id').values_list(
+                'location_id', 'station_id'):
+            station_ids[location_id].append(station_id)
+        for row in chunk:
+            yield row + (station_ids[row[0]],)
+
+
+# the columns of each table, and the function generating its rows from a selection
+TABLES = OrderedDict([
+    ('lines', (('id', 'name'), line_rows)),
+    ('stations', (('id', 'line_id', 'name'), station_rows)),
+    ('daily_schedules', (('id', 'station_id', 'day', 'time'), daily_schedule_rows)),
+    ('dated_schedules', (('id', 'station_id', 'date'), dated_schedule_rows)),
+    ('locations', (('id', 'user_id', 'name', 'station_ids'), location_rows)),
+])
+
+
+def service_id(station_id, label):
+    return '{}-{}'.format(station_id, label)
+
+
+def gtfs_date(value):
+    return '{:%Y%m%d}'.format(value)
+
+
+def label_of(labels, day, exception=None):
+    """
+    Return the label of the times of a station on a day, among the labels of the station, or None
+    """
+    return next((label for label in calendar.date_labels(day, exception) if label in labels), None)
+
+
+def gtfs_services(selection, chunk_size=None):
+    """
+    Generate the GTFS services of the daily schedules of stations, one per label of each station,
+    running on the days of the week and the dates of calendar exceptions on which the label is used
+
+    :return: (calendar rows, calendar date rows) of each chunk of stations
+    """
+    from lines.models import DailySchedule, CalendarException
+
+    exceptions = defaultdict(list)
+    for line_id, exception_date, label in CalendarException.objects.filter(line__in=selection.lines()).values_list(
+            'line_id', 'date', 'day'):
+        exceptions[line_id].append((exception_date, label))
+
+    for chunk in iter_chunks(selection.stations(), ('id', 'line_id'), chunk_size):
+        present = defaultdict(set)
+        schedules = DailySchedule.objects.filter(station_id__in=[station_id for station_id, _ in chunk])
+        for station_id, label in schedules.values_list('station_id', 'day').distinct():
+            present[station_id].add(label)
+
+        calendar_rows, date_rows = [], []
+        for station_id, line_id in chunk:
+            labels = present[station_id]
+            week = [label_of(labels, day) for day in DailySchedule.DAYS]
+            for label in sorted(labels):
+                calendar_rows.append((service_id(station_id, label),) + tuple(int(label == used) for used in week))
+
+            for exception_date, exception in exceptions[line_id]:
+                day = '{:%a}'.format(exception_date)
+                usual, instead = label_of(labels, day), label_of(labels, day, exception)
+                if usual != instead:
+                    if usual is not None:
+                        date_rows.append((service_id(station_id, usual), gtfs_date(exception_date), SERVICE_REMOVED))
+                    if instead is not None:
+                        date_rows.append((service_id(station_id, instead), gtfs_date(exception_date), SERVICE_ADDED))
+        yield calendar_rows, date_rows
+
+
+def gtfs_files(selection, start, days, agency_url, agency_name='', route_type=3, chunk_size=None):
+    """
+    Return the files of a GTFS feed of the selection, in the order to write them,
+    as a map of the name of each file to its columns and a function generating its rows.
+
+    The feed is a round-trip format, read back by the gtfs command, and not a valid GTFS feed:
+    stations have no coordinates, so the stops lack the stop_lat and stop_lon columns that GTFS requires.
+
+    Each time of the daily schedule is a trip of one stop, of the service of its station and label,
+    running from the start date for a number of days.
+    Each date of the general schedule is a trip of one stop, of a service running on that date only.
+    """
+    from lines.models import DailySchedule, GeneralSchedule
+
+    end = gtfs_date(start + timedelta(days - 1))
+    start = gtfs_date(start)
+
+    def agency():
+        yield 'transpo', agency_name, agency_url, timezone.get_current_timezone_name()
+
+    def routes():
+        for line_id, name in iter_rows(selection.lines(), ('id', 'name'), chunk_size):
+            yield line_id, 'transpo', name, route_type
+
+    def calendar_rows():
+        for rows, _ in gtfs_services(selection, chunk_size):
+            for row in rows:
+                yield row + (start, end)
+
+    def calendar_dates():
+        for _, rows in gtfs_services(selection, chunk_size):
+            yield from rows
+        for pk, service_date in iter_rows(selection.of_stations(GeneralSchedule), ('id', 'date'), chunk_size):
+            yield 'g{}'.format(pk), gtfs_date(local_datetime(service_date)), SERVICE_ADDED
+
+    def trips():
+        schedules = selection.of_stations(DailySchedule)
+        for pk, station_id, line_id, label in iter_rows(schedules, ('id', 'station_id', 'station__line_id', 'day'),
+                                                        chunk_size):
+            yield line_id, service_id(station_id, label), 'd{}'.format(pk)
+        dates = selection.of_stations(GeneralSchedule)
+        for pk, line_id in iter_rows(dates, ('id', 'station__line_id'), chunk_size):
+            yield line_id, 'g{}'.format(pk), 'g{}'.format(pk)
+
+    def stop_times():
+        for pk, station_id, t in iter_rows(selection.of_stations(DailySchedule), ('id', 'station_id', 'time'),
+                                           chunk_size):
+            yield 'd{}'.format(pk), t.isoformat(), t.isoformat(), station_id, 1
+        for pk, station_id, service_date in iter_rows(selection.of_stations(GeneralSchedule),
+                                                      ('id', 'station_id', 'date'), chunk_size):
+            t = local_datetime(service_date).time().isoformat()
+            yield 'g{}'.format(pk), t, t, station_id, 1
+
+    def stops():
+        return iter_rows(selection.stations(), ('id', 'name'), chunk_size)
+
+    return OrderedDict([
+        ('agency.txt', (('agency_id', 'agency_name', 'agency_url', 'agency_timezone'), agency)),
+        ('routes.txt', (('route_id', 'agency_id', 'route_short_name', 'route_type'), routes)),
+        ('stops.txt', (('stop_id', 'stop_name'), stops)),
+        ('calendar.txt', (('service_id',) + GTFS_CALENDAR_COLUMNS + ('start_date', 'end_date'), calendar_rows)),
+        ('calendar_dates.txt', (('service_id', 'date', 'exception_type'), calendar_dates)),
+        ('trips.txt', (('route_id', 'service_id', 'trip_id'), trips)),
+        ('stop_times.txt', (('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'), stop_times)),
+    ])
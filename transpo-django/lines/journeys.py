@@ -0,0 +1,262 @@
+"""
+Earliest arrival journeys between stations, with the Connection Scan Algorithm.
+
+The trips of lines are split into connections, from each stop of a trip to the next,
+and the connections running on a service day are sorted by departure time into arrays,
+built once per day and kept until a schedule changes.
+A change in this process drops the connections of all days at once. Changes made by other processes
+are found by comparing the schedule versions of the stations the connections were built from
+with the versions of all stations, read with a single query at most every TRANSPO_JOURNEY_CHECK_SECONDS.
+The earliest arrival from a station at a time is then found with a single scan of the connections
+departing from that time, stopping as soon as they depart after the best arrival found.
+
+Stations are specific to a line, so the stations of different lines with the same name are considered
+the same stop, where changing lines takes TRANSPO_JOURNEY_TRANSFER_MINUTES.
+Times are in seconds from the start of the service day, and trips continuing past midnight
+stop on the next day at the times of their stops on that day.
+"""
+import bisect
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.utils import timezone
+
+from lines import calendar
+from lines.signals import schedule_changed
+
+DAY_SECONDS = 24 * 60 * 60
+
+# how many service days to keep the connections of
+CACHED_DAYS = 3
+
+
+def transfer_seconds():
+    return getattr(settings, 'TRANSPO_JOURNEY_TRANSFER_MINUTES', 2) * 60
+
+
+def check_seconds():
+    return getattr(settings, 'TRANSPO_JOURNEY_CHECK_SECONDS', 5)
+
+
+def to_seconds(t):
+    return (t.hour * 60 + t.minute) * 60 + t.second
+
+
+class Leg(object):
+    """
+    A ride on a trip, from a station to another, in seconds from the start of the service day
+    """
+    def __init__(self, trip_id, line_id, from_station_id, departure, to_station_id, arrival):
+        self.trip_id = trip_id
+        self.line_id = line_id
+        self.from_station_id = from_station_id
+        self.departure = departure
+        self.to_station_id = to_station_id
+        self.arrival = arrival
+
+
+class Connections(object):
+    """
+    The connections of a service day, sorted by departure time, in arrays
+    """
+    def __init__(self, connections, trip_lines, transfers):
+        """
+        :param connections: (departure, arrival, from station id, to station id, trip id) tuples
+        :param trip_lines: map of trip id to line id
+        :param transfers: map of station id to the ids of the other stations of the same stop
+        """
+        connections = sorted(connections)
+        self.departures = array('l', (c[0] for c in connections))
+        self.arrivals = array('l', (c[1] for c in connections))
+        self.from_stations = array('l', (c[2] for c in connections))
+        self.to_stations = array('l', (c[3] for c in connections))
+        self.trips = array('l', (c[4] for c in connections))
+        self.trip_lines = trip_lines
+        self.transfers = transfers
+
+    def __len__(self):
+        return len(self.departures)
+
+    def stop(self, station_id):
+        return (station_id,) + self.transfers.get(station_id, ())
+
+    def earliest_arrival(self, origin, destination, start):
+        """
+        Return the legs of a journey from a station at a time, arriving as early as possible at another station,
+        or None if there is none on the service day
+
+        :param start: the time to leave from, in seconds from the start of the service day
+        """
+        unreached = float('inf')
+        transfer = transfer_seconds()
+        departures, arrivals, trips = self.departures, self.arrivals, self.trips
+        from_stations, to_stations = self.from_stations, self.to_stations
+
+        arrival = {station_id: start for station_id in self.stop(origin)}
+        targets = set(self.stop(destination))
+        best = start if origin in targets else unreached
+        # per station, the connections boarded and left to arrive there, or (None, station) after a transfer
+        via = {}
+        boarded = {}
+
+        for i in range(bisect.bisect_left(departures, start), len(departures)):
+            if departures[i] >= best:
+                break
+            trip = trips[i]
+            if trip not in boarded:
+                if arrival.get(from_stations[i], unreached) > departures[i]:
+                    continue
+                boarded[trip] = i
+
+            station_id = to_stations[i]
+            if arrivals[i] < arrival.get(station_id, unreached):
+                arrival[station_id] = arrivals[i]
+                via[station_id] = boarded[trip], i
+                if station_id in targets:
+                    best = min(best, arrivals[i])
+                for other in self.transfers.get(station_id, ()):
+                    if arrivals[i] + transfer < arrival.get(other, unreached):
+                        arrival[other] = arrivals[i] + transfer
+                        via[other] = None, station_id
+                        if other in targets:
+                            best = min(best, arrival[other])
+
+        if best == unreached:
+            return None
+        station_id = min(targets, key=lambda target: arrival.get(target, unreached))
+        return self.legs(via, station_id)
+
+    def legs(self, via, station_id):
+        legs = []
+        while station_id in via:
+            first, last = via[station_id]
+            if first is None:
+                station_id = last
+                continue
+            legs.append(Leg(self.trips[first], self.trip_lines[self.trips[first]], self.from_stations[first],
+                            self.departures[first], self.to_stations[last], self.arrivals[last]))
+            station_id = self.from_stations[first]
+        return legs[::-1]
+
+
+def build(date):
+    """
+    Return the connections of the trips running on a service day.
+    A stop runs on a date if the label of its time is the label of the times of its station on that date.
+    """
+    from lines.models import Station, TripStop
+
+    labels = {(station_id, day_date): label for station_id, day_date, label in
+              calendar.station_date_labels(date, 2, with_exceptions=calendar.is_enabled()) if label}
+
+    by_name = defaultdict(list)
+    for station_id, name in Station.objects.values_list('id', 'name').iterator():
+        by_name[name].append(station_id)
+    transfers = {station_id: tuple(other for other in station_ids if other != station_id)
+                 for station_ids in by_name.values() if len(station_ids) > 1 for station_id in station_ids}
+
+    connections = []
+    trip_lines = {}
+    stops = TripStop.objects.order_by('trip_id', 'sequence').values_list(
+        'trip_id', 'trip__line_id', 'schedule__station_id', 'schedule__day', 'schedule__time')
+    previous = None
+    for trip_id, line_id, station_id, day, t in stops.iterator():
+        if previous is None or previous[0] != trip_id:
+            offset = 0
+        elif to_seconds(t) < previous[3] % DAY_SECONDS:
+            offset += DAY_SECONDS
+        seconds = to_seconds(t) + offset
+        runs = offset < 2 * DAY_SECONDS and labels.get((station_id, date + timedelta(offset // DAY_SECONDS))) == day
+
+        if previous is not None and previous[0] == trip_id and previous[4] and runs:
+            connections.append((previous[3], seconds, previous[2], station_id, trip_id))
+            trip_lines[trip_id] = line_id
+        previous = trip_id, line_id, station_id, seconds, runs
+    return Connections(connections, trip_lines, transfers)
+
+
+# service date -> (connections, schedule versions of the stations when built)
+_days = OrderedDict()
+_generation = 0
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def station_versions():
+    from lines.models import Station
+
+    return dict(Station.objects.values_list('id', 'schedule_version'))
+
+
+def check_versions():
+    """
+    Drop the connections of the days built before a schedule changed, in any process, unless checked recently
+    """
+    global _checked_at
+
+    if time.time() - _checked_at < check_seconds():
+        return
+    checked_at = time.time()
+    versions = station_versions()
+    with _lock:
+        _checked_at = checked_at
+        for date, (_, built) in list(_days.items()):
+            if built != versions:
+                del _days[date]
+
+
+def get(date):
+    """
+    Return the connections of a service day, built once until a schedule changes
+    """
+    check_versions()
+    entry = _days.get(date)
+    if entry is None:
+        generation = _generation
+        # read first, so that a change made while building is found by the next check
+        versions = station_versions()
+        entry = build(date), versions
+        with _lock:
+            if generation == _generation:
+                _days[date] = entry
+                while len(_days) > CACHED_DAYS:
+                    _days.popitem(last=False)
+    return entry[0]
+
+
+def invalidate():
+    global _generation
+
+    with _lock:
+        _generation += 1
+        _days.clear()
+
+
+@receiver(schedule_changed)
+def invalidate_changed(sender, station_ids, **kwargs):
+    invalidate()
+
+
+def find_journey(origin, destination, date):
+    """
+    Return the legs of the journey arriving the earliest at a station, from another station at a date and time,
+    with their departure and arrival as datetimes, or None if there is none on the service day of the date
+    """
+    date = timezone.localtime(date) if timezone.is_aware(date) else date
+    service_date = date.date()
+    legs = get(service_date).earliest_arrival(origin, destination, to_seconds(date.time()))
+    if legs is None:
+        return None
+
+    midnight = datetime.combine(service_date, datetime.min.time())
+    for leg in legs:
+        leg.departure, leg.arrival = (midnight + timedelta(seconds=leg.departure),
+                                      midnight + timedelta(seconds=leg.arrival))
+        if settings.USE_TZ:
+            leg.departure, leg.arrival = timezone.make_aware(leg.departure), timezone.make_aware(leg.arrival)
+    return legs
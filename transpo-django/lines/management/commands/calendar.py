@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from lines import calendar, models
+
+
+def date_arg(value):
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+class Command(BaseCommand):
+    help = 'Manage holidays and other calendar exceptions, and compile the service calendar'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--add', '-a', metavar='date', type=date_arg, nargs='+',
+                            help='Add calendar exceptions on dates, for example: 2016-12-25')
+        parser.add_argument('--delete', metavar='date', type=date_arg, nargs='+',
+                            help='Delete calendar exceptions on dates')
+        parser.add_argument('--lines', metavar='line-id', type=int, nargs='+',
+                            help='Lines of the exceptions to add or delete, by default all lines')
+        parser.add_argument('--day', '-d', default=models.DailySchedule.HOLIDAY,
+                            help='Label of the times to run on the exception dates, '
+                                 'for example: holiday, Sun, {}'.format(models.CalendarException.NO_SERVICE))
+        parser.add_argument('--name', '-n', default='',
+                            help='Name of the exceptions, for example: Christmas')
+        parser.add_argument('--compile', '-c', action='store_true',
+                            help='Compile the day labels of all stations for the dates of the horizon')
+        parser.add_argument('--start', type=date_arg,
+                            help='First date to compile, by default today')
+        parser.add_argument('--days', type=int, default=calendar.horizon_days(),
+                            help='Number of days to compile')
+        parser.add_argument('--batch-size', type=int, default=models.BULK_BATCH_SIZE,
+                            help='Number of compiled days to insert at once')
+
+    def handle(self, *args, **options):
+        if options['add']:
+            self.add_exceptions(options)
+        elif options['delete']:
+            self.exceptions(options).delete()
+        elif options['compile']:
+            self.compile_calendar(options)
+        else:
+            for exception in models.CalendarException.objects.order_by('date', 'line'):
+                self.stdout.write('{} {}'.format(exception, exception.name).rstrip())
+
+    def lines(self, options):
+        lines = models.Line.objects.all()
+        if options['lines']:
+            lines = lines.filter(id__in=options['lines'])
+            missing = set(options['lines']) - set(lines.values_list('id', flat=True))
+            if missing:
+                raise CommandError('Lines do not exist: {}'.format(', '.join(str(pk) for pk in sorted(missing))))
+        return lines
+
+    def exceptions(self, options):
+        dates = options['add'] or options['delete']
+        return models.CalendarException.objects.filter(line__in=self.lines(options), date__in=dates)
+
+    def add_exceptions(self, options):
+        for line in self.lines(options):
+            for date in options['add']:
+                exception, _ = models.CalendarException.objects.update_or_create(
+                    line=line, date=date, defaults={'day': options['day'], 'name': options['name']})
+                self.stdout.write('{}'.format(exception))
+
+    def compile_calendar(self, options):
+        start = options['start'] or timezone.localtime(timezone.now()).date()
+        count = calendar.compile_calendar(start, options['days'], batch_size=options['batch_size'])
+        self.stdout.write('compiled {} station days from {}'.format(count, start))
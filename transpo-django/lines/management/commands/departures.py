@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from lines import departures, models
+from lines.management.commands.calendar import date_arg
+
+
+class Command(BaseCommand):
+    help = 'Build the departures of stations on each date of a window of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stations', metavar='station-id', type=int, nargs='+',
+                            help='Stations to build, by default all stations')
+        parser.add_argument('--start', type=date_arg,
+                            help='First date to build, by default today')
+        parser.add_argument('--days', type=int, default=departures.window_days(),
+                            help='Number of days to build')
+        parser.add_argument('--processes', '-p', type=int, default=1,
+                            help='Number of processes building stations in parallel')
+        parser.add_argument('--batch-size', type=int, default=models.BULK_BATCH_SIZE,
+                            help='Number of departures to insert at once')
+
+    def handle(self, *args, **options):
+        station_ids = list(models.Station.objects.order_by('id').values_list('id', flat=True))
+        if options['stations']:
+            missing = set(options['stations']) - set(station_ids)
+            if missing:
+                raise CommandError('Stations do not exist: {}'.format(', '.join(str(pk) for pk in sorted(missing))))
+            station_ids = sorted(options['stations'])
+
+        start = options['start'] or timezone.localtime(timezone.now()).date()
+        count = departures.rebuild(station_ids, start, options['days'], options['processes'], options['batch_size'])
+        self.stdout.write('built {} departures for {} stations from {}'.format(count, len(station_ids), start))
@@ -0,0 +1,118 @@
+import csv
+import io
+import json
+import os
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from lines import export, models
+from lines.management.commands.calendar import date_arg
+
+FORMATS = ('jsonl', 'csv', 'gtfs')
+
+
+class Command(BaseCommand):
+    help = 'Export lines, stations, schedules and locations as JSON Lines, CSV or a GTFS feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', '-f', choices=FORMATS, default='jsonl',
+                            help='jsonl: one object per row, with the name of its table; '
+                                 'csv: one file per table; gtfs: a feed of the lines, stations and times, '
+                                 'read back by the gtfs command, but without the coordinates of stops that '
+                                 'GTFS requires')
+        parser.add_argument('--output', '-o',
+                            help='File to write, or directory for csv, or zip file or directory for gtfs; '
+                                 'by default standard output, for jsonl, or csv of a single table')
+        parser.add_argument('--tables', '-t', nargs='+', choices=list(export.TABLES), default=list(export.TABLES),
+                            help='Tables to export, by default all')
+        parser.add_argument('--lines', metavar='line-id', type=int, nargs='+',
+                            help='Export only these lines')
+        parser.add_argument('--stations', metavar='station-id', type=int, nargs='+',
+                            help='Export only these stations')
+        parser.add_argument('--chunk-size', type=int, default=models.BULK_BATCH_SIZE,
+                            help='Number of rows to fetch at once')
+        parser.add_argument('--start', type=date_arg,
+                            help='First date of the services of the gtfs feed, by default today')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Number of days of the services of the gtfs feed')
+        parser.add_argument('--agency-name', default='',
+                            help='Name of the agency of the gtfs feed')
+        parser.add_argument('--agency-url',
+                            help='URL of the agency of the gtfs feed, required for gtfs')
+        parser.add_argument('--route-type', type=int, default=3,
+                            help='GTFS type of the routes, for example 0 for tram, 1 for subway, 3 for bus')
+
+    def handle(self, *args, **options):
+        selection = export.Selection(options['lines'], options['stations'])
+        chunk_size = options['chunk_size']
+        output = options['output']
+
+        if options['format'] == 'jsonl':
+            if output:
+                with open(output, 'w', encoding='utf-8') as fh:
+                    self.write_jsonl(fh, selection, options['tables'], chunk_size)
+            else:
+                self.write_jsonl(self.stdout, selection, options['tables'], chunk_size)
+        elif options['format'] == 'csv':
+            self.export_csv(selection, options['tables'], chunk_size, output)
+        else:
+            self.export_gtfs(selection, options, output)
+
+    @staticmethod
+    def write_jsonl(fh, selection, tables, chunk_size):
+        for name in tables:
+            columns, rows = export.TABLES[name]
+            for row in rows(selection, chunk_size):
+                obj = {'table': name}
+                obj.update(zip(columns, (export.format_value(value) for value in row)))
+                fh.write(json.dumps(obj) + '\n')
+
+    @staticmethod
+    def write_csv(fh, columns, rows):
+        writer = csv.writer(fh, lineterminator='\n')
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(export.format_value(value) for value in row)
+
+    def export_csv(self, selection, tables, chunk_size, output):
+        if not output:
+            if len(tables) != 1:
+                raise CommandError('specify an output directory to export more than one table as csv')
+            columns, rows = export.TABLES[tables[0]]
+            self.write_csv(self.stdout, columns, self.csv_rows(columns, rows(selection, chunk_size)))
+            return
+
+        os.makedirs(output, exist_ok=True)
+        for name in tables:
+            columns, rows = export.TABLES[name]
+            with open(os.path.join(output, name + '.csv'), 'w', encoding='utf-8', newline='') as fh:
+                self.write_csv(fh, columns, self.csv_rows(columns, rows(selection, chunk_size)))
+
+    @staticmethod
+    def csv_rows(columns, rows):
+        if 'station_ids' not in columns:
+            return rows
+        # lists of ids are space separated
+        index = columns.index('station_ids')
+        return (row[:index] + (' '.join(str(pk) for pk in row[index]),) + row[index + 1:] for row in rows)
+
+    def export_gtfs(self, selection, options, output):
+        if not output:
+            raise CommandError('specify the zip file or directory of the gtfs feed to export')
+        if not options['agency_url']:
+            raise CommandError('specify the URL of the agency of the gtfs feed with --agency-url')
+
+        start = options['start'] or timezone.localtime(timezone.now()).date()
+        files = export.gtfs_files(selection, start, options['days'], options['agency_url'], options['agency_name'],
+                                  options['route_type'], options['chunk_size'])
+        if output.endswith('.zip'):
+            with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as feed:
+                for name, (columns, rows) in files.items():
+                    with io.TextIOWrapper(feed.open(name, 'w'), encoding='utf-8', newline='') as fh:
+                        self.write_csv(fh, columns, rows())
+        else:
+            os.makedirs(output, exist_ok=True)
+            for name, (columns, rows) in files.items():
+                with open(os.path.join(output, name), 'w', encoding='utf-8', newline='') as fh:
+                    self.write_csv(fh, columns, rows())
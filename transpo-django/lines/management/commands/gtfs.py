@@ -0,0 +1,179 @@
+import csv
+import datetime
+import io
+import os
+import time
+import zipfile
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from lines import models, signals
+
+DAYS = (
+    models.DailySchedule.MONDAY,
+    models.DailySchedule.TUESDAY,
+    models.DailySchedule.WEDNESDAY,
+    models.DailySchedule.THURSDAY,
+    models.DailySchedule.FRIDAY,
+    models.DailySchedule.SATURDAY,
+    models.DailySchedule.SUNDAY,
+)
+
+CALENDAR_COLUMNS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+WEEKDAYS = (0, 1, 2, 3, 4)
+WEEKENDS = (5, 6)
+
+
+def day_groups(services_by_day):
+    """
+    Partition the days of the week into labelled groups of days on which the same services run.
+
+    Times registered for a station are looked up by specific day, then weekdays or weekends,
+    then daily, and only the first label found is used.
+    So that each day finds exactly the services running on it,
+    days can only share a label if the same services run on all of them.
+
+    :param services_by_day: list of 7 sets of services, starting on Monday
+    :return: list of (label, days) pairs
+    """
+    if all(services == services_by_day[0] for services in services_by_day):
+        return [(models.DailySchedule.DAILY, tuple(range(7)))]
+
+    groups = []
+    remaining = set(range(7))
+    for label, days in ((models.DailySchedule.WEEKDAYS, WEEKDAYS), (models.DailySchedule.WEEKENDS, WEEKENDS)):
+        if all(services_by_day[day] == services_by_day[days[0]] for day in days):
+            groups.append((label, days))
+            remaining -= set(days)
+
+    groups += [(DAYS[day], (day,)) for day in sorted(remaining)]
+    return groups
+
+
+def parse_gtfs_time(value):
+    """
+    Parse a GTFS time, which may go beyond 24:00:00 for trips after midnight.
+
+    :return: (time, days after the service day)
+    """
+    hours, minutes, seconds = (int(part) for part in value.split(':'))
+    return datetime.time(hours % 24, minutes, seconds), hours // 24
+
+
+class Command(BaseCommand):
+    help = 'Import lines, stations and daily schedules from a GTFS feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed',
+                            help='GTFS feed, as a zip file or a directory')
+        parser.add_argument('--batch-size', type=int, default=models.BULK_BATCH_SIZE,
+                            help='Number of times to insert at once')
+        parser.add_argument('--progress', type=int, default=100000,
+                            help='Report progress after every this many stop times')
+
+    def handle(self, *args, **options):
+        self.feed = options['feed']
+        if not os.path.exists(self.feed):
+            raise CommandError('feed does not exist: {}'.format(self.feed))
+
+        # the lines and stations are only created with their times
+        with transaction.atomic():
+            lines = self.import_routes()
+            stop_names = {row['stop_id']: row['stop_name'] for row in self.rows('stops.txt')}
+            service_days = self.read_calendar()
+            trips = {row['trip_id']: (row['route_id'], row['service_id']) for row in self.rows('trips.txt')}
+            labels = self.compute_labels(self.scan_station_services(trips, options['progress']), service_days)
+
+            stations = {}
+
+            def get_station_id(route_id, stop_id):
+                key = route_id, stop_id
+                if key not in stations:
+                    station = models.Station.objects.create(line=lines[route_id], name=stop_names[stop_id])
+                    stations[key] = station.id
+                return stations[key]
+
+            def schedules():
+                for row in self.rows('stop_times.txt', progress=options['progress']):
+                    value = row['departure_time'].strip() or row['arrival_time'].strip()
+                    if not value:
+                        # times of stops that are not timepoints may be omitted
+                        continue
+                    route_id, service_id = trips[row['trip_id']]
+                    t, shift = parse_gtfs_time(value)
+                    station_id = get_station_id(route_id, row['stop_id'])
+                    for label in labels[route_id, row['stop_id']][service_id, shift]:
+                        yield models.DailySchedule(station_id=station_id, day=label, time=t)
+
+            count = models.bulk_create(models.DailySchedule, schedules(), options['batch_size'])
+            signals.schedule_changed.send(sender=models.DailySchedule, station_ids=list(stations.values()))
+        self.stdout.write('imported {} lines, {} stations, {} times'.format(len(lines), len(stations), count))
+
+    @contextmanager
+    def open_file(self, name):
+        if os.path.isdir(self.feed):
+            with open(os.path.join(self.feed, name), encoding='utf-8-sig', newline='') as fh:
+                yield fh
+        else:
+            with zipfile.ZipFile(self.feed) as feed, feed.open(name) as fh:
+                yield io.TextIOWrapper(fh, encoding='utf-8-sig', newline='')
+
+    def rows(self, name, progress=None):
+        start = time.time()
+        with self.open_file(name) as fh:
+            for count, row in enumerate(csv.DictReader(fh), start=1):
+                yield row
+                if progress and count % progress == 0:
+                    elapsed = time.time() - start
+                    self.stdout.write('{}: {} rows, {:.0f} rows/s'.format(name, count, count / elapsed))
+
+    def import_routes(self):
+        lines = {}
+        for row in self.rows('routes.txt'):
+            name = row.get('route_short_name') or row.get('route_long_name') or row['route_id']
+            lines[row['route_id']] = models.Line.objects.create(name=name)
+        return lines
+
+    def read_calendar(self):
+        service_days = {}
+        for row in self.rows('calendar.txt'):
+            service_days[row['service_id']] = {day for day, column in enumerate(CALENDAR_COLUMNS) if row[column] == '1'}
+        return service_days
+
+    def scan_station_services(self, trips, progress):
+        """
+        Find the services stopping at each stop of each route, in a first pass over the stop times.
+
+        :return: map of (route, stop) to set of (service, days after the service day)
+        """
+        services = defaultdict(set)
+        for row in self.rows('stop_times.txt', progress=progress):
+            value = row['departure_time'].strip() or row['arrival_time'].strip()
+            if value:
+                route_id, service_id = trips[row['trip_id']]
+                services[route_id, row['stop_id']].add((service_id, int(value.split(':')[0]) // 24))
+        return services
+
+    @staticmethod
+    def compute_labels(station_services, service_days):
+        """
+        Map (route, stop) and (service, days after the service day) to the day labels to register times with.
+
+        Times past midnight run on the days following the days of their service,
+        so they are considered as a separate service, shifted by the days after the service day.
+        """
+        labels = {}
+        for station, services in station_services.items():
+            services_by_day = [set() for _ in range(7)]
+            for service_id, shift in services:
+                for day in service_days.get(service_id, ()):
+                    services_by_day[(day + shift) % 7].add((service_id, shift))
+
+            labels[station] = defaultdict(list)
+            for label, days in day_groups(services_by_day):
+                for service in services_by_day[days[0]]:
+                    labels[station][service].append(label)
+        return labels
@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
 from lines import models
 
 
@@ -37,7 +38,11 @@ class Command(BaseCommand):
     def list_stations(self, options):
         show_times = options['times']
 
-        stations = models.Station.objects.all()
+        # the name of a station is shown with its line
+        stations = models.Station.objects.select_related('line')
+        if show_times:
+            schedules = models.DailySchedule.objects.only('station', 'day', 'time')
+            stations = stations.prefetch_related(Prefetch('dailyschedule_set', queryset=schedules))
         if options['station-ids']:
             stations = stations.filter(id__in=options['station-ids'])
 
@@ -1,7 +1,30 @@
+import csv
+
 from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_time
 from lines import models
 
 
+def read_day_times(path):
+    """
+    Generate (day, time) pairs from a CSV file, or TSV if the filename ends with .tsv.
+    Empty lines, lines starting with # and a "day,time" header are skipped.
+    """
+    delimiter = '\t' if path.endswith('.tsv') else ','
+    with open(path) as fh:
+        for lineno, row in enumerate(csv.reader(fh, delimiter=delimiter), start=1):
+            if not row or row[0].startswith('#') or row[:2] == ['day', 'time']:
+                continue
+            try:
+                day, timestr = (value.strip() for value in row)
+                time = parse_time(timestr)
+            except ValueError:
+                day = time = None
+            if not day or time is None:
+                raise CommandError('{}:{}: expected day and time, got: {}'.format(path, lineno, row))
+            yield day, time
+
+
 class Command(BaseCommand):
     help = 'Manage daily schedule'
 
@@ -13,6 +36,13 @@ class Command(BaseCommand):
                             help='List of times, for example: 07:10 08:10')
         parser.add_argument('--create', '-c', action='store_true',
                             help='Create specified days and times')
+        parser.add_argument('--file', '-f',
+                            help='Create the days and times in a CSV or TSV file of day,time rows')
+        parser.add_argument('--sync', metavar='FILE',
+                            help='Replace the days and times with those in a CSV or TSV file of day,time rows, '
+                                 'creating and deleting only the differences; with --days, only of these days')
+        parser.add_argument('--batch-size', type=int, default=models.BULK_BATCH_SIZE,
+                            help='Number of rows to insert or delete at once from file')
         parser.add_argument('--delete', action='store_true',
                             help='Delete specified days and times')
         parser.add_argument('--list', '-l', action='store_true',
@@ -25,7 +55,11 @@ class Command(BaseCommand):
         except models.Station.DoesNotExist:
             raise CommandError('Station "{}" does not exist'.format(station_id))
 
-        if options['create']:
+        if options['sync']:
+            self.sync_times_from_file(station, options)
+        elif options['file']:
+            self.create_times_from_file(station, options)
+        elif options['create']:
             self.create_times(station, options)
         elif options['delete']:
             self.delete_times(station, options)
@@ -38,6 +72,19 @@ class Command(BaseCommand):
             raise CommandError('You must specify both days and times to register')
         station.register_daily_times(options['days'], options['times'])
 
+    def create_times_from_file(self, station, options):
+        count = station.bulk_register_daily_times(read_day_times(options['file']), options['batch_size'])
+        self.stdout.write('created {} times'.format(count))
+
+    def sync_times_from_file(self, station, options):
+        day_times = list(read_day_times(options['sync']))
+        try:
+            created, deleted = station.sync_daily_times(day_times, options['days'], options['batch_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write('created {} times, deleted {} times, unchanged {} times'.format(
+            created, deleted, len(day_times) - created))
+
     @staticmethod
     def for_each_time(station, options, fun):
         times = station.dailyschedule_set.all()
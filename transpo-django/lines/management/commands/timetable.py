@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from lines import timetable_file
+
+
+class Command(BaseCommand):
+    help = 'Build the timetable file of all stations, shared by the processes of the server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o',
+                            help='File to write, by default the TRANSPO_TIMETABLE_FILE setting; '
+                                 'it is replaced atomically')
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Number of stations whose times to query at once')
+
+    def handle(self, *args, **options):
+        filename = options['output'] or timetable_file.path()
+        if not filename:
+            raise CommandError('specify the file to build, or set TRANSPO_TIMETABLE_FILE')
+
+        stations, times = timetable_file.build(filename, options['chunk_size'])
+        self.stdout.write('built timetable of {} stations, {} times in {}'.format(stations, times, filename))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 12:51
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySchedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.CharField(max_length=30)),
+                ('time', models.TimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GeneralSchedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Line',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Station',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Line')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='stations',
+            field=models.ManyToManyField(to='lines.Station'),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='generalschedule',
+            name='station',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Station'),
+        ),
+        migrations.AddField(
+            model_name='dailyschedule',
+            name='station',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Station'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 12:51
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lines', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='dailyschedule',
+            index_together=set([('station', 'day', 'time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='generalschedule',
+            index_together=set([('station', 'date')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 12:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lines', '0002_schedule_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='schedule_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 13:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lines', '0003_station_schedule_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarException',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('day', models.CharField(default='holiday', max_length=30)),
+                ('name', models.CharField(blank=True, max_length=200)),
+                ('line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Line')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ServiceDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('day', models.CharField(blank=True, max_length=30)),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Station')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='serviceday',
+            unique_together=set([('station', 'date')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='calendarexception',
+            unique_together=set([('line', 'date')]),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 13:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lines', '0004_service_calendar'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Departure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_date', models.DateField()),
+                ('time', models.TimeField()),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.DailySchedule')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='station',
+            name='departures_end',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='station',
+            name='departures_start',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='departure',
+            name='station',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Station'),
+        ),
+        migrations.AlterIndexTogether(
+            name='departure',
+            index_together=set([('station', 'service_date', 'time')]),
+        ),
+    ]
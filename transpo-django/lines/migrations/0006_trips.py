@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 13:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lines', '0005_departures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trip',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=200)),
+                ('line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Line')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TripStop',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('schedule', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='lines.DailySchedule')),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lines.Trip')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='tripstop',
+            unique_together=set([('trip', 'sequence')]),
+        ),
+    ]
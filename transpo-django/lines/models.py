@@ -1,11 +1,130 @@
+import copy
+import heapq
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from functools import reduce
+from itertools import islice
+from operator import or_
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
+from lines import calendar, departures, journeys, signals, timetable
+from lines.utils import chunked
+
+BULK_BATCH_SIZE = 1000
+
+# how many days after the day of the date to look for times, when a limit is not reached
+ROLLOVER_DAYS = 7
+
+
+def bulk_create(model, objs, batch_size=None):
+    """
+    Insert objects in batches of the given size, in a single transaction
+    """
+    count = 0
+    with transaction.atomic():
+        for chunk in chunked(objs, batch_size or BULK_BATCH_SIZE):
+            model.objects.bulk_create(chunk)
+            count += len(chunk)
+    return count
+
+
+def related_fields(model):
+    """
+    Return the foreign keys and one-to-one fields of other models referring to a model
+    """
+    return [related.field for related in model._meta.related_objects
+            if related.one_to_many or related.one_to_one]
+
+
+def bulk_delete(model, ids):
+    """
+    Delete rows of a model by id, without loading them or sending their model signals.
+    The rows referring to them, found from the model metadata, are deleted first, or set to null as their field says.
+    """
+    for field in related_fields(model):
+        referring = field.model._base_manager.filter(**{'{}__in'.format(field.name): ids})
+        if field.remote_field.on_delete is models.SET_NULL:
+            referring.update(**{field.name: None})
+        else:
+            referring.delete()
+    queryset = model._base_manager.filter(id__in=ids)
+    return queryset._raw_delete(queryset.db)
+
+
+def following_days(date):
+    """
+    Generate the date and the start of each of the following ROLLOVER_DAYS days
+    """
+    yield date
+    if isinstance(date, datetime):
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    for days in range(1, ROLLOVER_DAYS + 1):
+        yield date + timedelta(days)
+
+
+def service_date(schedule, date):
+    """
+    Return a copy of a daily schedule, with the date of the day it is used for
+    """
+    schedule = copy.copy(schedule)
+    schedule.service_date = date.date() if isinstance(date, datetime) else date
+    return schedule
+
+
+def with_rollover(next_times, date, limit, after=None):
+    """
+    Return up to limit times from the date,
+    continuing with the following days from midnight when the rest of the day has fewer times.
+    The times are copies annotated with their service_date.
+
+    :param next_times: function of (date, limit, after) returning the times of the day of the date
+    """
+    result = []
+    for day_date in following_days(date):
+        times = next_times(day_date, limit - len(result), after if day_date is date else None)
+        result += [service_date(schedule, day_date) for schedule in times]
+        if len(result) >= limit:
+            break
+    return result
+
+
+def next_times_from_index(station_ids, date, after=None):
+    """
+    Return the times of the day of the date of stations, from the time of the date, from the timetable index
+
+    :return: map of station id to its times
+    """
+    if calendar.is_enabled():
+        labels = calendar.resolve(station_ids, date)
+        return {station_id: timetable.get(station_id).times_of(labels.get(station_id), date, after)
+                for station_id in station_ids}
+
+    day = '{:%a}'.format(date)
+    return {station_id: timetable.get(station_id).next_times(day, date, after) for station_id in station_ids}
+
 
 class Line(models.Model):
     name = models.CharField(max_length=200)
 
+    def register_trip(self, day, station_times, name=''):
+        """
+        Create a trip of the line, stopping at stations at times, and the daily schedules of its stops
+
+        :param day: the day label of the times
+        :param station_times: (station, time) of each stop, in order
+        """
+        with transaction.atomic():
+            trip = Trip.objects.create(line=self, name=name)
+            for sequence, (station, time) in enumerate(station_times):
+                schedule = DailySchedule.objects.create(station=station, day=day, time=time)
+                TripStop.objects.create(trip=trip, schedule=schedule, sequence=sequence)
+        return trip
+
     def __str__(self):
         return self.name
 
@@ -14,10 +133,80 @@ class Station(models.Model):
     name = models.CharField(max_length=200)
     line = models.ForeignKey(Line)
 
+    # incremented on every change of the daily schedule
+    schedule_version = models.PositiveIntegerField(default=0)
+
+    # the window of dates of the materialized departures, from start inclusive to end exclusive
+    departures_start = models.DateField(null=True, blank=True)
+    departures_end = models.DateField(null=True, blank=True)
+
     def register_daily_times(self, days, times):
-        for day in days:
-            for time in times:
-                DailySchedule.objects.create(station=self, day=day, time=time)
+        self.bulk_register_daily_times((day, time) for day in days for time in times)
+
+    def bulk_register_daily_times(self, day_times, batch_size=None):
+        schedules = (DailySchedule(station=self, day=day, time=time) for day, time in day_times)
+        count = bulk_create(DailySchedule, schedules, batch_size)
+        signals.schedule_changed.send(sender=DailySchedule, station_ids=[self.id])
+        return count
+
+    def sync_daily_times(self, day_times, days=None, batch_size=None):
+        """
+        Make the (day, time) pairs the daily schedule of the station, or of some of its days,
+        deleting and creating only the times that differ, so that the others keep their ids
+
+        :param days: the days whose times to replace, or None for all days
+        :return: (number of times created, number of times deleted)
+        """
+        wanted = Counter(day_times)
+        if days is not None and any(day not in days for day, _ in wanted):
+            raise ValueError('times of days not replaced: {}'.format(sorted({day for day, _ in wanted} - set(days))))
+
+        with transaction.atomic():
+            # concurrent syncs of the station wait for this one, where the database can lock rows
+            if connection.features.has_select_for_update:
+                list(Station.objects.select_for_update().filter(pk=self.pk).values_list('id'))
+
+            existing = defaultdict(list)
+            schedules = self.dailyschedule_set.all()
+            if days is not None:
+                schedules = schedules.filter(day__in=days)
+            for pk, day, time in schedules.order_by('id').values_list('id', 'day', 'time'):
+                existing[day, time].append(pk)
+
+            # the oldest of the same times are kept
+            deleted = [pk for day_time, ids in existing.items() for pk in ids[wanted[day_time]:]]
+            created = sorted(day_time for day_time, count in wanted.items()
+                             for _ in range(count - len(existing.get(day_time, ()))))
+
+            self.delete_daily_schedules(deleted, batch_size)
+            bulk_create(DailySchedule, (DailySchedule(station=self, day=day, time=time) for day, time in created),
+                        batch_size)
+            if created or deleted:
+                signals.schedule_changed.send(sender=DailySchedule, station_ids=[self.id])
+        return len(created), len(deleted)
+
+    def delete_daily_times(self, day_times, batch_size=None):
+        """
+        Delete the times of the station matching (day, time) pairs
+
+        :return: the number of times deleted
+        """
+        day_times = set(day_times)
+        schedules = self.dailyschedule_set.filter(day__in={day for day, _ in day_times})
+        deleted = [pk for pk, day, time in schedules.values_list('id', 'day', 'time') if (day, time) in day_times]
+        self.delete_daily_schedules(deleted, batch_size)
+        if deleted:
+            signals.schedule_changed.send(sender=DailySchedule, station_ids=[self.id])
+        return len(deleted)
+
+    @staticmethod
+    def delete_daily_schedules(ids, batch_size=None):
+        """
+        Delete daily schedules by id in batches, in a single transaction, without their model signals
+        """
+        with transaction.atomic():
+            for chunk in chunked(ids, batch_size or BULK_BATCH_SIZE):
+                bulk_delete(DailySchedule, chunk)
 
     def daily_times(self, date=None):
         if date is None:
@@ -26,47 +215,157 @@ class Station(models.Model):
         return self.next_daily_times(date)
 
     def find_daily_times(self, query, day):
-        # check for holiday
-        # TODO
-
-        # check for specific day
-        specific_day_query = query.filter(day=day)
-        if specific_day_query.exists():
-            return specific_day_query
-
-        # check for weekday or weekend
-        weekday_weekend_label = DailySchedule.weekday_weekend_label(day)
-        weekday_weekend_query = query.filter(day=weekday_weekend_label)
-        if weekday_weekend_query.exists():
-            return weekday_weekend_query
-
-        # check for daily
-        daily_query = query.filter(day=DailySchedule.DAILY)
-        if daily_query.exists():
-            return daily_query
-
-        return DailySchedule.objects.none()
-
-    def next_daily_times(self, date=None):
+        # check for specific day, then weekday or weekend, then daily
+        labels = DailySchedule.day_labels(day)
+        found = set(query.filter(day__in=labels).values_list('day', flat=True).distinct())
+        label = next((label for label in labels if label in found), None)
+        if label is None:
+            return DailySchedule.objects.none()
+        return query.filter(day=label)
+
+    def find_daily_times_of_date(self, query, date):
+        # check for holiday, then specific day, then weekday or weekend, then daily
+        label = calendar.resolve([self.id], date).get(self.id)
+        if label is None:
+            return DailySchedule.objects.none()
+        return query.filter(day=label)
+
+    def next_daily_times(self, date=None, limit=None, after=None, rollover=True):
+        """
+        Return the times of the day of the date, from the time of the date, ordered by time and id.
+
+        :param date: the date and time to start from, or None for all times of all days
+        :param limit: the maximum number of times to return;
+                      with a date, the times of the following days are included as needed to reach it
+        :param after: (time, id) of the last time already seen, to continue from
+        :param rollover: whether to include the times of the following days to reach the limit
+        """
+        if date is not None and limit is not None and rollover:
+            return with_rollover(self._next_daily_times, date, limit, after)
+        return self._next_daily_times(date, limit, after)
+
+    def _next_daily_times(self, date, limit, after):
         query = self.dailyschedule_set.all()
         if date is not None:
-            day = '{:%a}'.format(date)
-            query = self.find_daily_times(query, day)
+            if timetable.is_enabled():
+                return next_times_from_index([self.id], date, after)[self.id][:limit]
 
             # note: strange that this doesn't work:
             # timestr = '{:%H:%M}'.format(date.time)
             timestr = date.strftime('%H:%M')
 
-            return query.filter(time__gte=timestr)
+            if departures.is_enabled() and departures.covers(self, date):
+                query = DailySchedule.departing(date, timestr, station=self)
+                if after is not None:
+                    query = query.filter(DailySchedule.after(*after))
+                return query.order_by('departure__time', 'id')[:limit]
 
-        return query
+            query = self.find_daily_times_of_date(query, date)
+            query = query.filter(time__gte=timestr)
 
-    def register_dates(self, dates):
-        for date in dates:
-            GeneralSchedule.objects.create(station=self, date=date)
+        if after is not None:
+            query = query.filter(DailySchedule.after(*after))
+        return query.order_by('time', 'id')[:limit]
+
+    @staticmethod
+    def next_daily_times_by_station(station_ids, date, limit=None):
+        """
+        Return the times of the day of the date of many stations, from the time of the date.
+        The day labels of all stations are resolved with a single query,
+        and the times of all stations are fetched with another single query,
+        for the day of the date, and for each following day needed to reach the limit.
+
+        :return: map of station id to its times, ordered by time and id
+        """
+        if limit is None:
+            return Station._next_daily_times_by_station(station_ids, date, None)
+
+        result = {station_id: [] for station_id in station_ids}
+        for day_date in following_days(date):
+            pending = [station_id for station_id, times in result.items() if len(times) < limit]
+            if not pending:
+                break
+            for station_id, times in Station._next_daily_times_by_station(pending, day_date, limit).items():
+                needed = limit - len(result[station_id])
+                result[station_id] += [service_date(schedule, day_date) for schedule in times[:needed]]
+        return result
 
-    def dates(self):
-        return [s.date for s in GeneralSchedule.objects.filter(station=self)]
+    @staticmethod
+    def _next_daily_times_by_station(station_ids, date, limit):
+        if timetable.is_enabled():
+            return {station_id: times[:limit] for station_id, times in next_times_from_index(station_ids, date).items()}
+
+        result = {station_id: [] for station_id in station_ids}
+        timestr = date.strftime('%H:%M')
+        queries = []
+
+        if departures.is_enabled():
+            windows = Station.objects.filter(id__in=station_ids)
+            covered = [station.id for station in windows.only('departures_start', 'departures_end')
+                       if departures.covers(station, date)]
+            if covered:
+                query = DailySchedule.departing(date, timestr, station_id__in=covered)
+                queries.append(query.order_by('departure__station_id', 'departure__time', 'id'))
+                station_ids = [station_id for station_id in station_ids if station_id not in set(covered)]
+
+        labels = calendar.resolve(station_ids, date) if station_ids else {}
+        if labels:
+            stations_days = [models.Q(station_id=station_id, day=label) for station_id, label in labels.items()]
+            query = DailySchedule.objects.filter(reduce(or_, stations_days), time__gte=timestr)
+            queries.append(query.order_by('station_id', 'time', 'id'))
+
+        for query in queries:
+            for schedule in query:
+                times = result[schedule.station_id]
+                if limit is None or len(times) < limit:
+                    times.append(schedule)
+        return result
+
+    def register_dates(self, dates):
+        self.bulk_register_dates(dates)
+
+    def bulk_register_dates(self, dates, batch_size=None):
+        count = bulk_create(GeneralSchedule, (GeneralSchedule(station=self, date=date) for date in dates), batch_size)
+        signals.schedule_changed.send(sender=GeneralSchedule, station_ids=[self.id])
+        return count
+
+    def general_schedules(self, start=None, end=None, after=None):
+        """
+        Return the general schedule from the start date inclusive to the end date exclusive, ordered by date and id.
+
+        :param after: (date, id) of the last date already seen, to continue from
+        """
+        query = self.generalschedule_set.all()
+        if start is not None:
+            query = query.filter(date__gte=start)
+        if end is not None:
+            query = query.filter(date__lt=end)
+        if after is not None:
+            query = query.filter(GeneralSchedule.after(*after))
+        return query.order_by('date', 'id')
+
+    def iter_dates(self, start=None, end=None, chunk_size=None):
+        """
+        Generate the dates from the start date inclusive to the end date exclusive, in order,
+        fetched in chunks continuing from the last date of the previous chunk,
+        so that memory use doesn't depend on the number of dates.
+        """
+        chunk_size = chunk_size or BULK_BATCH_SIZE
+        after = None
+        while True:
+            chunk = list(self.general_schedules(start, end, after).values_list('date', 'id')[:chunk_size])
+            for date, _ in chunk:
+                yield date
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1]
+
+    def dates(self, start=None, end=None, limit=None):
+        """
+        Return the dates from the start date inclusive to the end date exclusive, in order, up to the limit
+        """
+        chunk_size = min(limit, BULK_BATCH_SIZE) if limit else None
+        return list(islice(self.iter_dates(start, end, chunk_size), limit))
 
     def __str__(self):
         return '{}/{}'.format(self.line, self.name)
@@ -81,17 +380,23 @@ class DailySchedule(models.Model):
     SATURDAY = 'Sat'
     SUNDAY = 'Sun'
 
+    DAYS = (MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY, SUNDAY)
+
     _WEEKDAYS = {MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY}
     _WEEKENDS = {SATURDAY, SUNDAY}
 
     WEEKDAYS = 'weekdays'
     WEEKENDS = 'weekends'
     DAILY = 'daily'
+    HOLIDAY = 'holiday'
 
     station = models.ForeignKey(Station)
     day = models.CharField(max_length=30)
     time = models.TimeField()
 
+    class Meta:
+        index_together = [('station', 'day', 'time')]
+
     def __str__(self):
         return '{}/{}/{}'.format(self.station, self.day, self.time)
 
@@ -107,23 +412,223 @@ class DailySchedule(models.Model):
             return DailySchedule.WEEKENDS
         return 'ERROR'
 
+    @staticmethod
+    def day_labels(day):
+        """
+        Return the labels to look for when finding the times of a day, in order of precedence
+        """
+        return day, DailySchedule.weekday_weekend_label(day), DailySchedule.DAILY
+
+    @staticmethod
+    def departing(date, timestr, **filters):
+        """
+        Return the times materialized as departures on the day of the date, from the time,
+        of the departures matching the filters
+        """
+        # one filter call, so that all the conditions apply to the same departure
+        filters = {'departure__' + name: value for name, value in filters.items()}
+        return DailySchedule.objects.filter(departure__service_date=calendar.as_date(date),
+                                            departure__time__gte=timestr, **filters)
+
+    @staticmethod
+    def after(time, pk):
+        """
+        Return the filter of times after the specified time and id, in (time, id) order
+        """
+        return models.Q(time__gt=time) | models.Q(time=time, id__gt=pk)
+
+    @staticmethod
+    def resolve_day_labels(station_ids, day):
+        """
+        Return the label to use for the times of the day of each station, using a single query.
+        Stations without times on that day are omitted.
+        """
+        labels = DailySchedule.day_labels(day)
+        found = defaultdict(set)
+        query = DailySchedule.objects.filter(station_id__in=station_ids, day__in=labels)
+        for station_id, label in query.values_list('station_id', 'day').distinct():
+            found[station_id].add(label)
+
+        return {station_id: next(label for label in labels if label in station_labels)
+                for station_id, station_labels in found.items()}
+
 
 class GeneralSchedule(models.Model):
     station = models.ForeignKey(Station)
     date = models.DateTimeField()
 
+    class Meta:
+        index_together = [('station', 'date')]
+
+    @staticmethod
+    def after(date, pk):
+        """
+        Return the filter of dates after the specified date and id, in (date, id) order
+        """
+        return models.Q(date__gt=date) | models.Q(date=date, id__gt=pk)
+
+
+class Departure(models.Model):
+    """
+    A time of a station on a date, materialized from the daily schedule
+    """
+    station = models.ForeignKey(Station)
+    service_date = models.DateField()
+    time = models.TimeField()
+    schedule = models.ForeignKey(DailySchedule)
+
+    class Meta:
+        index_together = [('station', 'service_date', 'time')]
+
+    def __str__(self):
+        return '{}/{}/{}'.format(self.station, self.service_date, self.time)
+
+
+class Trip(models.Model):
+    """
+    A run of a vehicle along a line, stopping at stations at the times of daily schedules
+    """
+    line = models.ForeignKey(Line)
+    name = models.CharField(max_length=200, blank=True)
+
+    def __str__(self):
+        return '{}/{}'.format(self.line, self.name or self.id)
+
+
+class TripStop(models.Model):
+    trip = models.ForeignKey(Trip)
+    schedule = models.OneToOneField(DailySchedule)
+    sequence = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = [('trip', 'sequence')]
+
+    def __str__(self):
+        return '{}/{}'.format(self.trip, self.sequence)
+
+
+class CalendarException(models.Model):
+    """
+    A date on which a line doesn't run the times of its day of the week.
+
+    The label is a day of the week whose times to run instead, HOLIDAY, or any other label,
+    in which case the times registered with that label are used, or else the times of Sunday.
+    NO_SERVICE means no times at all.
+    """
+    NO_SERVICE = 'none'
+
+    line = models.ForeignKey(Line)
+    date = models.DateField()
+    day = models.CharField(max_length=30, default=DailySchedule.HOLIDAY)
+    name = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        unique_together = [('line', 'date')]
+
+    def __str__(self):
+        return '{}/{}/{}'.format(self.line, self.date, self.day)
+
+
+class ServiceDay(models.Model):
+    """
+    The day label to use for the times of a station on a date, compiled ahead of time
+    from the labels of the daily schedule of the station and the calendar exceptions of its line.
+    An empty label means no times on that date.
+    """
+    station = models.ForeignKey(Station)
+    date = models.DateField()
+    day = models.CharField(max_length=30, blank=True)
+
+    class Meta:
+        unique_together = [('station', 'date')]
+
+    def __str__(self):
+        return '{}/{}/{}'.format(self.station, self.date, self.day)
+
 
 class Location(models.Model):
     user = models.ForeignKey(User)
     name = models.CharField(max_length=200)
     stations = models.ManyToManyField(Station)
 
-    def next_daily_times(self, date=None):
-        result = []
-        for station in self.stations.all():
-            result += list(station.next_daily_times(date))
+    def next_daily_times(self, date=None, limit=None, after=None, rollover=True):
+        """
+        Return the times of the day of the date at all stations, from the time of the date, ordered by time and id.
+
+        :param date: the date and time to start from, or None for all times of all days
+        :param limit: the maximum number of times to return;
+                      with a date, the times of the following days are included as needed to reach it
+        :param after: (time, id) of the last time already seen, to continue from
+        :param rollover: whether to include the times of the following days to reach the limit
+        """
+        if date is not None and limit is not None and rollover:
+            return with_rollover(self._next_daily_times, date, limit, after)
+        return self._next_daily_times(date, limit, after)
+
+    def _next_daily_times(self, date, limit, after):
+        if date is not None and timetable.is_enabled():
+            streams = next_times_from_index(list(self.stations.values_list('id', flat=True)), date, after).values()
+            merged = heapq.merge(*streams, key=lambda s: (s.time, s.id))
+            return list(islice(merged, limit))
+
+        ordering = 'time', 'id'
+        if date is None:
+            query = DailySchedule.objects.filter(station__location=self)
+        elif departures.is_enabled() and not self.uncovered_stations(date).exists():
+            query = DailySchedule.departing(date, date.strftime('%H:%M'), station__location=self)
+            ordering = 'departure__time', 'id'
+        else:
+            labels = calendar.resolve(self.stations.all(), date)
+            if not labels:
+                return DailySchedule.objects.none()
+
+            timestr = date.strftime('%H:%M')
+            stations_days = [models.Q(station_id=station_id, day=label) for station_id, label in labels.items()]
+            query = DailySchedule.objects.filter(reduce(or_, stations_days), time__gte=timestr)
+
+        if after is not None:
+            query = query.filter(DailySchedule.after(*after))
+
+        # the database merges the times of the stations,
+        # and the query is lazy, so that only the requested page or limit is fetched
+        query = query.order_by(*ordering)
+        if limit is not None:
+            query = query[:limit]
+        return query
 
-        return sorted(result, key=lambda x: x.time)
+    def uncovered_stations(self, date):
+        """
+        Return the stations without materialized departures on the day of the date
+        """
+        date = calendar.as_date(date)
+        return self.stations.exclude(departures_start__lte=date, departures_end__gt=date)
 
     def __str__(self):
         return '{} ({})'.format(self.name, ', '.join([str(x) for x in self.stations.all()]))
+
+
+@receiver([post_save, post_delete], sender=DailySchedule)
+def dailyschedule_changed(sender, instance, **kwargs):
+    signals.schedule_changed.send(sender=sender, station_ids=[instance.station_id])
+
+
+@receiver([post_save, post_delete], sender=GeneralSchedule)
+def generalschedule_changed(sender, instance, **kwargs):
+    signals.schedule_changed.send(sender=sender, station_ids=[instance.station_id])
+
+
+@receiver([post_save, post_delete], sender=TripStop)
+def tripstop_changed(sender, instance, **kwargs):
+    journeys.invalidate()
+
+
+@receiver([post_save, post_delete], sender=CalendarException)
+def calendarexception_changed(sender, instance, **kwargs):
+    # the times of the stations of the line change on the date
+    station_ids = list(Station.objects.filter(line_id=instance.line_id).values_list('id', flat=True))
+    signals.schedule_changed.send(sender=sender, station_ids=station_ids)
+
+
+@receiver(signals.schedule_changed)
+def increment_schedule_version(sender, station_ids, **kwargs):
+    Station.objects.filter(id__in=station_ids).update(schedule_version=models.F('schedule_version') + 1)
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent whenever the daily schedule of some stations changes,
+# including bulk operations that bypass the model signals.
+schedule_changed = Signal(providing_args=['station_ids'])
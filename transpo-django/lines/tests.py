@@ -1,11 +1,27 @@
+import csv
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zipfile
+from io import StringIO
+from unittest import mock
 from datetime import timedelta
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 from django.utils.datetime_safe import time, datetime
 from django.utils.timezone import get_current_timezone
-from lines.models import Line, Station, DailySchedule, Location
-from lines.utils import times_gte
+from lines import calendar, departures, export, journeys, timetable, timetable_file
+from lines.models import Line, Station, DailySchedule, GeneralSchedule, Location, CalendarException, ServiceDay, \
+    Departure, Trip, TripStop, related_fields
+from lines.utils import TimeIndex, batch_lookup, numpy, times_gte, table_scans
 
 
 def dayname(date):
@@ -61,6 +77,12 @@ class DailyTimesTestCase(TestCase):
             self._times(self.station.daily_times(self.next_weekday(1)))
         )
 
+    def test_find_daily_times_of_day_label(self):
+        query = self.station.dailyschedule_set.all()
+        self.assertEquals(self.saturday_times, self._times(self.station.find_daily_times(query, 'Sat')))
+        self.assertEquals(self.weekend_times, self._times(self.station.find_daily_times(query, 'Sun')))
+        self.assertEquals([], list(self.station.find_daily_times(query.filter(time__gte=time(20, 0)), 'Mon')))
+
     def test_times_on_saturday(self):
         self.assertEquals(self.saturday_times, self._times(self.station.daily_times(self.next_weekday(5))))
 
@@ -79,6 +101,26 @@ class DailyTimesTestCase(TestCase):
         times = self.weekday_times[-1:]
         self.assertEquals(times, self._times(self.station.next_daily_times(monday)))
 
+    def test_next_times_with_limit(self):
+        monday = self.next_weekday(0).replace(hour=17, minute=10)
+        self.assertEquals(self.weekday_times[1:3], self._times(self.station.next_daily_times(monday, limit=2)))
+
+    def test_next_times_with_limit_roll_over_midnight(self):
+        friday = self.next_weekday(4).replace(hour=18, minute=0)
+        times = self.station.next_daily_times(friday, limit=3)
+        self.assertEquals([time(18, 6), time(17, 6), time(9, 34)], self._times(times))
+        saturday = (friday + timedelta(1)).date()
+        sunday = saturday + timedelta(1)
+        self.assertEquals([friday.date(), saturday, sunday], [s.service_date for s in times])
+
+    def test_next_times_with_limit_stop_after_a_week(self):
+        monday = self.next_weekday(0)
+        self.assertEquals(4 * 6 + 1 + 3, len(self.station.next_daily_times(monday, limit=100)))
+
+    def test_next_times_with_limit_empty_station(self):
+        station = Station.objects.create(line=self.station.line, name='Stalingrad')
+        self.assertEquals([], station.next_daily_times(self.next_weekday(0), limit=1))
+
     def test_time_gte_all_for_min(self):
         times = [time(0, 0), time(5, 5), time(7, 7)]
         self.assertEquals(times, times_gte(times, time.min))
@@ -100,6 +142,687 @@ class DailyTimesTestCase(TestCase):
         self.assertEquals([], times_gte(times, time.max))
 
 
+class TimeIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.times = sorted(time(rng.randrange(24), rng.randrange(60)) for _ in range(200))
+        self.queries = [time(rng.randrange(24), rng.randrange(60)) for _ in range(100)] + [time.min, time.max]
+
+    def test_bisect_finds_same_times_as_filter(self):
+        index = TimeIndex(self.times)
+        index.array = None
+        self.assertEquals([[x for x in self.times if t <= x][:3] for t in self.queries],
+                          [times for _, times in index.lookup(self.queries, limit=3)])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_finds_same_indexes_as_bisect(self):
+        index = TimeIndex(self.times)
+        self.assertIsNotNone(index.array)
+        bisect_index = TimeIndex(self.times)
+        bisect_index.array = None
+        self.assertEquals(bisect_index.first_indexes(self.queries), index.first_indexes(self.queries))
+
+    def test_times_gte_of_unsorted_times(self):
+        times = self.queries[:50]
+        for t in self.queries:
+            self.assertEquals([x for x in times if x >= t], times_gte(times, t))
+
+    def test_batch_lookup_results_are_distinct(self):
+        result = batch_lookup({}, [(1, time.min), (2, time.min)])
+        result[0][1].append(time.max)
+        self.assertEquals((0, []), result[1])
+
+    def test_batch_lookup_keeps_order_of_queries(self):
+        station_times = {1: self.times, 2: self.times[::2]}
+
+        def next_times(times, t):
+            rest = [x for x in times if t <= x]
+            return len(times) - len(rest), rest[:2]
+
+        indexes = {station_id: TimeIndex(times) for station_id, times in station_times.items()}
+        queries = [(station_id, t) for t in self.queries for station_id in (2, 1, 3)]
+        self.assertEquals([next_times(station_times.get(station_id, []), t) for station_id, t in queries],
+                          batch_lookup(indexes, queries, limit=2))
+
+    def test_index_of_minutes(self):
+        index = TimeIndex([60, 120, 180])
+        self.assertEquals([0, 1, 3], index.first_indexes([0, 61, 181]))
+
+
+@override_settings(TRANSPO_TIMETABLE_INDEX=True)
+class TimetableIndexTestCase(DailyTimesTestCase):
+    def setUp(self):
+        timetable.invalidate()
+        super(TimetableIndexTestCase, self).setUp()
+
+    def test_loads_station_once(self):
+        monday = self.next_weekday(0)
+        # the check of the versions of the stations, and the times of the station
+        with self.assertNumQueries(2):
+            self.station.next_daily_times(monday)
+        with self.assertNumQueries(0):
+            self.assertEquals(self.weekday_times, self._times(self.station.next_daily_times(monday)))
+
+    def change_in_other_process(self):
+        # without the signals of this process, as another process would
+        DailySchedule.objects.bulk_create([DailySchedule(station=self.station, day=DailySchedule.MONDAY,
+                                                         time=time(8, 0))])
+        Station.objects.filter(pk=self.station.pk).update(schedule_version=F('schedule_version') + 1)
+
+    def test_change_in_other_process_found_by_check(self):
+        monday = self.next_weekday(0).replace(hour=0, minute=0)
+        self.station.next_daily_times(monday)
+        self.change_in_other_process()
+        self.assertEquals(self.weekday_times, self._times(self.station.next_daily_times(monday)))
+        with override_settings(TRANSPO_TIMETABLE_CHECK_SECONDS=0):
+            self.assertEquals([time(8, 0)], self._times(self.station.next_daily_times(monday)))
+
+    def test_registering_times_invalidates(self):
+        monday = self.next_weekday(0)
+        self.station.next_daily_times(monday)
+        self.station.register_daily_times([DailySchedule.MONDAY], [time(8, 0)])
+        self.assertEquals([time(8, 0)], self._times(self.station.next_daily_times(monday.replace(hour=0))))
+
+    def test_deleting_times_invalidates(self):
+        saturday = self.next_weekday(5)
+        self.station.next_daily_times(saturday)
+        self.station.dailyschedule_set.filter(day=DailySchedule.SATURDAY).delete()
+        self.assertEquals(self.weekend_times, self._times(self.station.daily_times(saturday)))
+
+
+class TimetableFileTestCase(TimetableIndexTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'timetable.bin')
+        settings = override_settings(TRANSPO_TIMETABLE_FILE=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(timetable.invalidate)
+        super(TimetableFileTestCase, self).setUp()
+        self.build()
+
+    def build(self):
+        out = StringIO()
+        call_command('timetable', stdout=out)
+        timetable.invalidate()
+        return out.getvalue()
+
+    def test_loads_station_once(self):
+        # only the check of the versions of the stations
+        with self.assertNumQueries(1):
+            times = self.station.next_daily_times(self.next_weekday(0))
+        self.assertEquals(self.weekday_times, self._times(times))
+        self.assertEquals([self.station.dailyschedule_set.get(day=DailySchedule.SATURDAY).id],
+                          [s.id for s in self.station.next_daily_times(self.next_weekday(5))])
+
+    def test_command_reports_counts(self):
+        self.assertEquals('built timetable of 1 stations, 8 times in {}\n'.format(self.path), self.build())
+
+    def test_packed_times_slices(self):
+        times = timetable_file.get(self.station.id).schedules[DailySchedule.WEEKDAYS]
+        self.assertEquals(self.weekday_times[1:3], self._times(times[1:3]))
+        self.assertEquals(self.weekday_times[-1], times[-1].time)
+        self.assertEquals([], list(times[3:1]))
+
+    def test_keeps_seconds(self):
+        self.station.register_daily_times([DailySchedule.MONDAY], [time(0, 30, 15)])
+        self.build()
+        monday = self.next_weekday(0).replace(hour=0, minute=0)
+        self.assertEquals([time(0, 30, 15)], self._times(self.station.next_daily_times(monday)))
+
+    def test_station_created_after_build(self):
+        station = Station.objects.create(line=self.station.line, name='Stalingrad')
+        station.register_daily_times([DailySchedule.DAILY], [time(12, 0)])
+        timetable.invalidate()
+        self.assertIsNone(timetable_file.get(station.id))
+        monday = self.next_weekday(0).replace(hour=0, minute=0)
+        self.assertEquals([time(12, 0)], self._times(station.next_daily_times(monday)))
+
+    def test_reopens_replaced_file(self):
+        first = timetable_file.current()
+        self.station.register_daily_times([DailySchedule.MONDAY], [time(8, 0)])
+        self.assertIsNone(timetable_file.get(self.station.id))
+        timetable_file.build(self.path)
+        timetable_file._checked_at = 0
+        self.assertIsNot(first, timetable_file.current())
+        self.assertEquals([time(8, 0)], self._times(timetable_file.get(self.station.id).next_times('Mon', time.min)))
+        # the times of the previous file remain readable
+        self.assertEquals(self.weekday_times, self._times(first.timetable(self.station.id).next_times('Mon', time.min)))
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as fh:
+            fh.write(b'\0' * timetable_file.HEADER_SIZE)
+        with self.assertRaises(ValueError):
+            timetable_file.TimetableFile(self.path)
+
+
+@override_settings(TRANSPO_SERVICE_CALENDAR=True)
+class ServiceCalendarTestCase(DailyTimesTestCase):
+    holiday_date = datetime(2016, 1, 18)
+    holiday_times = [time(10, 0)]
+
+    def setUp(self):
+        # the transaction of the test never commits, so recompile as soon as the schedule changes
+        patcher = mock.patch('django.db.transaction.on_commit', lambda func, using=None: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        calendar.pending_station_ids().clear()
+        super(ServiceCalendarTestCase, self).setUp()
+        self.holiday = CalendarException.objects.create(line=self.station.line, date=self.holiday_date.date(),
+                                                        name='Christmas')
+
+    def compile(self):
+        call_command('calendar', compile=True, start=self.holiday_date.date(), days=7, stdout=StringIO())
+
+    def test_holiday_runs_sunday_times(self):
+        self.assertEquals(self.weekend_times, self._times(self.station.next_daily_times(self.holiday_date)))
+
+    def test_holiday_runs_holiday_times(self):
+        self.station.register_daily_times([DailySchedule.HOLIDAY], self.holiday_times)
+        self.assertEquals(self.holiday_times, self._times(self.station.next_daily_times(self.holiday_date)))
+
+    def test_exception_runs_times_of_day(self):
+        self.holiday.day = DailySchedule.SATURDAY
+        self.holiday.save()
+        self.assertEquals(self.saturday_times, self._times(self.station.next_daily_times(self.holiday_date)))
+
+    def test_exception_without_service(self):
+        self.holiday.day = CalendarException.NO_SERVICE
+        self.holiday.save()
+        self.assertEquals([], self._times(self.station.next_daily_times(self.holiday_date)))
+
+    def test_other_dates_unaffected(self):
+        tuesday = self.holiday_date + timedelta(1)
+        self.assertEquals(self.weekday_times, self._times(self.station.next_daily_times(tuesday)))
+
+    def test_compiled_holiday_in_one_lookup(self):
+        self.station.register_daily_times([DailySchedule.HOLIDAY], self.holiday_times)
+        self.compile()
+        self.assertEquals(7, ServiceDay.objects.filter(station=self.station).count())
+        with self.assertNumQueries(2):
+            self.assertEquals(self.holiday_times, self._times(self.station.next_daily_times(self.holiday_date)))
+
+    def test_compiled_station_without_times(self):
+        station = Station.objects.create(line=self.station.line, name='Stalingrad')
+        self.compile()
+        self.assertEquals([''], list(station.serviceday_set.values_list('day', flat=True).distinct()))
+        self.assertEquals([], self._times(station.next_daily_times(self.holiday_date)))
+
+    def test_changing_times_recompiles_days(self):
+        other = Station.objects.create(line=Line.objects.create(name='R6'), name='Stalingrad')
+        self.compile()
+        other_days = list(other.serviceday_set.values_list('id', flat=True))
+        self.station.register_daily_times([DailySchedule.HOLIDAY], self.holiday_times)
+        self.assertEquals(7, ServiceDay.objects.filter(station=self.station).count())
+        self.assertEquals(other_days, list(other.serviceday_set.values_list('id', flat=True)))
+        with self.assertNumQueries(2):
+            self.assertEquals(self.holiday_times, self._times(self.station.next_daily_times(self.holiday_date)))
+
+    def test_changed_stations_recompiled_once_on_commit(self):
+        other = Station.objects.create(line=self.station.line, name='Stalingrad')
+        self.compile()
+        with mock.patch('django.db.transaction.on_commit') as on_commit:
+            self.station.line.register_trip(DailySchedule.HOLIDAY, [(self.station, time(10, 0)), (other, time(10, 5))])
+            # the compiled days of the changed stations are outdated until the commit
+            self.assertEquals(self.holiday_times, self._times(self.station.next_daily_times(self.holiday_date)))
+            self.assertEquals(DailySchedule.WEEKENDS, ServiceDay.objects.get(station=self.station,
+                                                                             date=self.holiday_date.date()).day)
+        with mock.patch('lines.calendar.compile_calendar', wraps=calendar.compile_calendar) as compile_calendar:
+            for call in on_commit.call_args_list:
+                call[0][0]()
+        compile_calendar.assert_called_once_with(self.holiday_date.date(), 7, [self.station.id, other.id], None)
+        self.assertEquals(DailySchedule.HOLIDAY, ServiceDay.objects.get(station=self.station,
+                                                                        date=self.holiday_date.date()).day)
+
+    def test_deleting_holiday_recompiles_days(self):
+        self.compile()
+        self.holiday.delete()
+        self.assertEquals(DailySchedule.WEEKDAYS, ServiceDay.objects.get(station=self.station,
+                                                                         date=self.holiday_date.date()).day)
+        self.assertEquals(self.weekday_times, self._times(self.station.next_daily_times(self.holiday_date)))
+
+    def test_calendar_command_adds_holidays(self):
+        tuesday = self.holiday_date.date() + timedelta(1)
+        call_command('calendar', add=[tuesday], day=DailySchedule.SATURDAY, stdout=StringIO())
+        times = self.station.next_daily_times(self.holiday_date + timedelta(1))
+        self.assertEquals(self.saturday_times, self._times(times))
+
+    @override_settings(TRANSPO_SERVICE_CALENDAR=False)
+    def test_holidays_ignored_when_disabled(self):
+        self.assertEquals(self.weekday_times, self._times(self.station.next_daily_times(self.holiday_date)))
+
+    @override_settings(TRANSPO_TIMETABLE_INDEX=True)
+    def test_holiday_from_timetable_index(self):
+        timetable.invalidate()
+        self.addCleanup(timetable.invalidate)
+        self.compile()
+        self.station.next_daily_times(self.holiday_date)
+        with self.assertNumQueries(1):
+            times = self.station.next_daily_times(self.holiday_date)
+        self.assertEquals(self.weekend_times, self._times(times))
+
+
+@override_settings(TRANSPO_DEPARTURES=True)
+class DeparturesTestCase(DailyTimesTestCase):
+    window_start = datetime(2016, 1, 9).date()
+
+    def setUp(self):
+        super(DeparturesTestCase, self).setUp()
+        # the transaction of the test never commits, so rebuild as soon as the schedule changes
+        patcher = mock.patch('django.db.transaction.on_commit', lambda func, using=None: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        call_command('departures', start=self.window_start, days=14, stdout=StringIO())
+        self.station.refresh_from_db()
+
+    def test_builds_departures_of_window(self):
+        self.assertEquals((self.window_start, self.window_start + timedelta(14)),
+                          (self.station.departures_start, self.station.departures_end))
+        # 2 Saturdays, 2 Sundays and 10 weekdays
+        self.assertEquals(2 * 1 + 2 * 3 + 10 * 4, Departure.objects.filter(station=self.station).count())
+
+    def test_reads_departures_in_one_query(self):
+        with self.assertNumQueries(1):
+            times = list(self.station.next_daily_times(self.weekday_date.replace(hour=17, minute=10)))
+        self.assertEquals(self.weekday_times[1:], self._times(times))
+
+    def test_registering_times_rebuilds_station(self):
+        self.station.register_daily_times([DailySchedule.MONDAY], [time(8, 0)])
+        self.station.refresh_from_db()
+        self.assertEquals([time(8, 0)], self._times(self.station.next_daily_times(self.weekday_date)))
+        self.assertEquals(2, Departure.objects.filter(station=self.station, time=time(8, 0)).count())
+
+    def test_general_schedule_is_not_materialized(self):
+        self.station.register_dates([timezone.make_aware(datetime(2016, 1, 12, 7, 30))])
+        self.assertEquals(set(self.station.dailyschedule_set.values_list('id', flat=True)),
+                          set(self.station.departure_set.values_list('schedule_id', flat=True)))
+
+    @override_settings(TRANSPO_SERVICE_CALENDAR=True)
+    def test_holiday_departures(self):
+        holiday = self.weekday_date.date() + timedelta(1)
+        CalendarException.objects.create(line=self.station.line, date=holiday)
+        self.station.refresh_from_db()
+        self.assertEquals(self.weekend_times, self._times(self.station.next_daily_times(holiday)))
+
+    def test_batch_times_from_departures(self):
+        station = Station.objects.create(line=self.station.line, name='Stalingrad')
+        station.register_daily_times([DailySchedule.DAILY], [time(17, 16)])
+        result = Station.next_daily_times_by_station([self.station.id, station.id], self.weekday_date, limit=2)
+        self.assertEquals(self.weekday_times[:2], self._times(result[self.station.id]))
+        self.assertEquals([time(17, 16)] * 2, self._times(result[station.id]))
+
+    def test_location_times_from_departures(self):
+        location = Location.objects.create(user=User.objects.create(), name='Work')
+        location.stations.add(self.station)
+        with self.assertNumQueries(2):
+            times = list(location.next_daily_times(self.weekday_date, limit=2, rollover=False))
+        self.assertEquals(self.weekday_times[:2], self._times(times))
+        self.assertFalse(location.uncovered_stations(self.weekday_date).exists())
+        self.assertTrue(location.uncovered_stations(self.window_start - timedelta(1)).exists())
+
+    @override_settings(TRANSPO_DEPARTURES=False)
+    def test_departures_ignored_when_disabled(self):
+        self.station.dailyschedule_set.filter(day=DailySchedule.SATURDAY).delete()
+        Departure.objects.all().delete()
+        self.assertEquals(self.weekday_times, self._times(self.station.next_daily_times(self.weekday_date)))
+        self.assertTrue(departures.covers(self.station, self.weekday_date))
+
+
+@override_settings(TRANSPO_DEPARTURES=True)
+class DeferredDeparturesTestCase(TransactionTestCase):
+    window_start = datetime(2016, 1, 9).date()
+
+    def setUp(self):
+        self.line = Line.objects.create(name='R5')
+        self.station = Station.objects.create(line=self.line, name='Jaures')
+        call_command('departures', start=self.window_start, days=7, stdout=StringIO())
+
+    def test_rebuilds_station_once_on_commit(self):
+        with mock.patch('lines.departures.rebuild_station', wraps=departures.rebuild_station) as rebuild:
+            with transaction.atomic():
+                self.line.register_trip(DailySchedule.MONDAY, [(self.station, time(8, 0)), (self.station, time(9, 0))])
+                self.station.register_daily_times([DailySchedule.MONDAY], [time(10, 0)])
+                self.assertEquals(0, rebuild.call_count)
+        rebuild.assert_called_once_with(self.station.id, self.window_start, 7)
+        self.assertEquals(3, Departure.objects.filter(station=self.station).count())
+
+    def test_rebuilds_after_rollback(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.station.register_daily_times([DailySchedule.MONDAY], [time(8, 0)])
+                raise ValueError
+        self.station.register_daily_times([DailySchedule.MONDAY], [time(9, 0)])
+        self.assertEquals([time(9, 0)], list(Departure.objects.filter(station=self.station).values_list(
+            'time', flat=True)))
+
+
+class BulkRegisterTestCase(TestCase):
+    def setUp(self):
+        line = Line.objects.create(name='R5')
+        self.station = Station.objects.create(line=line, name='Jaures')
+
+    def write_file(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_bulk_register_in_batches(self):
+        day_times = [(DailySchedule.WEEKDAYS, time(h, m)) for h in range(24) for m in range(0, 60, 10)]
+        with self.assertNumQueries(2 + 15 + 1):
+            count = self.station.bulk_register_daily_times(day_times, batch_size=10)
+        self.assertEquals(len(day_times), count)
+        self.assertEquals(len(day_times), self.station.dailyschedule_set.count())
+
+    def test_sync_creates_and_deletes_only_differences(self):
+        self.station.register_daily_times(['Sat'], [time(8, 10), time(9, 10), time(9, 10)])
+        self.station.register_daily_times([DailySchedule.WEEKDAYS], [time(7, 10)])
+        kept = self.station.dailyschedule_set.get(day='Sat', time=time(8, 10)).id
+        version = Station.objects.get(pk=self.station.pk).schedule_version
+
+        created, deleted = self.station.sync_daily_times([('Sat', time(8, 10)), ('Sat', time(9, 10)),
+                                                          ('Sun', time(10, 10))])
+        self.assertEquals((1, 2), (created, deleted))
+        expected = [('Sat', time(8, 10)), ('Sat', time(9, 10)), ('Sun', time(10, 10))]
+        self.assertEquals(expected, list(self.station.dailyschedule_set.order_by('day', 'time').values_list(
+            'day', 'time')))
+        self.assertTrue(self.station.dailyschedule_set.filter(id=kept).exists())
+        self.assertEquals(version + 1, Station.objects.get(pk=self.station.pk).schedule_version)
+
+    def test_sync_without_differences_changes_nothing(self):
+        self.station.register_daily_times(['Sat'], [time(8, 10)])
+        version = Station.objects.get(pk=self.station.pk).schedule_version
+        self.assertEquals((0, 0), self.station.sync_daily_times([('Sat', time(8, 10))]))
+        self.assertEquals(version, Station.objects.get(pk=self.station.pk).schedule_version)
+
+    def test_sync_of_days_keeps_other_days(self):
+        self.station.register_daily_times(['Sat', 'Sun'], [time(8, 10)])
+        self.assertEquals((1, 1), self.station.sync_daily_times([('Sat', time(9, 10))], days=['Sat']))
+        self.assertEquals([('Sat', time(9, 10)), ('Sun', time(8, 10))],
+                          list(self.station.dailyschedule_set.order_by('day').values_list('day', 'time')))
+        with self.assertRaises(ValueError):
+            self.station.sync_daily_times([('Sun', time(9, 10))], days=['Sat'])
+
+    def test_delete_times_with_their_trip_stops(self):
+        self.station.register_daily_times(['Sat'], [time(9, 10)])
+        self.station.line.register_trip('Sat', [(self.station, time(8, 10))])
+        self.assertEquals(1, self.station.delete_daily_times([('Sat', time(8, 10)), ('Sun', time(9, 10))]))
+        self.assertEquals([time(9, 10)], [s.time for s in self.station.dailyschedule_set.all()])
+        self.assertFalse(TripStop.objects.exists())
+
+    def test_delete_times_with_their_departures(self):
+        self.station.register_daily_times(['Sat'], [time(8, 10)])
+        Departure.objects.create(station=self.station, service_date=datetime(2016, 1, 9).date(), time=time(8, 10),
+                                 schedule=self.station.dailyschedule_set.get())
+        self.assertEquals(1, self.station.delete_daily_times([('Sat', time(8, 10))]))
+        self.assertFalse(Departure.objects.exists())
+
+    def test_bulk_delete_knows_the_models_referring_to_times(self):
+        # the rows of a new model referring to daily schedules must be deleted with them, or set to null
+        self.assertEquals({(Departure, 'schedule'), (TripStop, 'schedule')},
+                          {(field.model, field.name) for field in related_fields(DailySchedule)})
+
+    def test_sync_in_constant_queries(self):
+        day_times = [(DailySchedule.WEEKDAYS, time(h, m)) for h in range(24) for m in range(0, 60, 10)]
+        self.station.sync_daily_times(day_times[:100])
+        # one query of the times, a batch of deletes and a batch of inserts, and the signals of the change
+        with self.assertNumQueries(12):
+            self.station.sync_daily_times(day_times[50:], batch_size=100)
+
+    def test_times_command_creates_from_csv(self):
+        path = self.write_file('.csv', 'day,time\nweekdays,07:10\n\n# comment\nSat,08:10:30\n')
+        call_command('times', str(self.station.id), file=path, stdout=StringIO())
+        expected = [('Sat', time(8, 10, 30)), ('weekdays', time(7, 10))]
+        self.assertEquals(expected, list(self.station.dailyschedule_set.order_by('day').values_list('day', 'time')))
+
+    def test_times_command_creates_from_tsv(self):
+        path = self.write_file('.tsv', 'Sun\t09:34\nSun\t10:34\n')
+        call_command('times', str(self.station.id), file=path, stdout=StringIO())
+        self.assertEquals(2, self.station.dailyschedule_set.filter(day='Sun').count())
+
+    def test_times_command_syncs_from_file(self):
+        self.station.register_daily_times(['Sun'], [time(9, 34), time(11, 34)])
+        self.station.register_daily_times(['Sat'], [time(9, 34)])
+        kept = self.station.dailyschedule_set.get(day='Sun', time=time(9, 34)).id
+        path = self.write_file('.csv', 'Sun,09:34\nSun,10:34\n')
+        stdout = StringIO()
+        call_command('times', str(self.station.id), sync=path, days=['Sun'], stdout=stdout)
+        self.assertEquals('created 1 times, deleted 1 times, unchanged 1 times\n', stdout.getvalue())
+        self.assertEquals([('Sat', time(9, 34)), ('Sun', time(9, 34)), ('Sun', time(10, 34))],
+                          list(self.station.dailyschedule_set.order_by('day', 'time').values_list('day', 'time')))
+        self.assertTrue(self.station.dailyschedule_set.filter(id=kept).exists())
+
+    def test_times_command_sync_rejects_other_days(self):
+        path = self.write_file('.csv', 'Sat,09:34\n')
+        with self.assertRaises(CommandError):
+            call_command('times', str(self.station.id), sync=path, days=['Sun'], stdout=StringIO())
+        self.assertEquals(0, self.station.dailyschedule_set.count())
+
+    def test_times_command_rejects_malformed_rows_atomically(self):
+        path = self.write_file('.csv', 'Sun,09:34\nSun,malformed\n')
+        with self.assertRaises(CommandError):
+            call_command('times', str(self.station.id), file=path, stdout=StringIO())
+        self.assertEquals(0, self.station.dailyschedule_set.count())
+
+
+class GtfsImportTestCase(TestCase):
+    feed = {
+        'routes.txt': 'route_id,route_short_name,route_long_name\nr1,R5,\n',
+        'stops.txt': 'stop_id,stop_name\ns1,Jaures\ns2,Stalingrad\n',
+        'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday\n'
+                        'wk,1,1,1,1,1,0,0\nsat,0,0,0,0,0,1,0\n',
+        'trips.txt': 'route_id,service_id,trip_id\nr1,wk,t1\nr1,sat,t2\nr1,wk,t3\n',
+        'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                          't1,17:06:00,17:06:00,s1,1\nt1,17:10:00,17:11:00,s2,2\n'
+                          't2,09:34:00,09:34:00,s1,1\n'
+                          't3,24:30:00,24:30:00,s1,1\n',
+    }
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        with zipfile.ZipFile(self.path, 'w') as feed:
+            for name, content in self.feed.items():
+                feed.writestr(name, content)
+        call_command('gtfs', self.path, stdout=StringIO())
+        self.jaures = Station.objects.get(name='Jaures')
+
+    def _times(self, times):
+        return [s.time for s in times]
+
+    def next_weekday(self, weekday):
+        d = timezone.now().replace(hour=0, minute=0)
+        return d + timedelta((weekday - d.weekday()) % 7)
+
+    def test_creates_lines_and_stations(self):
+        self.assertEquals(['R5'], [line.name for line in Line.objects.all()])
+        self.assertEquals({'Jaures', 'Stalingrad'}, {station.name for station in Station.objects.all()})
+
+    def test_failed_import_creates_nothing(self):
+        # a stop time of an unknown trip fails the import after the lines and stations were created
+        files = dict(self.feed, **{'stop_times.txt': self.feed['stop_times.txt'] + 't4,10:00:00,10:00:00,s1,1\n'})
+        with zipfile.ZipFile(self.path, 'w') as feed:
+            for name, content in files.items():
+                feed.writestr(name, content)
+        with self.assertRaises(KeyError):
+            call_command('gtfs', self.path, stdout=StringIO())
+        self.assertEquals(1, Line.objects.count())
+        self.assertEquals(2, Station.objects.count())
+
+    def test_uses_departure_times(self):
+        stalingrad = Station.objects.get(name='Stalingrad')
+        self.assertEquals([time(17, 11)], self._times(stalingrad.next_daily_times(self.next_weekday(0))))
+
+    def test_times_after_midnight_run_on_next_day(self):
+        self.assertEquals([time(17, 6)], self._times(self.jaures.next_daily_times(self.next_weekday(0))))
+        self.assertEquals([time(0, 30), time(17, 6)], self._times(self.jaures.next_daily_times(self.next_weekday(1))))
+        self.assertEquals([time(0, 30), time(9, 34)], self._times(self.jaures.next_daily_times(self.next_weekday(5))))
+        self.assertEquals([], self._times(self.jaures.next_daily_times(self.next_weekday(6))))
+
+    def test_shares_labels_of_days_with_same_services(self):
+        stalingrad = Station.objects.get(name='Stalingrad')
+        self.assertEquals([DailySchedule.WEEKDAYS], [s.day for s in stalingrad.dailyschedule_set.all()])
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.line = Line.objects.create(name='R5')
+        self.jaures = Station.objects.create(line=self.line, name='Jaures')
+        self.jaures.register_daily_times([DailySchedule.WEEKDAYS], [time(17, 6), time(17, 26)])
+        self.jaures.register_daily_times([DailySchedule.SATURDAY], [time(9, 34)])
+        self.jaures.register_daily_times([DailySchedule.HOLIDAY], [time(10, 0)])
+        self.stalingrad = Station.objects.create(line=self.line, name='Stalingrad')
+        self.stalingrad.register_daily_times([DailySchedule.DAILY], [time(17, 16)])
+        self.date = timezone.make_aware(datetime(2016, 1, 19, 9, 41))
+        self.stalingrad.register_dates([self.date])
+        self.other = Station.objects.create(line=Line.objects.create(name='M6'), name='Nation')
+
+        self.location = Location.objects.create(user=User.objects.create(), name='Work')
+        self.location.stations.add(self.jaures, self.other)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def export(self, **options):
+        out = StringIO()
+        call_command('export', stdout=out, **options)
+        return out.getvalue()
+
+    def test_iterates_in_chunks(self):
+        with self.assertNumQueries(3):
+            rows = list(export.iter_rows(DailySchedule.objects.all(), ('time',), chunk_size=2))
+        self.assertEquals([time(17, 6), time(17, 26), time(9, 34), time(10, 0), time(17, 16)], [t for t, in rows])
+
+    def test_jsonl(self):
+        rows = [json.loads(line) for line in self.export().splitlines()]
+        self.assertEquals({'lines': 2, 'stations': 3, 'daily_schedules': 5, 'dated_schedules': 1, 'locations': 1},
+                          {table: len([row for row in rows if row['table'] == table]) for table in export.TABLES})
+        self.assertIn({'table': 'daily_schedules', 'id': self.jaures.dailyschedule_set.first().id,
+                       'station_id': self.jaures.id, 'day': DailySchedule.WEEKDAYS, 'time': '17:06:00'}, rows)
+        self.assertIn({'table': 'locations', 'id': self.location.id, 'user_id': self.location.user_id,
+                       'name': 'Work', 'station_ids': [self.jaures.id, self.other.id]}, rows)
+
+    def test_csv_of_line(self):
+        self.export(format='csv', output=self.directory, lines=[self.line.id])
+        with open(os.path.join(self.directory, 'stations.csv')) as fh:
+            self.assertEquals([['id', 'line_id', 'name'], [str(self.jaures.id), str(self.line.id), 'Jaures'],
+                               [str(self.stalingrad.id), str(self.line.id), 'Stalingrad']], list(csv.reader(fh)))
+        with open(os.path.join(self.directory, 'locations.csv')) as fh:
+            self.assertEquals([str(self.jaures.id)], [row['station_ids'] for row in csv.DictReader(fh)])
+
+    def test_csv_of_station_to_stdout(self):
+        out = self.export(format='csv', tables=['dated_schedules'], stations=[self.stalingrad.id])
+        self.assertEquals('id,station_id,date\n{},{},{}\n'.format(
+            self.stalingrad.generalschedule_set.get().id, self.stalingrad.id, self.date.isoformat()), out)
+        with self.assertRaises(CommandError):
+            self.export(format='csv')
+
+    def test_gtfs_imports_same_times(self):
+        holiday = datetime(2016, 1, 18).date()
+        CalendarException.objects.create(line=self.line, date=holiday)
+        path = os.path.join(self.directory, 'feed.zip')
+        with self.assertRaises(CommandError):
+            self.export(format='gtfs', output=path)
+        self.export(format='gtfs', output=path, lines=[self.line.id], start=holiday, agency_url='https://example.com')
+
+        with zipfile.ZipFile(path) as feed:
+            calendar_dates = feed.read('calendar_dates.txt').decode().splitlines()
+        self.assertIn('{}-weekdays,20160118,2'.format(self.jaures.id), calendar_dates)
+        self.assertIn('{}-holiday,20160118,1'.format(self.jaures.id), calendar_dates)
+
+        Line.objects.all().delete()
+        call_command('gtfs', path, stdout=StringIO())
+        jaures = Station.objects.get(name='Jaures')
+        self.assertEquals({(DailySchedule.WEEKDAYS, time(17, 6)), (DailySchedule.WEEKDAYS, time(17, 26)),
+                           (DailySchedule.SATURDAY, time(9, 34))},
+                          set(jaures.dailyschedule_set.values_list('day', 'time')))
+        self.assertEquals([(DailySchedule.DAILY, time(17, 16))],
+                          list(Station.objects.get(name='Stalingrad').dailyschedule_set.values_list('day', 'time')))
+
+    def test_stations_times_in_two_queries(self):
+        out = StringIO()
+        with self.assertNumQueries(2):
+            call_command('stations', times=True, stdout=out)
+        self.assertIn('  (weekdays) 17:06', out.getvalue())
+
+
+class JourneyTestCase(TestCase):
+    date = datetime(2016, 1, 11)
+
+    def setUp(self):
+        journeys.invalidate()
+        self.line1 = Line.objects.create(name='line1')
+        self.line2 = Line.objects.create(name='line2')
+        self.a, self.b, self.c = [Station.objects.create(line=self.line1, name=name) for name in 'ABC']
+        self.b2, self.d = [Station.objects.create(line=self.line2, name=name) for name in 'BD']
+
+        self.slow = self.line1.register_trip(DailySchedule.WEEKDAYS, [(self.a, time(8, 0)), (self.c, time(9, 0))])
+        self.first = self.line1.register_trip(DailySchedule.WEEKDAYS, [
+            (self.a, time(8, 5)), (self.b, time(8, 10)), (self.c, time(8, 20))])
+        self.second = self.line2.register_trip(DailySchedule.WEEKDAYS, [(self.b2, time(8, 11)), (self.d, time(8, 30))])
+        self.third = self.line2.register_trip(DailySchedule.WEEKDAYS, [(self.b2, time(8, 15)), (self.d, time(8, 40))])
+
+    def _legs(self, legs):
+        return [(leg.trip_id, leg.from_station_id, timezone.localtime(leg.departure).time(),
+                 leg.to_station_id, timezone.localtime(leg.arrival).time()) for leg in legs]
+
+    def test_earliest_arrival_on_one_line(self):
+        legs = journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=7))
+        self.assertEquals([(self.first.id, self.a.id, time(8, 5), self.c.id, time(8, 20))], self._legs(legs))
+
+    def test_transfers_between_stations_with_same_name(self):
+        # the trip of 8:11 leaves before the transfer from the trip arriving at 8:10
+        legs = journeys.find_journey(self.a.id, self.d.id, self.date.replace(hour=7))
+        self.assertEquals([(self.first.id, self.a.id, time(8, 5), self.b.id, time(8, 10)),
+                           (self.third.id, self.b2.id, time(8, 15), self.d.id, time(8, 40))], self._legs(legs))
+
+    @override_settings(TRANSPO_JOURNEY_TRANSFER_MINUTES=0)
+    def test_transfer_time(self):
+        legs = journeys.find_journey(self.a.id, self.d.id, self.date.replace(hour=7))
+        self.assertEquals([self.first.id, self.second.id], [leg.trip_id for leg in legs])
+
+    def test_no_journey_after_last_trip(self):
+        self.assertIsNone(journeys.find_journey(self.a.id, self.d.id, self.date.replace(hour=8, minute=6)))
+
+    def test_no_journey_on_other_days(self):
+        self.assertIsNone(journeys.find_journey(self.a.id, self.c.id, datetime(2016, 1, 10, 7)))
+
+    def test_trip_past_midnight(self):
+        trip = self.line1.register_trip(DailySchedule.WEEKDAYS, [(self.a, time(23, 50)), (self.c, time(0, 10))])
+        legs = journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=23))
+        self.assertEquals([trip.id], [leg.trip_id for leg in legs])
+        self.assertEquals(self.date.date() + timedelta(1), timezone.localtime(legs[0].arrival).date())
+
+    def test_rebuilt_after_trip_registered(self):
+        self.assertIsNone(journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=10)))
+        trip = self.line1.register_trip(DailySchedule.WEEKDAYS, [(self.a, time(11, 0)), (self.c, time(11, 30))])
+        legs = journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=10))
+        self.assertEquals([trip.id], [leg.trip_id for leg in legs])
+
+    def test_scans_connections_once_built(self):
+        journeys.find_journey(self.a.id, self.d.id, self.date.replace(hour=7))
+        with self.assertNumQueries(0):
+            journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=7))
+
+    def test_change_in_other_process_found_by_check(self):
+        self.assertIsNone(journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=10)))
+        # without the signals of this process, as another process would
+        trip = Trip.objects.create(line=self.line1)
+        DailySchedule.objects.bulk_create([DailySchedule(station=station, day=DailySchedule.WEEKDAYS, time=t)
+                                           for station, t in ((self.a, time(11, 0)), (self.c, time(11, 30)))])
+        schedules = DailySchedule.objects.filter(time__gte=time(11, 0)).order_by('time')
+        TripStop.objects.bulk_create([TripStop(trip=trip, sequence=sequence, schedule=schedule)
+                                      for sequence, schedule in enumerate(schedules)])
+        Station.objects.filter(pk__in=[self.a.pk, self.c.pk]).update(schedule_version=F('schedule_version') + 1)
+        self.assertIsNone(journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=10)))
+        with override_settings(TRANSPO_JOURNEY_CHECK_SECONDS=0):
+            legs = journeys.find_journey(self.a.id, self.c.id, self.date.replace(hour=10))
+        self.assertEquals([trip.id], [leg.trip_id for leg in legs])
+
+
 class GeneralScheduleTestCase(TestCase):
     def test_nonempty_dates(self):
         dates = [datetime(2016, 1, 19, 9, 41, tzinfo=get_current_timezone())]
@@ -115,6 +838,43 @@ class GeneralScheduleTestCase(TestCase):
         station.register_dates(dates=dates)
         self.assertEquals(dates, station.dates())
 
+    def test_every_write_changes_schedule_version(self):
+        line = Line.objects.create(name='TGV 6911')
+        station = Station.objects.create(line=line, name='Paris-Gare-de-Lyon')
+        station.register_dates([datetime(2016, 1, 19, 9, 41, tzinfo=get_current_timezone())])
+        schedule = GeneralSchedule.objects.create(station=station,
+                                                  date=datetime(2016, 1, 20, 9, 41, tzinfo=get_current_timezone()))
+        schedule.delete()
+        station.refresh_from_db()
+        self.assertEquals(3, station.schedule_version)
+
+    def create_station_with_dates(self):
+        start = datetime(2016, 1, 19, 9, 41, tzinfo=get_current_timezone())
+        dates = [start + timedelta(days) for days in range(10)]
+        line = Line.objects.create(name='TGV 6911')
+        station = Station.objects.create(line=line, name='Paris-Gare-de-Lyon')
+        station.register_dates(dates=reversed(dates))
+        return station, dates
+
+    def test_dates_in_range(self):
+        station, dates = self.create_station_with_dates()
+        self.assertEquals(dates[2:5], station.dates(dates[2], dates[5]))
+
+    def test_dates_with_limit(self):
+        station, dates = self.create_station_with_dates()
+        with self.assertNumQueries(1):
+            self.assertEquals(dates[3:5], station.dates(start=dates[3], limit=2))
+
+    def test_iter_dates_in_chunks(self):
+        station, dates = self.create_station_with_dates()
+        with self.assertNumQueries(4):
+            self.assertEquals(dates, list(station.iter_dates(chunk_size=3)))
+
+    def test_iter_dates_with_same_date(self):
+        station, dates = self.create_station_with_dates()
+        station.register_dates(dates[:1])
+        self.assertEquals(dates[:1] * 2 + dates[1:], list(station.iter_dates(chunk_size=1)))
+
 
 class LocationTestCase(TestCase):
     def setUp(self):
@@ -187,3 +947,135 @@ class LocationTestCase(TestCase):
             (self.line2, time(18, 6)),
         ]
         self.assertEquals(expected, times)
+
+    def test_combined_times_with_limit(self):
+        date = timezone.now().replace(hour=17, minute=20)
+        day = dayname(date)
+
+        self.station1.register_daily_times([day], [time(17, 1), time(17, 11), time(17, 21), time(17, 31)])
+        self.station2.register_daily_times([day], [time(17, 6), time(17, 26), time(17, 46), time(18, 6)])
+
+        times = self._linetimes(self.location.next_daily_times(date, limit=2))
+
+        expected = [
+            (self.line1, time(17, 21)),
+            (self.line2, time(17, 26)),
+        ]
+        self.assertEquals(expected, times)
+
+    def test_combined_times_with_limit_roll_over_midnight(self):
+        date = self.next_weekday_date(0).replace(hour=17, minute=30)
+
+        self.station1.register_daily_times([DailySchedule.MONDAY], [time(17, 1), time(17, 31)])
+        self.station1.register_daily_times([DailySchedule.TUESDAY], [time(6, 1)])
+        self.station2.register_daily_times([DailySchedule.WEEKDAYS], [time(5, 46)])
+
+        times = self.location.next_daily_times(date, limit=3)
+
+        expected = [
+            (self.line1, time(17, 31)),
+            (self.line2, time(5, 46)),
+            (self.line1, time(6, 1)),
+        ]
+        self.assertEquals(expected, self._linetimes(times))
+        tuesday = (date + timedelta(1)).date()
+        self.assertEquals([date.date(), tuesday, tuesday], [s.service_date for s in times])
+
+    def test_combined_times_resolve_days_per_station(self):
+        date = self.next_weekday_date(0)
+
+        self.station1.register_daily_times([DailySchedule.WEEKDAYS], [time(8, 1), time(9, 1)])
+        self.station1.register_daily_times([DailySchedule.DAILY], [time(8, 2)])
+        self.station2.register_daily_times([DailySchedule.DAILY], [time(8, 3), time(9, 3)])
+
+        times = self._linetimes(self.location.next_daily_times(date))
+
+        expected = [
+            (self.line1, time(8, 1)),
+            (self.line2, time(8, 3)),
+            (self.line1, time(9, 1)),
+            (self.line2, time(9, 3)),
+        ]
+        self.assertEquals(expected, times)
+
+    def test_combined_times_with_two_queries(self):
+        date = timezone.now().replace(hour=0, minute=0)
+        day = dayname(date)
+
+        self.station1.register_daily_times([day], [time(17, 1), time(17, 11)])
+        self.station2.register_daily_times([DailySchedule.DAILY], [time(17, 6), time(17, 26)])
+
+        with self.assertNumQueries(2):
+            self.assertEquals(4, len(list(self.location.next_daily_times(date))))
+
+    @staticmethod
+    def next_weekday_date(weekday):
+        d = timezone.now().replace(hour=0, minute=0)
+        return d + timedelta((weekday - d.weekday()) % 7)
+
+
+@override_settings(TRANSPO_TIMETABLE_INDEX=True)
+class LocationTimetableIndexTestCase(LocationTestCase):
+    def setUp(self):
+        timetable.invalidate()
+        super(LocationTimetableIndexTestCase, self).setUp()
+
+    def test_combined_times_with_two_queries(self):
+        date = timezone.now().replace(hour=0, minute=0)
+        day = dayname(date)
+
+        self.station1.register_daily_times([day], [time(17, 1), time(17, 11)])
+        self.station2.register_daily_times([DailySchedule.DAILY], [time(17, 6), time(17, 26)])
+        self.location.next_daily_times(date)
+
+        # only the stations of the location are queried, the times are in the index
+        with self.assertNumQueries(1):
+            self.assertEquals(4, len(self.location.next_daily_times(date)))
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    Check that the queries of the models use the indexes of the schedule tables
+    """
+    def setUp(self):
+        line = Line.objects.create(name='R5')
+        self.station1 = Station.objects.create(line=line, name='Jaures')
+        self.station2 = Station.objects.create(line=line, name='Stalingrad')
+        self.station1.register_daily_times([DailySchedule.WEEKDAYS], [time(17, 6), time(17, 26)])
+        self.station2.register_daily_times([DailySchedule.DAILY], [time(17, 16), time(17, 36)])
+        self.station1.register_dates([timezone.now()])
+
+        self.location = Location.objects.create(user=User.objects.create(), name='Work')
+        self.location.stations.add(self.station1, self.station2)
+
+        self.date = datetime(2016, 1, 11, 17, 10)
+
+    def assertNoTableScans(self, queryset):
+        self.assertEquals([], table_scans(queryset))
+
+    def test_find_daily_times(self):
+        self.assertNoTableScans(self.station1.dailyschedule_set.filter(day=DailySchedule.MONDAY))
+
+    def test_station_next_daily_times(self):
+        self.assertNoTableScans(self.station1.next_daily_times(self.date))
+
+    def test_station_all_daily_times(self):
+        self.assertNoTableScans(self.station1.next_daily_times())
+
+    def test_resolve_day_labels(self):
+        labels = DailySchedule.day_labels(DailySchedule.MONDAY)
+        query = DailySchedule.objects.filter(station_id__in=[self.station1.id, self.station2.id], day__in=labels)
+        self.assertNoTableScans(query.values_list('station_id', 'day').distinct())
+
+    def test_location_next_daily_times(self):
+        self.assertNoTableScans(self.location.next_daily_times(self.date))
+
+    def test_times_command_filters(self):
+        query = self.station1.dailyschedule_set.filter(day__in=[DailySchedule.WEEKDAYS], time__in=['17:06'])
+        self.assertNoTableScans(query)
+
+    def test_dates(self):
+        self.assertNoTableScans(GeneralSchedule.objects.filter(station=self.station1).order_by('date'))
+
+    def test_detects_table_scans(self):
+        self.assertEquals(['lines_dailyschedule'], table_scans(DailySchedule.objects.filter(time='17:06')))
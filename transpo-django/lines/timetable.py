@@ -0,0 +1,201 @@
+"""
+Compiled in-memory timetables of stations.
+
+When the TRANSPO_TIMETABLE_INDEX setting is enabled, the daily schedule
+of a station is loaded once into sorted arrays per day label,
+and next departures are found with a binary search,
+instead of querying the database on every call.
+With the TRANSPO_TIMETABLE_FILE setting, the timetables are read from a file shared by all processes,
+see timetable_file.
+
+A change of schedule in this process drops the timetables of its stations at once.
+Changes made by other processes are found by comparing the schedule version of each timetable
+with the versions of all stations, read with a single query at most every TRANSPO_TIMETABLE_CHECK_SECONDS.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from lines.signals import schedule_changed
+
+
+def is_enabled():
+    return getattr(settings, 'TRANSPO_TIMETABLE_INDEX', False)
+
+
+def check_seconds():
+    return getattr(settings, 'TRANSPO_TIMETABLE_CHECK_SECONDS', 5)
+
+
+def to_minutes(t):
+    # a plain date stands for the start of the day, as in the ORM queries
+    return getattr(t, 'hour', 0) * 60 + getattr(t, 'minute', 0)
+
+
+class StationTimetable(object):
+    def __init__(self, schedules):
+        buckets = defaultdict(list)
+        for schedule in schedules:
+            buckets[schedule.day].append(schedule)
+
+        self.schedules = {}
+        self.minutes = {}
+        for day, items in buckets.items():
+            items.sort(key=lambda s: (s.time, s.id))
+            self.schedules[day] = items
+            self.minutes[day] = [to_minutes(s.time) for s in items]
+
+    def resolve_day(self, day):
+        from lines.models import DailySchedule
+
+        for label in DailySchedule.day_labels(day):
+            if label in self.schedules:
+                return label
+        return None
+
+    def next_times(self, day, t, after=None):
+        return self.times_of(self.resolve_day(day), t, after)
+
+    def times_of(self, label, t, after=None):
+        if label not in self.schedules:
+            return []
+
+        schedules = self.schedules[label]
+        minutes = to_minutes(t)
+        if after is not None:
+            minutes = max(minutes, to_minutes(after[0]))
+        start = bisect.bisect_left(self.minutes[label], minutes)
+        if after is not None:
+            while start < len(schedules) and (schedules[start].time, schedules[start].id) <= after:
+                start += 1
+        return schedules[start:]
+
+
+# station id -> (timetable, schedule version of the station when loaded, or None if unknown)
+_timetables = {}
+_generation = 0
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def is_checked():
+    """
+    Return whether the versions of the timetables were checked recently enough to use them without a query
+    """
+    return time.time() - _checked_at < check_seconds()
+
+
+def check_versions():
+    """
+    Drop the timetables of the stations whose schedule changed since they were loaded, in any process,
+    unless checked recently
+    """
+    global _checked_at
+    from lines import timetable_file
+    from lines.models import Station
+
+    if is_checked():
+        return
+    checked_at = time.time()
+    versions = dict(Station.objects.values_list('id', 'schedule_version'))
+    timetable_file.check_versions(versions)
+    with _lock:
+        _checked_at = checked_at
+        for station_id, (_, version) in list(_timetables.items()):
+            if versions.get(station_id) != version:
+                del _timetables[station_id]
+
+
+def schedule_version(schedules):
+    # the version read in the same query as the times, or unknown for a station without times
+    return schedules[0].station.schedule_version if schedules else None
+
+
+def get(station_id):
+    check_versions()
+    entry = _timetables.get(station_id)
+    if entry is not None:
+        return entry[0]
+
+    from lines import timetable_file
+    from lines.models import DailySchedule
+
+    timetable = timetable_file.get(station_id)
+    if timetable is not None:
+        return timetable
+
+    generation = _generation
+    schedules = list(DailySchedule.objects.filter(station_id=station_id).select_related('station__line'))
+    timetable = StationTimetable(schedules)
+    with _lock:
+        # don't keep a timetable that was invalidated while loading
+        if generation == _generation:
+            _timetables[station_id] = timetable, schedule_version(schedules)
+    return timetable
+
+
+def snapshot(station_ids):
+    """
+    Return the timetables of stations by station id if they are all available without querying the database,
+    or else None
+    """
+    from lines import timetable_file
+
+    if not is_checked():
+        return None
+    timetables = {}
+    for station_id in station_ids:
+        entry = _timetables.get(station_id)
+        timetables[station_id] = entry[0] if entry is not None else timetable_file.get(station_id)
+        if timetables[station_id] is None:
+            return None
+    return timetables
+
+
+def preload():
+    """
+    Load the timetables of all stations, with a single query, unless they are read from the timetable file
+    """
+    from lines import timetable_file
+    from lines.models import Station, DailySchedule
+
+    check_versions()
+    if timetable_file.current() is not None:
+        return
+
+    generation = _generation
+    station_ids = list(Station.objects.values_list('id', flat=True))
+    schedules = defaultdict(list)
+    for schedule in DailySchedule.objects.select_related('station__line').iterator():
+        schedules[schedule.station_id].append(schedule)
+    timetables = {}
+    for station_id in station_ids:
+        station_schedules = schedules.get(station_id, [])
+        timetables[station_id] = StationTimetable(station_schedules), schedule_version(station_schedules)
+    with _lock:
+        if generation == _generation:
+            _timetables.update(timetables)
+
+
+def invalidate(station_ids=None):
+    global _generation, _checked_at
+    from lines import timetable_file
+
+    timetable_file.invalidate(station_ids)
+    with _lock:
+        _generation += 1
+        if station_ids is None:
+            _timetables.clear()
+            _checked_at = 0
+        else:
+            for station_id in station_ids:
+                _timetables.pop(station_id, None)
+
+
+@receiver(schedule_changed)
+def invalidate_changed(sender, station_ids, **kwargs):
+    invalidate(station_ids)
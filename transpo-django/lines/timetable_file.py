@@ -0,0 +1,296 @@
+"""
+Compiled timetables of all stations in a binary file, memory-mapped read-only.
+
+When the TRANSPO_TIMETABLE_INDEX setting is enabled and TRANSPO_TIMETABLE_FILE is the path of a file
+built by the timetable command, the timetables of stations are read from the file instead of being loaded
+from the database into each process. The file holds, for each station and day label, the times of the day
+as packed arrays of minutes since midnight, seconds and ids, sorted by time and id,
+so that all the processes of a server share a single copy of the timetables in the page cache,
+and open it without loading anything.
+
+The command writes a new file next to the old one and renames it over the old one,
+which processes notice within CHECK_INTERVAL seconds. The file also holds the schedule version
+of each station when it was built, and the stations whose schedule changed since,
+in this process or as found by the checks of versions of the timetable module,
+are loaded from the database instead.
+"""
+import bisect
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import defaultdict
+from collections.abc import Sequence
+from datetime import time as datetime_time
+
+from django.conf import settings
+
+from lines import export
+from lines.timetable import StationTimetable
+
+MAGIC = b'TTBL'
+VERSION = 2
+
+# magic, version, little endian, max station id, stations, buckets, times, size of labels, time of build
+HEADER = struct.Struct('<4sHBxIIIIId')
+HEADER_SIZE = 40
+
+CHECK_INTERVAL = 5
+
+
+def path():
+    return getattr(settings, 'TRANSPO_TIMETABLE_FILE', None)
+
+
+def padding(size, alignment=4):
+    return -size % alignment
+
+
+def build(filename, chunk_size=100):
+    """
+    Write the timetables of all stations to a new file, and rename it to the filename
+
+    :param chunk_size: the number of stations whose times to query at once
+    :return: (number of stations, number of times)
+    """
+    from lines.models import Station, DailySchedule
+
+    built_at = time.time()
+    labels = {}
+    station_ids, station_versions, station_buckets = array('I'), array('I'), array('I', [0])
+    bucket_labels, bucket_starts = array('I'), array('I')
+    ids, minutes, seconds = array('I'), array('H'), array('B')
+    max_station_id = 0
+
+    # the versions are read before the times, so that a change in between is found by the next check
+    for chunk in export.iter_chunks(Station.objects.all(), ('id', 'schedule_version'), chunk_size):
+        max_station_id = chunk[-1][0]
+        times = defaultdict(list)
+        schedules = DailySchedule.objects.filter(station_id__in=[pk for pk, _ in chunk])
+        for station_id, day, t, pk in schedules.order_by('station_id', 'day', 'time', 'id').values_list(
+                'station_id', 'day', 'time', 'id'):
+            times[station_id].append((day, t, pk))
+
+        for station_id, version in chunk:
+            station_ids.append(station_id)
+            station_versions.append(version)
+            current = None
+            for day, t, pk in times.get(station_id, ()):
+                if day != current:
+                    bucket_labels.append(labels.setdefault(day, len(labels)))
+                    bucket_starts.append(len(ids))
+                    current = day
+                ids.append(pk)
+                minutes.append(t.hour * 60 + t.minute)
+                seconds.append(t.second)
+            station_buckets.append(len(bucket_labels))
+    bucket_starts.append(len(ids))
+
+    labels_blob = '\n'.join(sorted(labels, key=labels.get)).encode('utf-8')
+    header = HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little', max_station_id,
+                         len(station_ids), len(bucket_labels), len(ids), len(labels_blob), built_at)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.timetable-')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(header + b'\0' * (HEADER_SIZE - len(header)))
+            fh.write(labels_blob + b'\0' * padding(len(labels_blob)))
+            for values in (station_ids, station_versions, station_buckets, bucket_labels, bucket_starts,
+                           ids, minutes, seconds):
+                fh.write(values.tobytes())
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp, 0o644)
+        # processes that mapped the previous file keep reading it until they reopen the new one
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(station_ids), len(ids)
+
+
+class PackedTimes(Sequence):
+    """
+    The times of a station and label in the file, as daily schedules created when accessed
+    """
+    def __init__(self, timetable_file, station_id, label, start, end):
+        self.file = timetable_file
+        self.station_id = station_id
+        self.label = label
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return PackedTimes(self.file, self.station_id, self.label, self.start + start,
+                               self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.file.schedule(self.station_id, self.label, self.start + index)
+
+
+class TimetableFile(object):
+    def __init__(self, filename):
+        with open(filename, 'rb') as fh:
+            stat = os.fstat(fh.fileno())
+            self.identity = stat.st_ino, stat.st_mtime_ns
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, little, self.max_station_id, station_count, bucket_count, time_count, labels_size,
+         self.built_at) = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION or little != (sys.byteorder == 'little'):
+            raise ValueError('not a timetable file of this version and byte order: {}'.format(filename))
+
+        view = memoryview(self.mmap)
+        offset = HEADER_SIZE
+        self.labels = bytes(view[offset:offset + labels_size]).decode('utf-8').split('\n')
+        offset += labels_size + padding(labels_size)
+
+        def take(typecode, count):
+            nonlocal offset
+            size = count * array(typecode).itemsize
+            values = view[offset:offset + size].cast(typecode)
+            offset += size
+            return values
+
+        self.station_ids = take('I', station_count)
+        self.versions = dict(zip(self.station_ids, take('I', station_count)))
+        self.station_buckets = take('I', station_count + 1)
+        self.bucket_labels = take('I', bucket_count)
+        self.bucket_starts = take('I', bucket_count + 1)
+        self.ids = take('I', time_count)
+        self.minutes = take('H', time_count)
+        self.seconds = take('B', time_count)
+
+    def covers(self, station_id):
+        return station_id <= self.max_station_id
+
+    def timetable(self, station_id):
+        """
+        Return the timetable of a station, which has no times if the station had none when the file was built
+        """
+        buckets = {}
+        index = bisect.bisect_left(self.station_ids, station_id)
+        if index < len(self.station_ids) and self.station_ids[index] == station_id:
+            for bucket in range(self.station_buckets[index], self.station_buckets[index + 1]):
+                label = self.labels[self.bucket_labels[bucket]]
+                buckets[label] = self.bucket_starts[bucket], self.bucket_starts[bucket + 1]
+        return PackedStationTimetable(self, station_id, buckets)
+
+    def schedule(self, station_id, label, index):
+        from lines.models import DailySchedule
+
+        minutes = self.minutes[index]
+        t = datetime_time(minutes // 60, minutes % 60, self.seconds[index])
+        return DailySchedule(id=self.ids[index], station_id=station_id, day=label, time=t)
+
+
+class PackedStationTimetable(StationTimetable):
+    """
+    The timetable of a station in the file, with the interface of the timetables loaded from the database
+    """
+    def __init__(self, timetable_file, station_id, buckets):
+        self.schedules = {}
+        self.minutes = {}
+        for label, (start, end) in buckets.items():
+            self.schedules[label] = PackedTimes(timetable_file, station_id, label, start, end)
+            self.minutes[label] = timetable_file.minutes[start:end]
+
+
+_file = None
+_checked_at = 0
+_changed = {}
+_lock = threading.Lock()
+
+
+def current():
+    """
+    Return the timetable file, reopened if it was replaced, or None without a file
+    """
+    global _file, _checked_at
+
+    filename = path()
+    if not filename:
+        return None
+
+    now = time.time()
+    if now - _checked_at < CHECK_INTERVAL:
+        return _file
+
+    with _lock:
+        _checked_at = now
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            _file = None
+            return None
+        if _file is None or _file.identity != (stat.st_ino, stat.st_mtime_ns):
+            # the previous map is closed once no timetable refers to it
+            _file = TimetableFile(filename)
+            for station_id, changed_at in list(_changed.items()):
+                if changed_at <= _file.built_at:
+                    del _changed[station_id]
+        return _file
+
+
+def get(station_id):
+    """
+    Return the timetable of a station from the file, or None if it must be loaded from the database
+    """
+    timetable_file = current()
+    if timetable_file is None or not timetable_file.covers(station_id) or station_id in _changed:
+        return None
+    return timetable_file.timetable(station_id)
+
+
+def check_versions(versions):
+    """
+    Load from the database the stations whose schedule version differs from their version in the file,
+    and from the file again those whose version is the same
+
+    :param versions: map of the id of each station to its schedule version
+    """
+    timetable_file = current()
+    if timetable_file is None:
+        return
+
+    now = time.time()
+    with _lock:
+        for station_id, version in versions.items():
+            if not timetable_file.covers(station_id):
+                continue
+            if timetable_file.versions.get(station_id) == version:
+                _changed.pop(station_id, None)
+            elif station_id not in _changed:
+                _changed[station_id] = now
+
+
+def invalidate(station_ids=None):
+    """
+    Load the stations from the database until the file is rebuilt, or reopen the file for all stations
+    """
+    global _file, _checked_at
+
+    with _lock:
+        if station_ids is None:
+            _file = None
+            _checked_at = 0
+            _changed.clear()
+        else:
+            now = time.time()
+            for station_id in station_ids:
+                _changed[station_id] = now
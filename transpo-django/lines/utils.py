@@ -1,9 +1,108 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict
 from datetime import time
+from itertools import islice
+
+from django.db import connections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def time_key(t):
+    """
+    Return a number that orders times like the times themselves, numbers being their own keys
+
+    >>> time_key(time(1, 2, 3, 4))
+    3723000004
+
+    >>> time_key(62)
+    62
+    """
+    if isinstance(t, time):
+        return ((t.hour * 60 + t.minute) * 60 + t.second) * 1000000 + t.microsecond
+    return t
+
+
+class TimeIndex(object):
+    """
+    Sorted times, searched for many query times at once.
+
+    The keys of the times are computed once, so each search costs O(log n) instead of a scan of the times,
+    and the searches of a batch are done by numpy.searchsorted when numpy is installed,
+    or else by bisect, each search starting from where the search of the previous query time in order stopped.
+
+    >>> index = TimeIndex([time(1, 1), time(2, 2), time(3, 3)])
+    >>> index.first_indexes([time(2, 2), time(0, 0), time(3, 4)])
+    [1, 0, 3]
+
+    >>> index.lookup([time(1, 9)], limit=1)
+    [(1, [datetime.time(2, 2)])]
+    """
+    def __init__(self, times, key=time_key):
+        self.times = times
+        self.key = key
+        self.keys = [key(t) for t in times]
+        self.array = numpy.array(self.keys) if numpy is not None and self.keys else None
+
+    def first_indexes(self, queries):
+        """
+        Return the index of the first time greater than or equal to each query time
+        """
+        keys = [self.key(t) for t in queries]
+        if self.array is not None and keys:
+            return numpy.searchsorted(self.array, keys, side='left').tolist()
+
+        indexes = [0] * len(keys)
+        lo = 0
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            lo = bisect_left(self.keys, keys[i], lo)
+            indexes[i] = lo
+        return indexes
+
+    def lookup(self, queries, limit=None):
+        """
+        Return the index of the first time greater than or equal to each query time, and the times from there
+
+        :param limit: the maximum number of times to return for each query
+        :return: list of (index, times) pairs, in the order of the queries
+        """
+        return [(i, list(self.times[i:None if limit is None else i + limit])) for i in self.first_indexes(queries)]
+
+
+def batch_lookup(indexes, queries, limit=None):
+    """
+    Find the next times of many (key, time) queries, such as (station id, time), with one search per key
+
+    >>> indexes = {1: TimeIndex([time(1, 1), time(2, 2)]), 2: TimeIndex([time(1, 30)])}
+    >>> batch_lookup(indexes, [(1, time(1, 2)), (2, time(1, 2)), (3, time(1, 2))], limit=1)
+    [(1, [datetime.time(2, 2)]), (0, [datetime.time(1, 30)]), (0, [])]
+
+    :param indexes: map of key to TimeIndex; keys without index have no times
+    :param queries: (key, time) pairs
+    :param limit: the maximum number of times to return for each query
+    :return: list of (index, times) pairs, in the order of the queries
+    """
+    positions = defaultdict(list)
+    for position, (key, t) in enumerate(queries):
+        positions[key].append((position, t))
+
+    result = [(0, []) for _ in range(sum(len(items) for items in positions.values()))]
+    for key, items in positions.items():
+        index = indexes.get(key)
+        if index is None:
+            continue
+        for (position, _), found in zip(items, index.lookup([t for _, t in items], limit)):
+            result[position] = found
+    return result
 
 
 def times_gte(times, t):
     """
-    Return the times greater than or equal to specified time
+    Return the times greater than or equal to specified time, in their order
 
     >>> times_gte([], None)
     []
@@ -23,8 +122,74 @@ def times_gte(times, t):
     >>> times_gte([time(1, 1), time(2, 2), time(3, 3)], time(1, 9))
     [datetime.time(2, 2), datetime.time(3, 3)]
 
-    :param times: time objects to filter
+    >>> times_gte([time(3, 0), time(1, 0), time(2, 0)], time(1, 30))
+    [datetime.time(3, 0), datetime.time(2, 0)]
+
+    :param times: time objects to filter, searched with an index when sorted
     :param t: target time to compare to
     :return: times greater than or equal to t
     """
-    return list(filter(lambda x: t <= x, times))
+    if not times:
+        return []
+    if any(a > b for a, b in zip(times, islice(times, 1, None))):
+        return [x for x in times if x >= t]
+    (_, result), = TimeIndex(times).lookup([t])
+    return result
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of the specified size, without consuming it all at once
+
+    >>> list(chunked([], 2))
+    []
+
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+
+    :param iterable: items to split
+    :param size: maximum size of the chunks
+    :return: generator of lists of items
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def query_plan(queryset):
+    """
+    Return the lines of the query plan of a queryset, as explained by the database
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+TABLE_SCAN_PATTERNS = (
+    # sqlite: "SCAN lines_dailyschedule", or "SCAN TABLE lines_dailyschedule" in older versions
+    re.compile(r'^SCAN (?:TABLE )?(\w+)'),
+    # postgresql: "Seq Scan on lines_dailyschedule"
+    re.compile(r'Seq Scan on (\w+)'),
+)
+
+
+def table_scans(queryset):
+    """
+    Return the names of the tables that the database would read entirely to run a queryset
+    """
+    tables = []
+    for line in query_plan(queryset):
+        for pattern in TABLE_SCAN_PATTERNS:
+            match = pattern.search(line.strip())
+            if match:
+                tables.append(match.group(1))
+    return tables
@@ -0,0 +1,19 @@
+"""
+ASGI config for transpo project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+which answers the compact lookups of next times asynchronously, see api.asgi,
+and passes all other requests to the WSGI application.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "transpo.settings")
+
+wsgi_application = get_wsgi_application()
+
+from api.asgi import TimesApplication  # noqa: E402, the settings must be configured first
+
+application = TimesApplication(wsgi_application)
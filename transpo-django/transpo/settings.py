@@ -40,10 +40,12 @@ INSTALLED_APPS = (
     'rest_framework',
     'lines',
     'api',
+    'benchmarks',
     'corsheaders',
 )
 
 MIDDLEWARE_CLASSES = (
+    'api.middleware.SQLInstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,6 +55,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.ProfilingMiddleware',
 )
 
 ROOT_URLCONF = 'transpo.urls'
@@ -119,3 +122,75 @@ REST_FRAMEWORK = {
 # Project specific
 
 CORS_ORIGIN_ALLOW_ALL = True
+
+# Serve next departures of stations from compiled in-memory timetables
+# instead of querying the daily schedule on every request
+TRANSPO_TIMETABLE_INDEX = False
+
+# How often to check the schedule versions of all stations with one query, to drop the timetables
+# of the stations changed by other processes
+TRANSPO_TIMETABLE_CHECK_SECONDS = 5
+
+# With the timetable index, read the timetables from this file built by the timetable command,
+# mapped in memory and shared by all processes, instead of loading them in each process
+TRANSPO_TIMETABLE_FILE = None
+
+# Resolve the day labels of stations from the service calendar compiled by the calendar command,
+# which takes holidays and other calendar exceptions into account, for the number of days from today
+TRANSPO_SERVICE_CALENDAR = False
+TRANSPO_SERVICE_CALENDAR_DAYS = 60
+
+# Read the times of stations from the departures materialized per date by the departures command,
+# for the dates of the window of days they were built for
+TRANSPO_DEPARTURES = False
+TRANSPO_DEPARTURES_DAYS = 30
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'times': {
+        'BACKEND': 'api.cache.LRULocMemCache',
+        'LOCATION': 'times',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# Cache alias for the responses of the times endpoints, for example 'times', or None to disable.
+# The 'times' cache is local to each process, and only suits a single process serving the times:
+# with several, use a cache shared by the processes, such as memcached.
+TRANSPO_TIMES_CACHE = None
+TRANSPO_TIMES_CACHE_TIMEOUT = 300
+
+# Report the number of queries and the time spent in the database of requests in Server-Timing headers,
+# and log the queries of requests exceeding the budgets, of queries or milliseconds, None for no budget
+TRANSPO_SQL_INSTRUMENTATION = False
+TRANSPO_SQL_QUERY_BUDGET = 20
+TRANSPO_SQL_LATENCY_BUDGET = 500
+TRANSPO_SQL_STATEMENTS_LOGGED = 10
+
+# Profile requests with a profile parameter or X-Profile header, of staff users,
+# or with an X-Profile-Secret header matching the secret, None to allow only staff users,
+# returning a summary, or writing the profile to the directory with profile=file
+TRANSPO_PROFILING = False
+TRANSPO_PROFILING_SECRET = None
+TRANSPO_PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+TRANSPO_PROFILING_SORT = 'cumulative'
+TRANSPO_PROFILING_LIMIT = 40
+
+# Time to change between the stations of different lines with the same name, in journeys
+TRANSPO_JOURNEY_TRANSFER_MINUTES = 2
+
+# How often to check the schedule versions of all stations with one query, to drop the connections of journeys
+# built before other processes changed a schedule
+TRANSPO_JOURNEY_CHECK_SECONDS = 5
+
+# Number of departures of the boards of locations streamed as server-sent events,
+# and how often boards check for schedules changed in other processes
+TRANSPO_BOARD_LIMIT = 10
+TRANSPO_BOARD_CHECK_SECONDS = 30
+
+# Maximum number of stations in one request of the times of many stations
+TRANSPO_BATCH_MAX_STATIONS = 50